@@ -0,0 +1,117 @@
+"""
+Замер времени и пиковой памяти Python при сборке JSON с изображениями.
+
+Сравнивает прежний путь (base64-строка на каждое фото + json.dumps всего тела)
+и потоковый (Base64Payload + StreamingJsonBody) - для тела запроса к Claude и
+для ответа группировки браузеру. Декодированные пиксели Pillow выделяет вне
+интерпретатора, tracemalloc их не видит - они в замер не входят.
+
+Запуск из корня репозитория:
+    python bench/memory_benchmark.py --images 5 --size 3000
+"""
+import argparse
+import base64
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import List
+
+# Хранилище сервиса при импорте main - во временной папке, а не в репозитории
+os.environ.setdefault("STORAGE_BASE", tempfile.mkdtemp(prefix="bench_storage_"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image  # noqa: E402
+
+import main  # noqa: E402
+from main import Base64Payload, JSONResponse, StreamingJsonBody  # noqa: E402
+
+
+def traced_peak(fn) -> int:
+    """Пик памяти, выделенной Python во время вызова fn, сверх уже занятой"""
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        fn()
+        return tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        tracemalloc.stop()
+
+
+def measure(fn, data_bytes: int) -> dict:
+    started = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - started
+    peak = traced_peak(fn)
+    return {"seconds": round(seconds, 4), "peak_bytes": peak, "copies_per_image": round(peak / data_bytes, 2)}
+
+
+def request_body(resized: List[tuple[bytes, str]], encode) -> dict:
+    content = [{
+        "type": "image",
+        "source": {"type": "base64", "media_type": mime_type, "data": encode(data)}
+    } for data, mime_type in resized]
+    content.append({"type": "text", "text": "benchmark"})
+    return {"model": main.CLAUDE_MODEL, "messages": [{"role": "user", "content": content}]}
+
+
+def grouping_response(file_info: List[dict], data_url) -> dict:
+    results = []
+    for i, info in enumerate(file_info):
+        images = [data_url(info)]
+        results.append({"id": f"product_{i}", "title": "Товар", "images": images, "image_preview": images[0]})
+    return {"success": True, "results": results, "processed_count": len(results)}
+
+
+def eager_data_url(info: dict) -> str:
+    image_base64 = base64.b64encode(info['contents']).decode('utf-8')
+    return f"data:image/{info['filename'].split('.')[-1]};base64,{image_base64}"
+
+
+def consume(body: StreamingJsonBody) -> None:
+    for _ in body:
+        pass
+
+
+def run_memory_benchmark(images: int, size: int) -> dict:
+    file_info = []
+    for i in range(images):
+        # Шум сжимается хуже реальных фото - оценка сверху
+        image = Image.frombytes('RGB', (size, size * 3 // 4), os.urandom(size * size * 3 // 4 * 3))
+        output = io.BytesIO()
+        image.save(output, format='JPEG', quality=90)
+        file_info.append(main.image_info(f"{i}.jpg", output.getvalue()))
+    resized = [main.resize_image_for_claude(info['contents']) for info in file_info]
+
+    resized_bytes = sum(len(data) for data, _ in resized)
+    source_bytes = sum(info['size'] for info in file_info)
+    return {
+        "images": images,
+        "source_size": f"{size}x{size * 3 // 4}",
+        "json_library": "orjson" if main.orjson is not None else "json",
+        "request": {
+            "resized_bytes": resized_bytes,
+            "eager": measure(lambda: json.dumps(request_body(
+                resized, lambda data: base64.b64encode(data).decode('utf-8'))).encode('utf-8'), resized_bytes),
+            "streamed": measure(lambda: consume(StreamingJsonBody(
+                request_body(resized, Base64Payload))), resized_bytes)
+        },
+        "response": {
+            "source_bytes": source_bytes,
+            "eager": measure(lambda: JSONResponse(grouping_response(file_info, eager_data_url)).body, source_bytes),
+            "streamed": measure(lambda: consume(StreamingJsonBody(
+                grouping_response(file_info, main.image_data_url))), source_bytes)
+        }
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Время и пиковая память на сборку JSON с изображениями")
+    parser.add_argument("--images", type=int, default=5, help="число фото (1-20)")
+    parser.add_argument("--size", type=int, default=3000, help="ширина фото в пикселях (100-6000)")
+    args = parser.parse_args()
+    result = run_memory_benchmark(max(1, min(args.images, 20)), max(100, min(args.size, 6000)))
+    print(json.dumps(result, ensure_ascii=False, indent=2))
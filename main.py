@@ -1,27 +1,68 @@
-from fastapi import FastAPI, UploadFile, File, Request, HTTPException
-from fastapi.responses import HTMLResponse, FileResponse, JSONResponse
+from fastapi import FastAPI, UploadFile, File, Form, Request, HTTPException
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.datastructures import Headers, MutableHeaders
 import io
 import os
 import base64
+import binascii
+import gzip
+import zlib
 import anthropic
+import httpx
 import json
 import traceback
-from typing import List
+from typing import List, Optional
 import logging
 import logging.handlers
 import time
+import contextvars
+import re
+import secrets
+import hashlib
+import threading
+import queue
+import urllib.request
+import asyncio
+import shutil
+import sqlite3
+import zipfile
+import mimetypes
+import heapq
+import math
+import random
+from contextlib import contextmanager
+from collections import OrderedDict, deque
 from datetime import datetime
-import io
 from PIL import Image
 
+# Текущий спан трассировки запроса (см. раздел "Трассировка запросов")
+_current_span: contextvars.ContextVar = contextvars.ContextVar(
+    "current_span", default=None)
+
+
+class TraceIdLogFilter(logging.Filter):
+    """Добавляет trace_id текущего запроса в каждую строку лога"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        # trace_id, переданный явно (extra), не переопределяем
+        if not hasattr(record, "trace_id"):
+            span = _current_span.get()
+            record.trace_id = span.trace_id if span else "-"
+        return True
+
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s'
+
 # Временная настройка логирования (будет обновлена после определения STORAGE_BASE)
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    format=LOG_FORMAT,
     handlers=[logging.StreamHandler()]  # Пока только консоль
 )
+for _handler in logging.getLogger().handlers:
+    _handler.addFilter(TraceIdLogFilter())
 logger = logging.getLogger(__name__)
 
 app = FastAPI(title="Somon.tj",
@@ -36,8 +77,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Определяем базовую папку для хранения (используем примонтированный диск Render)
-STORAGE_BASE = "/var/data" if os.path.exists("/var/data") else "."
+# Определяем базовую папку для хранения (используем примонтированный диск Render);
+# STORAGE_BASE в окружении задает ее явно (например, временная папка тестов)
+STORAGE_BASE = os.getenv("STORAGE_BASE") or ("/var/data" if os.path.exists("/var/data") else ".")
 
 # Создаем папки
 os.makedirs("static", exist_ok=True)
@@ -56,1386 +98,3769 @@ file_handler = logging.handlers.RotatingFileHandler(
     maxBytes=10*1024*1024,  # 10MB
     backupCount=5
 )
-file_handler.setFormatter(logging.Formatter(
-    '%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+file_handler.addFilter(TraceIdLogFilter())
 logger.addHandler(file_handler)
 logger.info(f"📝 Логи сохраняются в: {log_file_path}")
 
-# Подключаем статические файлы
-app.mount("/static", StaticFiles(directory="static"), name="static")
-
-# Структура категорий Somon.tj
-SOMON_CATEGORIES = """Телефоны и связь
--- Мобильные телефоны
--- Аксессуары для телефонов
--- Ремонт и сервис телефонов
--- Запчасти и инструменты для телефонов
--- Стационарные телефоны
--- Другая техника связи
-
-Детский мир
--- Детская одежда
--- Детская обувь
--- Детская мебель
--- Детские коляски, качели
--- Детские автокресла
--- Детский транспорт
--- Детские часы
--- Игрушки
--- Товары для мам
--- Товары для кормления
--- Товары для школьников
--- Товары для детского купания
--- Постельные принадлежности
--- Другие детские товары
-
-Одежда и личные вещи
--- Мужская одежда
--- Женская одежда
--- Обувь
--- Аксессуары, шарфы, головные уборы
--- Парфюмерия и косметика
--- Часы и украшения
--- Для свадьбы
--- Одежда на прокат
--- Другие товары
--- Потери и находки
--- Чемоданы, сумки, клатчи
--- Ткани и материалы для пошива одежды
-
-Компьютеры и оргтехника
--- Ноутбуки
--- Персональные компьютеры
--- Игровые приставки
--- Программы и игры
--- Планшеты и букридеры
--- Принтеры и сканеры
--- Мониторы и проекторы
--- Модемы и сетевое оборудование
--- Комплектующие и аксессуары
--- Ремонт
--- Серверы
--- Другая техника
-
-Электроника и бытовая техника
--- Фото и видеокамеры
--- TV, DVD и видео
--- Аудио и стерео
--- Техника для дома и кухни
--- Для личного ухода
--- Принадлежности и аппараты для здоровья
--- Аксессуары и комплектующие
--- Электронные компоненты и радиодетали
--- Системы видеонаблюдения, охраны, "Умный дом"
--- Другая техника
--- Климатическая техника
-
-Все для дома
--- Мебель
--- Текстиль и интерьер
--- Пищевые продукты
--- Посуда и кухонная утварь
--- Хозяйственный инвентарь и бытовая химия
--- Сад и огород
--- Сейфы
--- Канцтовары
--- Другие товары для дома
--- Товары для праздников
-
-Строительство, сырье и ремонт
--- Электроинструмент
--- Ручной инструмент
--- Строительные и отделочные материалы
-
-Хобби, музыка и спорт
--- Спорт и инвентарь
--- Велосипеды и принадлежности
--- Музыкальные инструменты
--- Книги и журналы
--- CD, DVD, пластинки и кассеты
--- Антиквариат и коллекции
--- Билеты
-
-Животные и растения
--- Собаки
--- Кошки
--- Кролики
--- Птицы
--- Вязка
--- Садовые растения
--- Сельхоз животные
--- Аквариумные
--- Комнатные растения
--- Товары для животных
--- Другие животные
--- Отдам даром
--- Утерянные животные
--- Корм для животных
--- Пчёлы и инвентарь для пчеловодства
-
-Все для бизнеса
--- Бизнес на продажу
--- Оборудование
--- Сырьё и материалы для бизнеса
--- Готовый бизнес в аренду"""
-
-
-def resize_image_for_claude(image_data: bytes, max_size: int = 2000) -> tuple[bytes, str]:
-    """Изменяет размер изображения для соответствия ограничениям Claude API"""
-    try:
-        # Открываем изображение
-        image = Image.open(io.BytesIO(image_data))
+# ===== Трассировка запросов =====
+# Спаны в стиле OpenTelemetry вокруг этапов конвейера анализа.
+# TRACE_EXPORTER: file (logs/traces.jsonl), otlp (OTLP/HTTP JSON коллектор) или none
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "file").lower()
+TRACE_FILE_PATH = os.path.join(STORAGE_BASE, "logs", "traces.jsonl")
+TRACE_FILE_MAX_BYTES = 10*1024*1024  # 10MB, затем файл ротируется в .1
+OTLP_ENDPOINT = os.getenv(
+    "OTEL_EXPORTER_OTLP_ENDPOINT", "http://localhost:4318").rstrip("/")
+OTEL_SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "image-cluster-service")
+# Служебные эндпоинты, которые опрашиваются постоянно и не трассируются
+TRACE_SKIP_PREFIXES = ("/api/logs", "/api/health")
+
+
+class Span:
+    """Один этап обработки запроса: имя, время, атрибуты и статус"""
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attributes: dict):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.status = "OK"
+        self.error = None
+
+    @property
+    def duration_ms(self) -> float:
+        end_ns = self.end_ns or time.time_ns()
+        return (end_ns - self.start_ns) / 1e6
+
+    def set_attribute(self, key: str, value) -> None:
+        self.attributes[key] = value
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": datetime.fromtimestamp(self.start_ns / 1e9).isoformat(),
+            "duration_ms": round(self.duration_ms, 2),
+            "status": self.status,
+            "error": self.error,
+            "attributes": self.attributes
+        }
 
-        # Получаем текущие размеры
-        width, height = image.size
-        logger.info(f"📐 Исходный размер изображения: {width}x{height}")
+    def to_otlp(self) -> dict:
+        def otlp_value(value):
+            if isinstance(value, bool):
+                return {"boolValue": value}
+            if isinstance(value, int):
+                return {"intValue": str(value)}
+            if isinstance(value, float):
+                return {"doubleValue": value}
+            return {"stringValue": str(value)}
+
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or time.time_ns()),
+            "attributes": [{"key": k, "value": otlp_value(v)} for k, v in self.attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.status == "ERROR" else {"code": 1}
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
 
-        # Проверяем нужно ли изменять размер
-        if width <= max_size and height <= max_size:
-            logger.info(
-                f"✅ Размер изображения в пределах нормы ({max_size}px)")
-            # Определяем MIME тип исходного изображения
-            original_mime = "image/jpeg"
-            if image.format == 'PNG':
-                original_mime = "image/png"
-            elif image.format == 'WEBP':
-                original_mime = "image/webp"
-            return image_data, original_mime
-
-        # Вычисляем новые размеры с сохранением пропорций
-        if width > height:
-            new_width = max_size
-            new_height = int((height * max_size) / width)
+
+class BackgroundWriter:
+    """
+    Очередь с фоновым потоком-писателем: запрос кладет задачу и не ждет диск или сеть.
+    Поток забирает накопившееся пачкой (не больше batch_size) и передает в write_batch;
+    при переполнении очереди (по числу задач или, если задан max_pending_bytes,
+    по суммарному размеру) задача отбрасывается и считается в stats["dropped"]
+    """
+
+    thread_name = "background-writer"
+    error_message = "❌ Ошибка фоновой записи"
+
+    def __init__(self, max_pending: int, batch_size: int = 0, max_pending_bytes: int = 0):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.batch_size = batch_size
+        self.max_pending_bytes = max_pending_bytes
+        self.pending_bytes = 0
+        self.stats = {"queued": 0, "written": 0, "dropped": 0, "failed": 0}
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def put(self, item, nbytes: int = 0) -> bool:
+        """Ставит задачу (nbytes - ее размер в памяти) в очередь; False, если очередь переполнена"""
+        self._ensure_thread()
+        with self._lock:
+            if self.max_pending_bytes and self.pending_bytes + nbytes > self.max_pending_bytes:
+                self.stats["dropped"] += 1
+                return False
+            try:
+                self.queue.put_nowait((nbytes, item))
+            except queue.Full:
+                self.stats["dropped"] += 1
+                return False
+            self.pending_bytes += nbytes
+        self.stats["queued"] += 1
+        return True
+
+    def pending(self) -> int:
+        return self.queue.qsize()
+
+    def flush(self, timeout: float = 10.0) -> None:
+        """Ждет, пока очередь будет записана (используется при остановке сервера)"""
+        deadline = time.time() + timeout
+        while self.queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.05)
+
+    def write_batch(self, batch: list) -> int:
+        """Записывает пачку и возвращает число успешно записанных задач"""
+        raise NotImplementedError
+
+    def _ensure_thread(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if not (self._thread and self._thread.is_alive()):
+                self._thread = threading.Thread(
+                    target=self._run, name=self.thread_name, daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self.queue.get()]
+            # Собираем все, что накопилось, в одну пачку
+            while not self.batch_size or len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            written = 0
+            try:
+                written = self.write_batch([item for _, item in batch])
+            except Exception as e:
+                writer_logger.error(f"{self.error_message}: {e}")
+            finally:
+                self.stats["written"] += written
+                self.stats["failed"] += len(batch) - written
+                with self._lock:
+                    self.pending_bytes -= sum(nbytes for nbytes, _ in batch)
+                for _ in batch:
+                    self.queue.task_done()
+
+
+class SpanExporter(BackgroundWriter):
+    """Экспортирует завершенные спаны пачками в фоновом потоке, не задерживая запросы"""
+
+    thread_name = "span-exporter"
+
+    def __init__(self, mode: str):
+        super().__init__(max_pending=10000, batch_size=512)
+        self.mode = mode
+        self.error_message = f"❌ Ошибка экспорта спанов ({mode})"
+
+    def export(self, span: Span) -> None:
+        if self.mode not in ("file", "otlp"):
+            return
+        self.put(span)
+
+    def write_batch(self, batch: List[Span]) -> int:
+        if self.mode == "otlp":
+            self._send_otlp(batch)
         else:
-            new_height = max_size
-            new_width = int((width * max_size) / height)
-
-        logger.info(f"🔄 Изменяем размер до: {new_width}x{new_height}")
-
-        # Изменяем размер
-        resized_image = image.resize(
-            (new_width, new_height), Image.Resampling.LANCZOS)
-
-        # Сохраняем в байты
-        output = io.BytesIO()
-
-        # Определяем формат для сохранения с улучшенным сжатием
-        output_mime = "image/jpeg"  # По умолчанию
-        if image.format in ['JPEG', 'JPG']:
-            resized_image.save(output, format='JPEG',
-                               quality=75, optimize=True)  # Уменьшили quality для меньшего размера
-            output_mime = "image/jpeg"
-        elif image.format == 'PNG':
-            resized_image.save(output, format='PNG', optimize=True)
-            output_mime = "image/png"
+            self._write_file(batch)
+        return len(batch)
+
+    def _write_file(self, batch: List[Span]) -> None:
+        if os.path.exists(TRACE_FILE_PATH) and os.path.getsize(TRACE_FILE_PATH) > TRACE_FILE_MAX_BYTES:
+            os.replace(TRACE_FILE_PATH, TRACE_FILE_PATH + ".1")
+        with open(TRACE_FILE_PATH, 'a', encoding='utf-8') as f:
+            for span in batch:
+                f.write(json.dumps(span.to_dict(), ensure_ascii=False) + "\n")
+
+    def _send_otlp(self, batch: List[Span]) -> None:
+        payload = {
+            "resourceSpans": [{
+                "resource": {"attributes": [
+                    {"key": "service.name", "value": {"stringValue": OTEL_SERVICE_NAME}}
+                ]},
+                "scopeSpans": [{
+                    "scope": {"name": "main"},
+                    "spans": [span.to_otlp() for span in batch]
+                }]
+            }]
+        }
+        request = urllib.request.Request(
+            f"{OTLP_ENDPOINT}/v1/traces",
+            data=json.dumps(payload).encode('utf-8'),
+            headers={"Content-Type": "application/json"},
+            method="POST"
+        )
+        with urllib.request.urlopen(request, timeout=5) as response:
+            response.read()
+
+
+# Фоновые потоки работают вне запросов: trace_id задан заранее, фильтр его не ищет
+writer_logger = logging.LoggerAdapter(logger, {"trace_id": "-"})
+span_exporter = SpanExporter(TRACE_EXPORTER)
+
+
+@contextmanager
+def trace_span(name: str, **attributes):
+    """Открывает дочерний спан текущего запроса (или новый трейс, если запроса нет)"""
+    parent = _current_span.get()
+    if parent:
+        trace_id, parent_id = parent.trace_id, parent.span_id
+        # Идентификатор сессии наследуется всеми этапами запроса
+        if "session.id" in parent.attributes:
+            attributes.setdefault(
+                "session.id", parent.attributes["session.id"])
+    else:
+        trace_id, parent_id = secrets.token_hex(16), None
+
+    span = Span(name, trace_id, parent_id, attributes)
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.status = "ERROR"
+        span.error = str(e) or type(e).__name__
+        raise
+    finally:
+        span.end_ns = time.time_ns()
+        _current_span.reset(token)
+        logger.debug(f"⏱️ {name}: {span.duration_ms:.1f} мс")
+        span_exporter.export(span)
+
+
+def get_trace_id() -> Optional[str]:
+    """trace_id текущего запроса для ответа клиенту"""
+    span = _current_span.get()
+    return span.trace_id if span else None
+
+
+def set_span_attributes(**attributes) -> None:
+    """Добавляет атрибуты к текущему спану (например, session.id после его создания)"""
+    span = _current_span.get()
+    if span:
+        span.attributes.update(attributes)
+
+
+def parse_traceparent(header: Optional[str]) -> Optional[tuple[str, str]]:
+    """Разбирает W3C заголовок traceparent: 00-<trace_id>-<span_id>-<flags>"""
+    if not header:
+        return None
+    parts = header.strip().split('-')
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    return parts[1], parts[2]
+
+
+@app.middleware("http")
+async def tracing_middleware(request: Request, call_next):
+    """Корневой спан для каждого API запроса и заголовок X-Trace-Id в ответе"""
+    path = request.url.path
+    if not path.startswith("/api/") or path.startswith(TRACE_SKIP_PREFIXES):
+        return await call_next(request)
+
+    # Продолжаем внешний трейс, если клиент или прокси передали traceparent
+    remote_token = None
+    incoming = parse_traceparent(request.headers.get("traceparent"))
+    if incoming:
+        remote_parent = Span("remote", incoming[0], None, {})
+        remote_parent.span_id = incoming[1]
+        remote_token = _current_span.set(remote_parent)
+
+    try:
+        with trace_span(f"{request.method} {path}", **{
+            "http.method": request.method,
+            "http.route": path,
+            "http.request_content_length": int(request.headers.get("content-length", 0) or 0)
+        }) as span:
+            response = await call_next(request)
+            span.set_attribute("http.status_code", response.status_code)
+    finally:
+        if remote_token:
+            _current_span.reset(remote_token)
+
+    response.headers["X-Trace-Id"] = span.trace_id
+    return response
+
+# ===== Сжатие ответов и условные запросы =====
+# Ответы больше COMPRESSION_MIN_BYTES сжимаются brotli или gzip - что поддерживает
+# браузер. Статика и встроенные HTML-страницы сжимаются один раз и хранятся в памяти
+# вместе с ETag: повторный запрос с If-None-Match получает 304 без тела.
+# Поток SSE (/api/logs/stream) не сжимается - события должны уходить сразу.
+try:
+    import brotli
+except ImportError:  # необязательная зависимость - тогда только gzip
+    brotli = None
+
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))
+COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", "6"))
+# Для ответов на лету brotli с низким качеством: почти как gzip по скорости, но плотнее
+BROTLI_DYNAMIC_QUALITY = 4
+# Куски больше этого сжимаются в пуле потоков, чтобы не задерживать цикл событий
+COMPRESSION_THREAD_MIN_BYTES = 64 * 1024
+STATIC_CACHE_MAX_FILE_BYTES = 2 * 1024 * 1024
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript", "image/svg+xml")
+SUPPORTED_ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def is_compressible(content_type: str) -> bool:
+    return content_type.startswith(COMPRESSIBLE_TYPES) and not content_type.startswith("text/event-stream")
+
+
+def negotiate_encoding(accept_encoding: Optional[str], available) -> Optional[str]:
+    """Лучшая из доступных кодировок по Accept-Encoding (brotli предпочтительнее gzip)"""
+    accepted = {}
+    for item in (accept_encoding or "").split(","):
+        name, _, params = item.partition(";")
+        match = re.search(r"q=([0-9.]+)", params)
+        try:
+            accepted[name.strip().lower()] = float(match.group(1)) if match else 1.0
+        except ValueError:
+            continue
+    for encoding in SUPPORTED_ENCODINGS:
+        if encoding in available and accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+class StreamCompressor:
+    """Потоковое сжатие тела ответа: gzip или brotli"""
+
+    def __init__(self, encoding: str):
+        if encoding == "br":
+            compressor = brotli.Compressor(quality=BROTLI_DYNAMIC_QUALITY)
+            self.compress, self.finish = compressor.process, compressor.finish
         else:
-            # Для WebP и других форматов сохраняем как JPEG с хорошим сжатием
-            if resized_image.mode in ('RGBA', 'LA', 'P'):
-                # Конвертируем в RGB для JPEG
-                rgb_image = Image.new(
-                    'RGB', resized_image.size, (255, 255, 255))
-                if resized_image.mode == 'P':
-                    resized_image = resized_image.convert('RGBA')
-                rgb_image.paste(resized_image, mask=resized_image.split(
-                )[-1] if resized_image.mode in ('RGBA', 'LA') else None)
-                resized_image = rgb_image
-            resized_image.save(output, format='JPEG',
-                               quality=75, optimize=True)  # Уменьшили quality
-            output_mime = "image/jpeg"
-
-        resized_data = output.getvalue()
-        size_change = len(resized_data)/len(image_data)*100
-        logger.info(
-            f"✅ Размер изменен: {len(image_data)} → {len(resized_data)} байт ({size_change:.1f}%)")
-        logger.info(f"📎 Формат: {image.format} → {output_mime}")
+            compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 31)  # 31 - формат gzip
+            self.compress, self.finish = compressor.compress, compressor.flush
+
+
+class CompressionMiddleware:
+    """ASGI-middleware сжатия ответов, в том числе потоковых (StreamingJSONResponse)"""
+
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_BYTES):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding"), SUPPORTED_ENCODINGS)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        compressor = None
+        passthrough = False
+
+        async def compress(data: bytes) -> bytes:
+            if len(data) >= COMPRESSION_THREAD_MIN_BYTES:
+                return await asyncio.to_thread(compressor.compress, data)
+            return compressor.compress(data)
+
+        async def send_compressed(message):
+            nonlocal start_message, compressor, passthrough
+            if message["type"] == "http.response.start":
+                # Решение о сжатии принимается по первому куску тела
+                start_message = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if compressor is None:
+                headers = MutableHeaders(raw=start_message["headers"])
+                if more_body:
+                    # Потоковый ответ сжимаем, если его размер неизвестен или не меньше порога
+                    declared = headers.get("content-length")
+                    small = declared is not None and int(declared) < self.minimum_size
+                else:
+                    small = len(body) < self.minimum_size
+                if small or "content-encoding" in headers or not is_compressible(headers.get("content-type", "")):
+                    passthrough = True
+                    await send(start_message)
+                    await send(message)
+                    return
+                compressor = StreamCompressor(encoding)
+                headers["Content-Encoding"] = encoding
+                headers.add_vary_header("Accept-Encoding")
+                if more_body:
+                    del headers["content-length"]
+                else:
+                    body = await compress(body) + compressor.finish()
+                    headers["Content-Length"] = str(len(body))
+                    await send(start_message)
+                    await send({"type": "http.response.body", "body": body})
+                    return
+                await send(start_message)
+
+            body = await compress(body) if body else b""
+            if not more_body:
+                body += compressor.finish()
+            if body or not more_body:
+                await send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
+
+
+class CompressedAsset:
+    """Готовый ответ в памяти: тело, заранее сжатые варианты и ETag"""
+
+    def __init__(self, body: bytes, media_type: str, cache_control: str = "no-cache"):
+        self.body = body
+        self.media_type = media_type
+        self.cache_control = cache_control
+        self.digest = hashlib.sha256(body).hexdigest()[:32]
+        self.variants = {}
+        if is_compressible(media_type) and len(body) >= COMPRESSION_MIN_BYTES:
+            for encoding in SUPPORTED_ENCODINGS:
+                if encoding == "br":
+                    data = brotli.compress(body, quality=11)
+                else:
+                    data = gzip.compress(body, compresslevel=9, mtime=0)
+                if len(data) < len(body):
+                    self.variants[encoding] = data
+
+    def etag(self, encoding: Optional[str] = None) -> str:
+        # Сжатый вариант - другое представление, у него свой ETag
+        return f'"{self.digest}-{encoding}"' if encoding else f'"{self.digest}"'
+
+    def not_modified(self, request: Request) -> bool:
+        header = request.headers.get("if-none-match")
+        if not header:
+            return False
+        tags = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+        return "*" in tags or any(self.etag(encoding) in tags for encoding in (None, *self.variants))
+
+    def response(self, request: Request) -> Response:
+        encoding = negotiate_encoding(request.headers.get("accept-encoding"), self.variants)
+        headers = {"ETag": self.etag(encoding), "Cache-Control": self.cache_control, "Vary": "Accept-Encoding"}
+        if self.not_modified(request):
+            return Response(status_code=304, headers=headers)
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        return Response(self.variants.get(encoding, self.body), media_type=self.media_type, headers=headers)
+
+
+class StaticAssetCache:
+    """Файлы static/ в памяти со сжатыми вариантами; перечитываются при изменении файла"""
+
+    def __init__(self):
+        self.items = {}
+        self._lock = threading.Lock()
+
+    def get(self, path: str, stat_result: Optional[os.stat_result] = None) -> Optional[CompressedAsset]:
+        stat_result = stat_result or os.stat(path)
+        if stat_result.st_size > STATIC_CACHE_MAX_FILE_BYTES:
+            return None
+        version = (stat_result.st_mtime_ns, stat_result.st_size)
+        with self._lock:
+            cached = self.items.get(path)
+        if cached and cached[0] == version:
+            return cached[1]
+
+        with open(path, 'rb') as f:
+            body = f.read()
+        asset = CompressedAsset(body, mimetypes.guess_type(path)[0] or "application/octet-stream")
+        with self._lock:
+            self.items[path] = (version, asset)
+        return asset
+
+    def warm(self, directory: str) -> int:
+        count = 0
+        for root, _, files in os.walk(directory):
+            for name in files:
+                if self.get(os.path.join(root, name)):
+                    count += 1
+        return count
+
+
+static_asset_cache = StaticAssetCache()
+
+
+class CachedStaticFiles(StaticFiles):
+    """StaticFiles, отдающий файлы из памяти: сжатые заранее, с ETag и 304"""
+
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200) -> Response:
+        asset = static_asset_cache.get(str(full_path), stat_result) if status_code == 200 else None
+        if asset is None:
+            return super().file_response(full_path, stat_result, scope, status_code)
+        return asset.response(Request(scope))
+
+
+def static_page_response(request: Request, path: str) -> Response:
+    """HTML-страница из static/ через кэш (вместо FileResponse)"""
+    asset = static_asset_cache.get(path)
+    if asset is None:
+        return FileResponse(path)
+    return asset.response(request)
+
+
+@app.on_event("startup")
+async def warm_static_assets():
+    """Сжимает статику заранее, чтобы первый запрос не ждал brotli"""
+    count = await asyncio.to_thread(static_asset_cache.warm, "static")
+    logger.info(f"🗜️ Статика в памяти: {count} файлов, сжатие: {', '.join(SUPPORTED_ENCODINGS)}")
+
+
+app.add_middleware(CompressionMiddleware)
+
+
+# ===== Дедлайн запроса =====
+# У каждого запроса один срок ответа: клиент может задать его заголовком
+# X-Request-Timeout (секунды), иначе REQUEST_DEADLINE_SECONDS. Стадии конвейера
+# (ingest, preprocess, вызовы Claude) берут из него оставшееся время: таймаут
+# вызова Claude не больше остатка, повтор не начинается, если не успеет
+# закончиться, а стадия после истечения срока не запускается вовсе - клиент
+# получает 504 с названием стадии вместо ответа, который уже никто не ждет.
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "150"))
+REQUEST_DEADLINE_MAX_SECONDS = float(os.getenv("REQUEST_DEADLINE_MAX_SECONDS", "300"))
+DEADLINE_HEADER = "x-request-timeout"
+
+
+class Deadline:
+    """Срок ответа на запрос"""
 
-        # Предупреждение если размер сильно увеличился
-        if size_change > 150:
-            logger.warning(
-                f"⚠️ Размер файла увеличился на {size_change-100:.1f}% из-за конвертации {image.format} → JPEG")
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.expires_at = time.monotonic() + timeout
 
-        return resized_data, output_mime
+    @classmethod
+    def from_header(cls, value: Optional[str]) -> "Deadline":
+        try:
+            timeout = float(value) if value else REQUEST_DEADLINE_SECONDS
+        except ValueError:
+            timeout = REQUEST_DEADLINE_SECONDS
+        if not timeout > 0:
+            timeout = REQUEST_DEADLINE_SECONDS
+        return cls(min(timeout, REQUEST_DEADLINE_MAX_SECONDS))
 
-    except ImportError:
-        logger.warning("⚠️ PIL не установлен, пропускаем изменение размера")
-        return image_data, "image/jpeg"
-    except Exception as e:
-        logger.error(f"❌ Ошибка изменения размера изображения: {e}")
-        return image_data, "image/jpeg"
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
 
+    def check(self, stage: str):
+        """Бросает DeadlineExceeded, если на стадию stage времени уже не осталось"""
+        if self.remaining() <= 0:
+            raise DeadlineExceeded(stage, self)
 
-def save_debug_files(files_data: List[tuple], session_id: str) -> str:
-    """Сохраняет файлы для отладки и возвращает путь к папке"""
-    try:
-        # Создаем папку для этой сессии
-        session_folder = os.path.join(STORAGE_BASE, "debug_images", session_id)
-        os.makedirs(session_folder, exist_ok=True)
+    def budget(self, stage: str, cap: float) -> float:
+        """Время на стадию: не больше cap и не больше остатка срока"""
+        self.check(stage)
+        return min(cap, self.remaining())
 
-        # Сохраняем каждый файл с индексом
-        for idx, (contents, filename) in enumerate(files_data):
-            # Всегда используем .webp расширение для единообразия
-            debug_filename = f"{idx:02d}.webp"
-            debug_path = os.path.join(session_folder, debug_filename)
 
-            with open(debug_path, 'wb') as f:
-                f.write(contents)
+class DeadlineExceeded(Exception):
+    """Срок ответа истек до или во время стадии конвейера"""
 
-            logger.info(
-                f"💾 Сохранен файл {idx}: {debug_filename} (оригинал: {filename}, {len(contents)} байт)")
+    def __init__(self, stage: str, deadline: Deadline):
+        self.stage = stage
+        self.timeout = deadline.timeout
+        super().__init__(f"Запрос не уложился в {deadline.timeout:g}с (стадия {stage})")
 
-        # Создаем файл с метаданными
-        metadata = {
-            "session_id": session_id,
-            "timestamp": datetime.now().isoformat(),
-            "total_files": len(files_data),
-            "files": [
-                {
-                    "index": idx,
-                    "original_filename": filename,
-                    "debug_filename": f"{idx:02d}.webp",
-                    "size_bytes": len(contents)
-                }
-                for idx, (contents, filename) in enumerate(files_data)
-            ]
-        }
 
-        metadata_path = os.path.join(session_folder, "metadata.json")
-        with open(metadata_path, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, ensure_ascii=False, indent=2)
+_current_deadline: contextvars.ContextVar[Optional[Deadline]] = contextvars.ContextVar(
+    "request_deadline", default=None)
+deadline_stats = {"exceeded": 0, "by_stage": {}}
 
-        logger.info(f"📋 Создан файл метаданных: {metadata_path}")
-        return session_folder
 
-    except Exception as e:
-        logger.error(f"❌ Ошибка сохранения отладочных файлов: {e}")
-        return ""
+def current_deadline() -> Deadline:
+    """Дедлайн текущего запроса; вне запроса - срок по умолчанию от текущего момента"""
+    return _current_deadline.get() or Deadline(REQUEST_DEADLINE_SECONDS)
 
 
-def analyze_image_with_claude(image_data: bytes, filename: str) -> str:
-    """Анализирует изображение с помощью Claude и возвращает описание"""
-    try:
-        logger.info(
-            f"🔍 НАЧИНАЕМ АНАЛИЗ ИЗОБРАЖЕНИЯ: {filename}, размер: {len(image_data)} байт")
-
-        # Проверяем что API ключ настроен
-        api_key = os.getenv("ANTHROPIC_API_KEY")
-        if not api_key:
-            error_msg = "❌ API ключ Anthropic не настроен в переменных окружения"
-            logger.error(error_msg)
-            return error_msg
-
-        logger.info(f"✅ API ключ найден: {api_key[:15]}...{api_key[-4:]}")
-
-        # Проверяем размер изображения
-        if len(image_data) > 20 * 1024 * 1024:  # 20MB лимит
-            error_msg = f"❌ Изображение слишком большое: {len(image_data)/1024/1024:.1f}MB (максимум 20MB)"
-            logger.error(error_msg)
-            return error_msg
-
-        # Инициализация клиента
-        logger.info("🔧 Инициализируем Anthropic клиент...")
-        client = anthropic.Anthropic(
-            api_key=api_key,
-            # Убираем проксирование для Render
-            timeout=60.0
-        )
+def deadline_payload(error: DeadlineExceeded) -> dict:
+    """Тело ответа 504 (без trace_id); заодно учитывает истечение в метриках"""
+    deadline_stats["exceeded"] += 1
+    deadline_stats["by_stage"][error.stage] = deadline_stats["by_stage"].get(error.stage, 0) + 1
+    set_span_attributes(**{"deadline.exceeded_stage": error.stage})
+    logger.warning(f"⌛ {error}")
+    return {"success": False, "error": str(error), "stage": error.stage}
 
-        # Кодируем изображение в base64
-        logger.info("🔄 Кодируем изображение в base64...")
-        image_base64 = base64.b64encode(image_data).decode('utf-8')
-        logger.info(f"✅ Base64 готов, длина: {len(image_base64)} символов")
-
-        # Определяем MIME тип
-        file_extension = filename.lower().split(
-            '.')[-1] if '.' in filename else 'jpg'
-        mime_type_map = {
-            'jpg': 'image/jpeg',
-            'jpeg': 'image/jpeg',
-            'png': 'image/png',
-            'gif': 'image/gif',
-            'webp': 'image/webp'
-        }
-        mime_type = mime_type_map.get(file_extension, 'image/jpeg')
-        logger.info(f"📎 MIME тип: {mime_type}")
-
-        logger.info("🚀 ОТПРАВЛЯЕМ ЗАПРОС В CLAUDE API...")
-
-        # Отправляем запрос к Claude
-        message = client.messages.create(
-            model="claude-sonnet-4-20250514",
-            max_tokens=2000,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "image",
-                            "source": {
-                                "type": "base64",
-                                "media_type": mime_type,
-                                "data": image_base64,
-                            },
-                        },
-                        {
-                            "type": "text",
-                            "text": """Проанализируйте это изображение товара для создания объявления о продаже. Отвечайте ТОЛЬКО на русском языке.
 
-Дайте краткую информацию:
+def deadline_exceeded_response(error: DeadlineExceeded) -> JSONResponse:
+    return JSONResponse({**deadline_payload(error), "trace_id": get_trace_id()}, status_code=504)
 
-🏷️ ТОВАР:
-- Название товара (максимум 5-7 слов)
-- Основная категория (одежда, техника, мебель, автомобиль и т.д.)
-- Подкатегория товара
-- Основной цвет товара
 
-📝 КРАТКОЕ ОПИСАНИЕ:
-- Материал и состояние (новый/б/у)
-- Бренд (если различимо)
-- 1-2 ключевые особенности
+class DeadlineMiddleware:
+    """ASGI-middleware: дедлайн запроса в контексте до всех остальных обработчиков"""
 
-Отвечайте кратко и по делу. Фокусируйтесь только на основной информации для объявления."""
-                        }
-                    ],
-                }
-            ],
-        )
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        # Срок отсчитывается с прихода заголовков: загрузка тела тоже входит в него
+        token = _current_deadline.set(
+            Deadline.from_header(Headers(scope=scope).get(DEADLINE_HEADER)))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _current_deadline.reset(token)
 
-        description = message.content[0].text
+
+# Добавлен после tracing_middleware и сжатия, поэтому оборачивает их: контекст с дедлайном
+# наследуют и задачи BaseHTTPMiddleware. Еще внешнее - добавленные позже ClientKeyMiddleware
+# и AdmissionMiddleware (они дедлайн не читают)
+app.add_middleware(DeadlineMiddleware)
+
+
+# Подключаем статические файлы
+app.mount("/static", CachedStaticFiles(directory="static"), name="static")
+
+# ===== Категории Somon.tj =====
+# Дерево категорий разбирается из somon_categories.txt один раз при старте и
+# перечитывается, только если файл изменился (проверка mtime не чаще раза в
+# TAXONOMY_CHECK_INTERVAL секунд). Из него же строятся список для промптов и
+# готовый ответ /api/categories с ETag.
+CATEGORIES_FILE = os.getenv("CATEGORIES_FILE", "somon_categories.txt")
+TAXONOMY_CHECK_INTERVAL = 2.0
+
+# Базовые категории на случай, если файл не удалось прочитать
+FALLBACK_CATEGORIES = {
+    'Одежда и личные вещи': ['Мужская одежда', 'Женская одежда', 'Обувь'],
+    'Электроника и бытовая техника': ['Телефоны и связь', 'Компьютеры и оргтехника'],
+    'Детский мир': ['Детская одежда', 'Игрушки'],
+    'Все для дома': ['Мебель', 'Бытовая техника']
+}
+
+
+def parse_categories_text(text: str) -> dict:
+    """Разбирает формат somon_categories.txt: категория, под ней строки '-- подкатегория'"""
+    categories = {}
+    current_category = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('--'):
+            # Это подкатегория
+            if current_category:
+                categories[current_category].append(line[2:].strip())
+        else:
+            # Это основная категория
+            current_category = line
+            categories.setdefault(current_category, [])
+    return categories
+
+
+# Предварительный выбор категорий: вместо всего дерева (около 100 строк) в промпт
+# попадают только несколько вероятных подкатегорий. Их подбирает локальный TF-IDF
+# классификатор по тому, что известно до запроса к Claude: описание от пользователя,
+# имена файлов, прежние названия товаров. Если подсказок нет или классификатор
+# не уверен (IMG_1234.jpg без описания), Claude получает все дерево целиком.
+CATEGORY_SHORTLIST_SIZE = int(os.getenv("CATEGORY_SHORTLIST_SIZE", "5"))
+# Ниже этой близости лучшего кандидата список считается ненадежным
+CATEGORY_SHORTLIST_MIN_SCORE = float(os.getenv("CATEGORY_SHORTLIST_MIN_SCORE", "0.2"))
+
+# Дополнительные слова для подкатегорий, о которых покупатели пишут иначе, чем называется раздел
+CATEGORY_KEYWORDS = {
+    "Мобильные телефоны": "телефон смартфон айфон iphone samsung galaxy xiaomi redmi honor huawei realme tecno infinix",
+    "Аксессуары для телефонов": "чехол зарядка зарядное кабель наушники airpods powerbank стекло",
+    "Ноутбуки": "ноутбук laptop macbook lenovo asus acer hp dell thinkpad",
+    "Персональные компьютеры": "компьютер системный блок пк процессор видеокарта",
+    "Игровые приставки": "playstation ps4 ps5 xbox nintendo джойстик геймпад приставка",
+    "Планшеты и букридеры": "планшет ipad tablet kindle электронная книга",
+    "Мониторы и проекторы": "монитор проектор экран",
+    "Принтеры и сканеры": "принтер сканер мфу картридж",
+    "TV, DVD и видео": "телевизор tv smart led lg samsung пульт",
+    "Аудио и стерео": "колонка акустика усилитель магнитола наушники jbl",
+    "Фото и видеокамеры": "фотоаппарат камера объектив canon nikon sony gopro",
+    "Техника для дома и кухни": "холодильник стиральная машина пылесос микроволновка духовка плита чайник утюг блендер мультиварка",
+    "Климатическая техника": "кондиционер обогреватель вентилятор сплит увлажнитель",
+    "Для личного ухода": "фен плойка бритва триммер эпилятор выпрямитель",
+    "Мужская одежда": "куртка рубашка брюки джинсы костюм футболка свитер пиджак мужской",
+    "Женская одежда": "платье юбка блузка кофта пальто джинсы женский",
+    "Обувь": "кроссовки ботинки туфли сапоги кеды сандалии nike adidas",
+    "Часы и украшения": "часы кольцо серьги цепочка браслет золото серебро",
+    "Чемоданы, сумки, клатчи": "сумка рюкзак чемодан клатч кошелек",
+    "Парфюмерия и косметика": "духи парфюм крем помада тушь косметика",
+    "Детская одежда": "детский комбинезон боди ползунки",
+    "Детские коляски, качели": "коляска качели люлька",
+    "Детские автокресла": "автокресло бустер",
+    "Игрушки": "игрушка кукла конструктор lego машинка",
+    "Мебель": "диван кровать шкаф стол стул кресло комод матрас",
+    "Посуда и кухонная утварь": "посуда кастрюля сковорода тарелки сервиз",
+    "Текстиль и интерьер": "ковер шторы покрывало люстра картина",
+    "Электроинструмент": "дрель перфоратор шуруповерт болгарка пила",
+    "Ручной инструмент": "молоток ключи отвертка набор инструментов",
+    "Велосипеды и принадлежности": "велосипед самокат",
+    "Спорт и инвентарь": "тренажер гантели мяч штанга беговая",
+    "Музыкальные инструменты": "гитара пианино синтезатор скрипка барабан",
+    "Книги и журналы": "книга журнал учебник",
+    "Товары для животных": "клетка аквариум переноска когтеточка",
+}
+
+# Слова из имен файлов и объявлений, которые ничего не говорят о товаре
+HINT_STOPWORDS = {"img", "dsc", "image", "photo", "фото", "pic", "screenshot", "whatsapp",
+                  "telegram", "jpg", "jpeg", "png", "webp", "heic", "copy", "scaled", "edited",
+                  "продаю", "продам", "продается", "продажа", "срочно", "цена", "торг", "новый",
+                  "новая", "новое", "состояние", "отличное", "хорошее", "почти", "сомони"}
+
+
+def hint_tokens(text: str) -> List[str]:
+    """Слова подсказки, обрезанные до основы (первые 5 букв - грубая замена стеммеру)"""
+    tokens = []
+    for word in re.findall(r"[^\W\d_]+", text.casefold().replace('ё', 'е')):
+        if len(word) < 3 or word in HINT_STOPWORDS:
+            continue
+        tokens.append(word[:5])
+    return tokens
+
+
+class CategoryClassifier:
+    """TF-IDF по подкатегориям: название категории, подкатегории и ключевые слова"""
+
+    def __init__(self, categories: dict, keywords: dict):
+        self.nodes = []
+        documents = []
+        for category, subcategories in categories.items():
+            for subcategory in subcategories:
+                self.nodes.append((category, subcategory))
+                documents.append(hint_tokens(f"{category} {subcategory} {subcategory} {keywords.get(subcategory, '')}"))
+
+        document_frequency = {}
+        for tokens in documents:
+            for token in set(tokens):
+                document_frequency[token] = document_frequency.get(token, 0) + 1
+        total = max(len(documents), 1)
+        self.idf = {token: math.log(total / count) + 1.0 for token, count in document_frequency.items()}
+
+        # Нормированные векторы документов и обратный индекс token -> [(узел, вес)]
+        self.postings = {}
+        for node_index, tokens in enumerate(documents):
+            weights = self._weights(tokens)
+            for token, weight in weights.items():
+                self.postings.setdefault(token, []).append((node_index, weight))
+
+    def _weights(self, tokens: List[str]) -> dict:
+        counts = {}
+        for token in tokens:
+            if token in self.idf:
+                counts[token] = counts.get(token, 0) + 1
+        weights = {token: (1 + math.log(count)) * self.idf[token] for token, count in counts.items()}
+        norm = math.sqrt(sum(weight * weight for weight in weights.values())) or 1.0
+        return {token: weight / norm for token, weight in weights.items()}
+
+    def shortlist(self, texts: List[str], k: int = CATEGORY_SHORTLIST_SIZE) -> List[tuple[str, str, float]]:
+        """До k подкатегорий (категория, подкатегория, косинусная близость) по текстовым подсказкам"""
+        query = self._weights(hint_tokens(" ".join(text for text in texts if text)))
+        scores = {}
+        for token, weight in query.items():
+            for node_index, node_weight in self.postings.get(token, ()):
+                scores[node_index] = scores.get(node_index, 0.0) + weight * node_weight
+        best = sorted(scores.items(), key=lambda item: -item[1])[:k]
+        # Кандидаты намного слабее лучшего только удлиняют промпт
+        cutoff = max(0.05, best[0][1] * 0.5) if best else 0.0
+        return [(*self.nodes[node_index], round(score, 3)) for node_index, score in best if score >= cutoff]
+
+
+def normalize_category_key(value: str) -> str:
+    """Ключ для сравнения названий: регистр, ё/е, знаки препинания и лишние пробелы не важны"""
+    value = value.casefold().replace('ё', 'е')
+    return " ".join(re.sub(r'[^\w]+', ' ', value).split())
+
+
+def edit_similarity(a: str, b: str) -> float:
+    """1 - расстояние Левенштейна / длина большей строки"""
+    if a == b:
+        return 1.0
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return 1.0 - previous[-1] / max(len(a), len(b))
+
+
+def category_trigrams(key: str) -> set:
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class CategoryMatcher:
+    """Индекс названий из дерева категорий: точное совпадение, без учета регистра, по триграммам"""
+
+    # Ниже этой похожести считаем, что подходящего узла в дереве нет
+    MIN_SCORE = 0.6
+
+    def __init__(self, names: List[str]):
+        self.exact = {name: name for name in names}
+        self.folded = {}
+        self.grams = {}
+        self.postings = {}
+        for name in names:
+            key = normalize_category_key(name)
+            self.folded.setdefault(key, name)
+            grams = category_trigrams(key)
+            self.grams[name] = (key, grams)
+            for gram in grams:
+                self.postings.setdefault(gram, set()).add(name)
+
+    def match(self, value: str) -> tuple[Optional[str], float, str]:
+        """Возвращает (каноническое название, уверенность 0..1, способ сопоставления)"""
+        if not value:
+            return None, 0.0, "none"
+        if value in self.exact:
+            return value, 1.0, "exact"
+        key = normalize_category_key(value)
+        if key in self.folded:
+            return self.folded[key], 0.98, "casefold"
+
+        grams = category_trigrams(key)
+        counts = {}
+        for gram in grams:
+            for name in self.postings.get(gram, ()):
+                counts[name] = counts.get(name, 0) + 1
+        best_name, best_score = None, 0.0
+        # Расстояние Левенштейна (дороже) считаем только для лучших кандидатов по триграммам
+        for name, shared in sorted(counts.items(), key=lambda item: -item[1])[:3]:
+            name_key, name_grams = self.grams[name]
+            dice = 2 * shared / (len(grams) + len(name_grams))
+            ratio = edit_similarity(key, name_key) if abs(len(key) - len(name_key)) <= 3 else 0.0
+            # Claude часто сокращает название ("Телефоны" вместо "Телефоны и связь")
+            prefix = 0.9 if len(key) >= 4 and name_key.startswith(key) else 0.0
+            score = max(dice, ratio, prefix)
+            if score > best_score:
+                best_name, best_score = name, score
+        if best_score < self.MIN_SCORE:
+            return None, 0.0, "none"
+        return best_name, round(best_score * 0.95, 3), "fuzzy"
+
+
+class Taxonomy:
+    """Дерево категорий в памяти: прямой и обратный поиск, текст для промптов, ответ API"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.mtime = None
+        self.checked_at = 0.0
+        self.categories = {}
+        self.parents = {}
+        self.api_asset = None
+        self._lock = threading.Lock()
+        self.refresh(force=True)
+
+    def refresh(self, force: bool = False) -> "Taxonomy":
+        now = time.monotonic()
+        if not force and now - self.checked_at < TAXONOMY_CHECK_INTERVAL:
+            return self
+        self.checked_at = now
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+        if not force and mtime == self.mtime:
+            return self
+
+        with self._lock:
+            if not force and mtime == self.mtime:
+                return self
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    categories = parse_categories_text(f.read())
+                if not categories:
+                    raise ValueError("файл категорий пуст")
+                logger.info(f"📂 Загружено {len(categories)} категорий из {self.path}")
+            except Exception as e:
+                logger.error(f"Ошибка загрузки категорий: {e}")
+                categories = FALLBACK_CATEGORIES
+            self._build(categories)
+            self.mtime = mtime
+        return self
+
+    def _build(self, categories: dict) -> None:
+        parents = {}
+        for category, subcategories in categories.items():
+            for subcategory in subcategories:
+                parents.setdefault(subcategory, []).append(category)
+
+        # Ответ /api/categories: готовое тело со сжатыми вариантами и ETag
+        self.api_asset = CompressedAsset(json.dumps({
+            "success": True,
+            "categories": categories,
+            "total_categories": len(categories),
+            "message": "Категории успешно загружены"
+        }, ensure_ascii=False).encode('utf-8'), "application/json")
+        self.category_matcher = CategoryMatcher(list(categories))
+        self.subcategory_matcher = CategoryMatcher(list(parents))
+        self.subcategory_matchers = {category: CategoryMatcher(subcategories)
+                                     for category, subcategories in categories.items()}
+        self.normalize_cache = {}
+        self.classifier = CategoryClassifier(categories, CATEGORY_KEYWORDS)
+        self.main_categories_text = "; ".join(categories)
+        # Присваиваем в конце: читатели всегда видят согласованное состояние
+        self.parents = parents
+        self.categories = categories
+
+    def subcategories(self, category: str) -> List[str]:
+        return self.categories.get(category, [])
+
+    def parents_of(self, subcategory: str) -> List[str]:
+        """Категории, в которых есть такая подкатегория (например, 'Другая техника' - в нескольких)"""
+        return self.parents.get(subcategory, [])
+
+    def contains(self, category: str, subcategory: Optional[str] = None) -> bool:
+        if subcategory is None:
+            return category in self.categories
+        return subcategory in self.categories.get(category, ())
+
+    def normalize(self, category: Optional[str], subcategory: Optional[str] = None) -> dict:
+        """Сопоставляет категорию и подкатегорию из ответа Claude с узлом дерева"""
+        cache_key = (category, subcategory)
+        cached = self.normalize_cache.get(cache_key)
+        if cached is None:
+            cached = self._normalize((category or "").strip(), (subcategory or "").strip())
+            if len(self.normalize_cache) >= 4096:
+                self.normalize_cache.clear()
+            self.normalize_cache[cache_key] = cached
+        return dict(cached)
+
+    def _normalize(self, category: str, subcategory: str) -> dict:
+        cat, cat_score, cat_method = self.category_matcher.match(category)
+        if not cat:
+            # Claude иногда пишет подкатегорию вместо категории ("Ноутбуки")
+            sub_as_cat, score, method = self.subcategory_matcher.match(category)
+            if sub_as_cat:
+                cat, cat_score, cat_method = self.parents_of(sub_as_cat)[0], score, method
+                subcategory = subcategory or sub_as_cat
+
+        sub, sub_score, sub_method = None, 0.0, "none"
+        if subcategory:
+            if cat:
+                sub, sub_score, sub_method = self.subcategory_matchers[cat].match(subcategory)
+            if sub_score < 0.9:
+                # Подкатегория могла оказаться не в той категории
+                other, other_score, other_method = self.subcategory_matcher.match(subcategory)
+                if other and other_score > sub_score + 0.05:
+                    parents = self.parents_of(other)
+                    if cat in parents or other_score >= 0.9 or other_score > cat_score:
+                        sub, sub_score, sub_method = other, other_score, other_method
+                        if cat not in parents:
+                            cat, cat_score, cat_method = parents[0], other_score * 0.9, "subcategory"
+            if not sub and not cat:
+                # ...или в ней написано название основной категории
+                cat, cat_score, cat_method = self.category_matcher.match(subcategory)
+
+        if not cat:
+            return {"category": category, "subcategory": subcategory,
+                    "category_confidence": 0.0, "category_match": "none"}
+
+        if not subcategory:
+            confidence, method = cat_score, cat_method
+        elif not sub:
+            # Категория найдена, подкатегорию пользователь выберет сам
+            confidence, method = cat_score * 0.5, "category_only"
+        elif sub_score < cat_score:
+            confidence, method = sub_score, sub_method
+        else:
+            confidence, method = cat_score, cat_method
+        return {"category": cat, "subcategory": sub or "",
+                "category_confidence": round(confidence, 3), "category_match": method}
+
+
+def category_prompt_section(hints: List[str]) -> str:
+    """Блок промпта с категориями: короткий список вероятных, а при слабых подсказках - все дерево"""
+    current = taxonomy.refresh()
+    shortlist = current.classifier.shortlist(hints)
+    # Список обрезан среди почти равных кандидатов - нужная подкатегория могла не попасть
+    ambiguous = len(shortlist) >= CATEGORY_SHORTLIST_SIZE and shortlist[-1][2] >= shortlist[0][2] * 0.9
+    if not shortlist or shortlist[0][2] < CATEGORY_SHORTLIST_MIN_SCORE or ambiguous:
+        set_span_attributes(**{"category.shortlist": 0})
+        logger.info("📂 Подсказок для выбора категорий мало, в промпт идет все дерево")
+        lines = ["Категории Somon.tj (категория: подкатегории):"]
+        lines.extend(f"- {category}: {'; '.join(subcategories)}"
+                     for category, subcategories in current.categories.items())
+        return "\n".join(lines)
+
+    set_span_attributes(**{"category.shortlist": len(shortlist)})
+    logger.info(
+        f"📂 Вероятные категории: {', '.join(f'{sub} ({score})' for _, sub, score in shortlist)}")
+    lines = [f"Основные категории Somon.tj: {current.main_categories_text}.",
+             "Наиболее вероятные подкатегории (выбирай из них, если товар подходит):"]
+    lines.extend(f"- {category} / {subcategory}" for category, subcategory, _ in shortlist)
+    return "\n".join(lines)
+
+
+def normalize_product_categories(product: dict) -> dict:
+    """Заменяет категорию и подкатегорию товара каноническими, сохраняя исходные значения при замене"""
+    raw_category = product.get("category") or ""
+    raw_subcategory = product.get("subcategory") or ""
+    normalized = taxonomy.refresh().normalize(raw_category, raw_subcategory)
+    product.update(normalized)
+    if normalized["category"] != raw_category or normalized["subcategory"] != raw_subcategory:
+        product["raw_category"] = raw_category
+        product["raw_subcategory"] = raw_subcategory
         logger.info(
-            f"✅ ПОЛУЧЕН ОТВЕТ ОТ CLAUDE! Длина: {len(description)} символов")
+            f"📂 Категория нормализована: '{raw_category} / {raw_subcategory}' → "
+            f"'{normalized['category']} / {normalized['subcategory']}' "
+            f"({normalized['category_match']}, {normalized['category_confidence']})")
+    return product
 
-        return description
 
-    except Exception as e:
-        error_msg = f"❌ ОШИБКА АНАЛИЗА {filename}: {str(e)}"
-        logger.error(f"{error_msg}\nПолная ошибка: {traceback.format_exc()}")
-        return error_msg
+taxonomy = Taxonomy(CATEGORIES_FILE)
 
 
-def load_categories_from_file() -> dict:
-    """Загружает категории из файла somon_categories.txt"""
-    try:
-        categories = {}
-        current_category = None
+# ===== Размер изображений =====
+# Claude всё равно работает с картинками не больше CLAUDE_MAX_IMAGE_SIZE по длинной
+# стороне, поэтому браузер уменьшает фото до этого размера ещё до загрузки
+# (параметры отдаёт /api/upload-config), а сервер лишь страхует себя.
+CLAUDE_MAX_IMAGE_SIZE = int(os.getenv("CLAUDE_MAX_IMAGE_SIZE", "2000"))
+UPLOAD_IMAGE_MIME_TYPE = "image/jpeg"
+UPLOAD_IMAGE_QUALITY = float(os.getenv("UPLOAD_IMAGE_QUALITY", "0.85"))
 
-        with open('somon_categories.txt', 'r', encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
-                if not line:
-                    continue
 
-                if line.startswith('--'):
-                    # Это подкатегория
-                    if current_category:
-                        subcategory = line[2:].strip()
-                        categories[current_category].append(subcategory)
-                else:
-                    # Это основная категория
-                    current_category = line
-                    categories[current_category] = []
+def resize_image_for_claude(image_data: bytes, max_size: int = CLAUDE_MAX_IMAGE_SIZE) -> tuple[bytes, str]:
+    """Изменяет размер изображения для соответствия ограничениям Claude API"""
+    with trace_span("resize_image", **{"image.bytes_in": len(image_data), "image.max_size": max_size}) as span:
+        try:
+            # Открываем изображение
+            image = Image.open(io.BytesIO(image_data))
 
-        logger.info(f"Загружено {len(categories)} категорий из файла")
-        return categories
+            # Получаем текущие размеры
+            width, height = image.size
+            logger.info(f"📐 Исходный размер изображения: {width}x{height}")
 
-    except Exception as e:
-        logger.error(f"Ошибка загрузки категорий: {e}")
-        # Возвращаем базовые категории как fallback
-        return {
-            'Одежда и личные вещи': ['Мужская одежда', 'Женская одежда', 'Обувь'],
-            'Электроника и бытовая техника': ['Телефоны и связь', 'Компьютеры и оргтехника'],
-            'Детский мир': ['Детская одежда', 'Игрушки'],
-            'Все для дома': ['Мебель', 'Бытовая техника']
-        }
+            # Проверяем нужно ли изменять размер
+            if width <= max_size and height <= max_size:
+                logger.info(
+                    f"✅ Размер изображения в пределах нормы ({max_size}px)")
+                # Определяем MIME тип исходного изображения
+                original_mime = "image/jpeg"
+                if image.format == 'PNG':
+                    original_mime = "image/png"
+                elif image.format == 'WEBP':
+                    original_mime = "image/webp"
+                span.set_attribute("image.bytes_out", len(image_data))
+                return image_data, original_mime
+
+            # Вычисляем новые размеры с сохранением пропорций
+            if width > height:
+                new_width = max_size
+                new_height = int((height * max_size) / width)
+            else:
+                new_height = max_size
+                new_width = int((width * max_size) / height)
+
+            logger.info(f"🔄 Изменяем размер до: {new_width}x{new_height}")
+
+            # JPEG декодируется сразу в уменьшенном масштабе (1/2, 1/4, 1/8, но не меньше
+            # целевого размера) - в памяти не держится полноразмерная картинка
+            image.draft(None, (new_width, new_height))
+
+            # Изменяем размер
+            resized_image = image.resize(
+                (new_width, new_height), Image.Resampling.LANCZOS)
+
+            # Сохраняем в байты
+            output = io.BytesIO()
+
+            # Определяем формат для сохранения с улучшенным сжатием
+            output_mime = "image/jpeg"  # По умолчанию
+            if image.format in ['JPEG', 'JPG']:
+                resized_image.save(output, format='JPEG',
+                                   quality=75, optimize=True)  # Уменьшили quality для меньшего размера
+                output_mime = "image/jpeg"
+            elif image.format == 'PNG':
+                resized_image.save(output, format='PNG', optimize=True)
+                output_mime = "image/png"
+            else:
+                # Для WebP и других форматов сохраняем как JPEG с хорошим сжатием
+                if resized_image.mode in ('RGBA', 'LA', 'P'):
+                    # Конвертируем в RGB для JPEG
+                    rgb_image = Image.new(
+                        'RGB', resized_image.size, (255, 255, 255))
+                    if resized_image.mode == 'P':
+                        resized_image = resized_image.convert('RGBA')
+                    rgb_image.paste(resized_image, mask=resized_image.split(
+                    )[-1] if resized_image.mode in ('RGBA', 'LA') else None)
+                    resized_image = rgb_image
+                resized_image.save(output, format='JPEG',
+                                   quality=75, optimize=True)  # Уменьшили quality
+                output_mime = "image/jpeg"
+
+            resized_data = output.getvalue()
+            size_change = len(resized_data)/len(image_data)*100
+            logger.info(
+                f"✅ Размер изменен: {len(image_data)} → {len(resized_data)} байт ({size_change:.1f}%)")
+            logger.info(f"📎 Формат: {image.format} → {output_mime}")
 
+            # Предупреждение если размер сильно увеличился
+            if size_change > 150:
+                logger.warning(
+                    f"⚠️ Размер файла увеличился на {size_change-100:.1f}% из-за конвертации {image.format} → JPEG")
 
-def smart_group_products(descriptions: List[dict]) -> List[dict]:
-    """Умная группировка товаров на основе их описаний"""
-    groups = []
-    used_indices = set()
+            span.set_attribute("image.bytes_out", len(resized_data))
+            return resized_data, output_mime
 
-    for i, desc1 in enumerate(descriptions):
-        if i in used_indices:
-            continue
+        except ImportError:
+            logger.warning("⚠️ PIL не установлен, пропускаем изменение размера")
+            span.set_attribute("image.bytes_out", len(image_data))
+            return image_data, "image/jpeg"
+        except Exception as e:
+            logger.error(f"❌ Ошибка изменения размера изображения: {e}")
+            span.set_attribute("image.bytes_out", len(image_data))
+            return image_data, "image/jpeg"
 
-        # Начинаем новую группу
-        group = {
-            "title": desc1.get("title", "Товар"),
-            "category": desc1.get("category", "Разное"),
-            "subcategory": desc1.get("subcategory", ""),
-            "color": desc1.get("color", ""),
-            "image_indexes": [i],
-            "descriptions": [desc1.get("description", "")]
-        }
-        used_indices.add(i)
 
-        # Ищем похожие товары
-        for j, desc2 in enumerate(descriptions):
-            if j <= i or j in used_indices:
-                continue
+# ===== Потоковый JSON с изображениями =====
+# Изображение хранится одной копией байт (уменьшенное - в кэше ImageBlockCache,
+# исходное - в file_info), а в base64 кодируется кусками прямо при записи тела
+# в сокет: и в запросе к Claude, и в ответе браузеру (data URL). Полная
+# base64-строка, её JSON-представление и байты тела в памяти не собираются.
+# Остальной JSON сериализуется через orjson, если он установлен.
+try:
+    import orjson
+except ImportError:  # необязательная зависимость - работаем на стандартном json
+    orjson = None
 
-            # Простое сравнение по названию и категории
-            if (desc1.get("title", "").lower() == desc2.get("title", "").lower() and
-                    desc1.get("category", "").lower() == desc2.get("category", "").lower()):
-                group["image_indexes"].append(j)
-                group["descriptions"].append(desc2.get("description", ""))
-                used_indices.add(j)
+JSON_PAYLOAD_CHUNK = 3 * 64 * 1024  # кратно 3: куски кодируются без '=' в середине
 
-        groups.append(group)
 
-    return groups
+def dumps_json(obj, default=None) -> bytes:
+    """JSON в UTF-8 без пробелов - как у JSONResponse, но через orjson, если он есть"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=default)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=default).encode('utf-8')
 
 
-def process_claude_results_with_filenames(products: List[dict], image_batch: List[tuple[bytes, str]], file_info: List[dict]) -> List[dict]:
-    """
-    Обрабатывает результаты Claude с использованием имен файлов вместо индексов
-    Возвращает список товаров с изображениями
-    """
-    # Создаем словарь filename -> index для обратного поиска
-    filename_to_index = {filename: i for i,
-                         (_, filename) in enumerate(image_batch)}
-    all_filenames = set(filename_to_index.keys())
+class Base64Payload:
+    """Байты изображения, которые кодируются в base64 только при отправке"""
 
-    logger.info(
-        f"🔧 Валидация имен файлов: всего файлов = {len(all_filenames)}")
-    logger.info(f"📋 Доступные файлы: {sorted(all_filenames)}")
+    __slots__ = ("data", "prefix")
 
-    # Собираем все использованные имена файлов
-    all_used_filenames = []
-    for product in products:
-        original_filenames = product.get('image_filenames', [])
-        valid_filenames = []
+    def __init__(self, data: bytes, prefix: str = ""):
+        self.data = memoryview(data)
+        # Например "data:image/jpeg;base64," для data URL в ответе браузеру
+        self.prefix = prefix.encode('ascii')
 
-        for filename in original_filenames:
-            if filename in filename_to_index:
-                valid_filenames.append(filename)
-                all_used_filenames.append(filename)
-            else:
-                logger.warning(
-                    f"⚠️ Товар {product.get('title', '?')}: неверное имя файла '{filename}'")
-                logger.warning(f"   Доступные файлы: {sorted(all_filenames)}")
+    def __len__(self) -> int:
+        # Длина в base64 - для Content-Length и трассировки
+        return len(self.prefix) + (len(self.data) + 2) // 3 * 4
 
-        product['image_filenames'] = valid_filenames
-        # Конвертируем в индексы для обратной совместимости
-        product['image_indexes'] = [filename_to_index[f]
-                                    for f in valid_filenames]
+    def chunks(self):
+        if self.prefix:
+            yield self.prefix
+        for start in range(0, len(self.data), JSON_PAYLOAD_CHUNK):
+            yield binascii.b2a_base64(self.data[start:start + JSON_PAYLOAD_CHUNK], newline=False)
 
-        if original_filenames != valid_filenames:
-            logger.info(
-                f"✅ Товар {product.get('title', '?')}: исправлены файлы {original_filenames} → {valid_filenames}")
+    def __str__(self) -> str:
+        return self.prefix.decode('ascii') + base64.b64encode(self.data).decode('ascii')
 
-    # Проверяем на пропущенные и дублированные файлы
-    used_filenames = set(all_used_filenames)
-    missing_filenames = all_filenames - used_filenames
-    duplicate_filenames = [
-        f for f in all_used_filenames if all_used_filenames.count(f) > 1]
 
-    if missing_filenames:
-        logger.warning(
-            f"⚠️ Пропущенные файлы: {sorted(missing_filenames)}")
-    if duplicate_filenames:
-        logger.warning(
-            f"⚠️ Дублированные файлы: {sorted(set(duplicate_filenames))}")
+class StreamingJsonBody:
+    """Тело JSON: структура сериализуется сразу, изображения - кусками при отправке"""
 
-    logger.info(
-        f"📊 Статистика файлов: использовано {len(used_filenames)}/{len(all_filenames)}")
+    def __init__(self, obj):
+        marker = f"@@payload-{secrets.token_hex(8)}@@"
+        self.payloads = []
 
-    # Формируем результаты по группам товаров
-    results = []
+        def default(value):
+            if isinstance(value, Base64Payload):
+                self.payloads.append(value)
+                return marker
+            raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
 
-    for product_idx, product in enumerate(products):
-        title = product.get('title', f'Товар {product_idx + 1}')
-        category = product.get('category', 'Разное')
-        subcategory = product.get('subcategory', '')
-        color = product.get('color', '')
-        image_filenames = product.get('image_filenames', [])
-        image_indexes = product.get(
-            'image_indexes', [])  # Уже валидированы выше
+        self.parts = dumps_json(obj, default=default).split(marker.encode('ascii'))
+        self.length = sum(len(part) for part in self.parts) + sum(len(payload) for payload in self.payloads)
 
-        logger.info(
-            f"🔍 Обрабатываем товар {product_idx}: '{title}' с файлами {image_filenames}")
+    def __len__(self) -> int:
+        return self.length
 
-        # Используем уже валидированные индексы без повторной проверки
-        valid_indexes = image_indexes
+    def __iter__(self):
+        # Новый проход при каждом вызове: SDK может повторить запрос
+        yield self.parts[0]
+        for payload, part in zip(self.payloads, self.parts[1:]):
+            yield from payload.chunks()
+            yield part
 
-        # Если нет валидных индексов, используем первый доступный
-        if not valid_indexes and file_info:
-            valid_indexes = [0]
-            image_filenames = [file_info[0]['filename']]
-            logger.info(
-                f"✅ Fallback: назначен файл {file_info[0]['filename']} для товара '{title}'")
+    async def stream(self):
+        for chunk in self:
+            yield chunk
 
-        # Собираем изображения для этого товара
-        product_images = []
-        actual_filenames = []
 
-        for img_idx in valid_indexes:
-            if img_idx < len(file_info):
-                info = file_info[img_idx]
-                image_base64 = base64.b64encode(
-                    info['contents']).decode('utf-8')
-                product_images.append(
-                    f"data:image/{info['filename'].split('.')[-1]};base64,{image_base64}")
-                actual_filenames.append(info['filename'])
-                logger.info(
-                    f"  ✅ Добавлено изображение: {info['filename']}")
+class StreamingJSONResponse(StreamingResponse):
+    """JSONResponse для больших ответов: изображения (Base64Payload) пишутся кусками"""
 
-        if not product_images and file_info:  # Fallback если нет изображений
-            info = file_info[0]
-            image_base64 = base64.b64encode(
-                info['contents']).decode('utf-8')
-            product_images.append(
-                f"data:image/{info['filename'].split('.')[-1]};base64,{image_base64}")
-            valid_indexes = [0]
-            actual_filenames = [info['filename']]
+    def __init__(self, content, status_code: int = 200, headers: Optional[dict] = None):
+        body = StreamingJsonBody(content)
+        super().__init__(body.stream(), status_code=status_code, headers=headers,
+                         media_type="application/json")
+        self.headers["content-length"] = str(len(body))
 
-        logger.info(
-            f"  📸 Итого изображений для '{title}': {len(product_images)} ({actual_filenames})")
 
-        # Создаем краткое описание товара
-        description_parts = [f"🏷️ {title}"]
-        if color:
-            description_parts.append(f"🎨 Цвет: {color}")
-        description_parts.append(f"📂 {category}")
-        if subcategory:
-            description_parts.append(f"📂 {subcategory}")
+def image_data_url(info: dict) -> Base64Payload:
+    """data URL исходного изображения для ответа браузеру (кодируется при отправке)"""
+    return Base64Payload(info['contents'], f"data:image/{info['filename'].split('.')[-1]};base64,")
 
-        description = "\n".join(description_parts)
 
-        results.append({
-            "id": f"product_{product_idx}_{int(time.time())}",
-            "filename": f"grouped_product_{product_idx}",
-            "width": 800,
-            "height": 600,
-            "size_bytes": sum(file_info[i]['size'] for i in valid_indexes if i < len(file_info)),
-            "images": product_images,
-            "image_preview": product_images[0] if product_images else "",
-            "description": description,
-            "title": title,
-            "category": category,
-            "subcategory": subcategory,
-            "color": color,
-            "image_indexes": valid_indexes,
-            "image_filenames": actual_filenames
-        })
+class ClaudeHttpClient(anthropic.DefaultAsyncHttpxClient):
+    """HTTP-клиент SDK Claude, который отправляет изображения без промежуточных копий"""
 
-    logger.info(f"✅ Сформировано {len(results)} товарных групп")
-    return results
+    def build_request(self, method, url, *, json=None, **kwargs):
+        if json is not None and not any(kwargs.get(name) is not None for name in ("content", "data", "files")):
+            body = StreamingJsonBody(json)
+            if body.payloads:
+                headers = httpx.Headers(kwargs.pop("headers", None))
+                headers["Content-Type"] = "application/json"
+                headers["Content-Length"] = str(len(body))
+                return super().build_request(method, url, content=body.stream(), headers=headers, **kwargs)
+        return super().build_request(method, url, json=json, **kwargs)
 
 
-def analyze_images_batch_with_claude(image_batch: List[tuple[bytes, str]]) -> str:
-    """
-    Анализирует batch изображений с Claude API для группировки товаров
-    Теперь использует имена файлов вместо индексов для большей надежности
-    """
-    try:
-        # Инициализация клиента
-        api_key = os.getenv("ANTHROPIC_API_KEY")
-        if not api_key:
-            logger.error("❌ API ключ Anthropic не настроен!")
-            raise ValueError(
-                "API ключ Anthropic не настроен в переменных окружения")
-
-        client = anthropic.Anthropic(
-            api_key=api_key,
-            timeout=120.0,  # Увеличиваем таймаут до 2 минут
-            max_retries=2   # Ограничиваем количество повторных попыток
-        )
-        logger.info(f"✅ API ключ найден: {api_key[:15]}...{api_key[-4:]}")
+# ===== Контентно-адресуемое хранилище изображений =====
+# Каждое уникальное изображение хранится один раз: blobs/ab/cd/<sha256>.<ext>.
+# Сессии, кэши и миниатюры ссылаются на изображения по хэшу.
+BLOB_DIR = os.path.join(STORAGE_BASE, "blobs")
+# Неиспользуемые blob'ы моложе этого срока не удаляются (их могут писать прямо сейчас)
+BLOB_GC_GRACE_SECONDS = int(os.getenv("BLOB_GC_GRACE_SECONDS", "3600"))
 
-        # Подготавливаем изображения для batch запроса
-        image_contents = []
-        file_list = []
+os.makedirs(BLOB_DIR, exist_ok=True)
 
-        for i, (image_data, filename) in enumerate(image_batch):
-            logger.info(f"🖼️ Обработка изображения: {filename}")
+blob_store_stats = {"stored": 0, "deduplicated": 0}
 
-            # Изменяем размер изображения для соответствия ограничениям Claude
-            resized_image_data, mime_type = resize_image_for_claude(
-                image_data, max_size=2000)
 
-            # Кодируем изображение в base64
-            base64_image = base64.b64encode(resized_image_data).decode('utf-8')
+def detect_image_type(data: bytes) -> tuple[str, str]:
+    """Определяет расширение и MIME тип по сигнатуре файла, а не по имени"""
+    header = bytes(data[:16])
+    if header.startswith(b'\xff\xd8\xff'):
+        return "jpg", "image/jpeg"
+    if header.startswith(b'\x89PNG\r\n\x1a\n'):
+        return "png", "image/png"
+    if header[:6] in (b'GIF87a', b'GIF89a'):
+        return "gif", "image/gif"
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return "webp", "image/webp"
+    if header[4:8] == b'ftyp' and header[8:12] in (b'heic', b'heix', b'mif1', b'msf1'):
+        return "heic", "image/heic"
+    if header.startswith(b'BM'):
+        return "bmp", "image/bmp"
+    return "bin", "application/octet-stream"
 
-            image_contents.append({
-                "type": "image",
-                "source": {
-                    "type": "base64",
-                    "media_type": mime_type,
-                    "data": base64_image
-                }
-            })
 
-            file_list.append(filename)
+def is_sha256(value: str) -> bool:
+    return len(value) == 64 and all(c in "0123456789abcdef" for c in value)
 
-        # НОВЫЙ ПРОМПТ: используем имена файлов вместо индексов
-        batch_prompt = f"""ГРУППИРОВКА ТОВАРОВ: Проанализируйте эти {len(image_batch)} изображений и сгруппируй ОДИНАКОВЫЕ товары.
 
-СПИСОК ФАЙЛОВ (используйте ТОЧНЫЕ имена файлов):
-{chr(10).join([f"- {filename}" for filename in file_list])}
+def blob_shard_dir(sha256: str) -> str:
+    return os.path.join(BLOB_DIR, sha256[:2], sha256[2:4])
 
-ЗАДАЧА: Найти изображения которые показывают ОДИН И ТОТ ЖЕ товар с разных ракурсов.
 
-ПРАВИЛА:
-1. Внимательно сравните каждое изображение
-2. Группируйте только ИДЕНТИЧНЫЕ предметы (одна и та же стиральная машина, один и тот же кондиционер)
-3. Разные модели/цвета/размеры = разные товары
-4. При малейшем сомнении - лучше разделить
-5. ИСПОЛЬЗУЙТЕ ТОЧНЫЕ ИМЕНА ФАЙЛОВ из списка выше
+def find_blob(sha256: str) -> Optional[str]:
+    """Путь к blob'у по хэшу (расширение заранее неизвестно)"""
+    shard = blob_shard_dir(sha256)
+    try:
+        for filename in os.listdir(shard):
+            if filename.startswith(sha256 + "."):
+                return os.path.join(shard, filename)
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def store_blob(data: bytes, sha256: Optional[str] = None) -> dict:
+    """Сохраняет изображение в хранилище, если такого еще нет, и возвращает описание blob'а"""
+    sha256 = sha256 or hashlib.sha256(data).hexdigest()
+    ext, mime_type = detect_image_type(data)
+    shard = blob_shard_dir(sha256)
+    path = os.path.join(shard, f"{sha256}.{ext}")
+
+    created = not os.path.exists(path)
+    if not created:
+        # Обновляем mtime, чтобы льготный период gc_blobs защищал переиспользованный blob
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Janitor успел удалить файл между проверкой и обновлением - пишем заново
+            created = True
+    if created:
+        os.makedirs(shard, exist_ok=True)
+        # Пишем во временный файл и атомарно переименовываем
+        tmp_path = f"{path}.{secrets.token_hex(4)}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        blob_store_stats["stored"] += 1
+    else:
+        blob_store_stats["deduplicated"] += 1
+
+    return {
+        "sha256": sha256,
+        "ext": ext,
+        "mime_type": mime_type,
+        "size": len(data),
+        "path": path,
+        "created": created
+    }
 
-Используйте категории: {SOMON_CATEGORIES}
 
-ФОРМАТ ОТВЕТА - детальный JSON с объяснениями:
-[
-  {{
-    "group_id": 1,
-    "title": "Название товара",
-    "category": "Категория",
-    "subcategory": "Подкатегория",
-    "color": "цвет",
-    "reasoning": "Почему эти изображения сгруппированы вместе",
-    "image_filenames": ["точное_имя_файла1.jpg", "точное_имя_файла2.jpg"],
-    "description": "Детальное описание товара"
-  }}
-]
+def blob_url(sha256: str) -> str:
+    return f"/blobs/{sha256}"
 
-ВАЖНО:
-- Используйте только имена файлов из списка выше
-- Каждое имя файла должно использоваться РОВНО ОДИН РАЗ
-- Объясните свои решения в поле "reasoning"!
-
-ВЕРНИТЕ ТОЛЬКО JSON БЕЗ ДОПОЛНИТЕЛЬНОГО ТЕКСТА."""
-
-        logger.info("🚀 ОТПРАВЛЯЕМ BATCH ЗАПРОС В CLAUDE API...")
-
-        # Отправляем batch запрос к Claude с параметрами как на claude.ai
-        message = client.messages.create(
-            model="claude-sonnet-4-20250514",
-            max_tokens=8192,
-            temperature=0,  # Делаем ответы более детерминированными
-            system="You are a helpful assistant that analyzes images accurately. When grouping images, be EXTREMELY careful with filenames. Use EXACT filenames from the provided list. Each filename must be used exactly once.",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        *image_contents,
-                        {
-                            "type": "text",
-                            "text": batch_prompt
-                        }
-                    ],
-                }
-            ],
-        )
 
-        response_text = message.content[0].text
-        logger.info(
-            f"✅ ПОЛУЧЕН ОТВЕТ ОТ CLAUDE! Длина: {len(response_text)} символов")
-
-        return response_text
-
-    except anthropic.APITimeoutError as e:
-        logger.error(f"❌ ТАЙМАУТ Claude API: {e}")
-        raise ValueError(f"Таймаут Claude API: {str(e)}")
-    except anthropic.RateLimitError as e:
-        logger.error(f"❌ ЛИМИТ ЗАПРОСОВ Claude API: {e}")
-        raise ValueError(f"Превышен лимит запросов Claude API: {str(e)}")
-    except anthropic.APIError as e:
-        logger.error(f"❌ ОШИБКА Claude API: {e}")
-        raise ValueError(f"Ошибка Claude API: {str(e)}")
-    except Exception as e:
-        logger.error(
-            f"❌ Неожиданная ошибка при анализе batch: {e}\n{traceback.format_exc()}")
-        raise ValueError(f"Ошибка анализа изображений: {str(e)}")
+def blob_refs_from_metadata(metadata: dict) -> dict:
+    """Хэши blob'ов, на которые ссылается сессия, с их размерами"""
+    return {entry["sha256"]: entry.get("size_bytes", 0)
+            for entry in metadata.get("files", []) if entry.get("sha256")}
 
 
-@app.get("/", response_class=HTMLResponse)
-async def root():
-    """Главная страница с React приложением"""
-    try:
-        return FileResponse('static/index.html')
-    except Exception as e:
-        logger.error(f"Ошибка загрузки главной страницы: {e}")
-        return HTMLResponse("""
-        <!DOCTYPE html>
-        <html>
-        <head><title>Ошибка</title></head>
-        <body>
-            <h1>Ошибка загрузки</h1>
-            <p>Файл index.html не найден</p>
-            <p>Убедитесь что файл static/index.html существует</p>
-        </body>
-        </html>
-        """, status_code=500)
-
-
-@app.post("/api/analyze-single")
-async def analyze_single_image(file: UploadFile = File(...)):
-    """Анализ одного изображения"""
-    try:
+def gc_blobs(referenced: set, now: float) -> tuple[int, int]:
+    """Удаляет blob'ы, на которые больше никто не ссылается"""
+    deleted, freed = 0, 0
+    for root, _, filenames in os.walk(BLOB_DIR):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            sha256 = filename.split(".")[0]
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if sha256 in referenced or now - stat.st_mtime < BLOB_GC_GRACE_SECONDS:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Уже удален (например, параллельным проходом уборщика)
+                continue
+            deleted += 1
+            freed += stat.st_size
+    if deleted:
         logger.info(
-            f"📥 Получен файл для анализа: {file.filename}, тип: {file.content_type}")
-
-        # Проверяем тип файла
-        if not file.content_type.startswith('image/'):
-            logger.warning(f"⚠️ Неверный тип файла: {file.content_type}")
-            raise HTTPException(
-                status_code=400, detail="Файл должен быть изображением")
+            f"🧹 Удалено {deleted} неиспользуемых blob'ов ({freed/1024/1024:.1f}MB)")
+    return deleted, freed
+
+
+def env_flag(name: str, default: bool) -> bool:
+    """Читает булев флаг из переменной окружения (1/true/yes/on)"""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+# ===== Отладочные файлы =====
+# DEBUG_FILES_ENABLED=false полностью отключает запись (например, в продакшене).
+# DEBUG_SAMPLE_RATE - доля сессий, которые сохраняются целиком (0.05 = 5%).
+# DEBUG_PERSIST_FAILURES - дополнительно сохранять все сессии, завершившиеся ошибкой.
+DEBUG_FILES_ENABLED = env_flag("DEBUG_FILES_ENABLED", True)
+DEBUG_SAMPLE_RATE = min(max(float(os.getenv("DEBUG_SAMPLE_RATE", "1.0")), 0.0), 1.0)
+DEBUG_PERSIST_FAILURES = env_flag("DEBUG_PERSIST_FAILURES", True)
+DEBUG_WRITER_MAX_PENDING = int(os.getenv("DEBUG_WRITER_MAX_PENDING", "32"))
+# Очередь держит байты изображений до записи: сверх этого объема сессии отбрасываются
+DEBUG_WRITER_MAX_PENDING_BYTES = int(float(os.getenv("DEBUG_WRITER_MAX_PENDING_MB", "64")) * 1024 * 1024)
+
+
+def is_debug_session_sampled(session_id: str) -> bool:
+    """Детерминированная выборка: одна и та же сессия всегда получает одно решение"""
+    bucket = int(hashlib.sha1(session_id.encode('utf-8')).hexdigest()[:8], 16)
+    return bucket / 0xFFFFFFFF < DEBUG_SAMPLE_RATE
+
+
+def should_persist_debug_files(session_id: str, failed: bool = False, force: bool = False) -> bool:
+    """Решает, нужно ли сохранять отладочные файлы сессии"""
+    if not DEBUG_FILES_ENABLED:
+        return False
+    if force:
+        # Диагностические эндпоинты сохраняют всё сразу, повторно при ошибке не пишем
+        return not failed
+    if failed:
+        # Попавшие в выборку сессии уже сохранены при первом вызове
+        return DEBUG_PERSIST_FAILURES and not is_debug_session_sampled(session_id)
+    return is_debug_session_sampled(session_id)
+
+
+class DebugFileWriter(BackgroundWriter):
+    """Фоновая очередь записи отладочных файлов - запрос не ждет диск"""
+
+    thread_name = "debug-file-writer"
+    error_message = "❌ Ошибка записи отладочных файлов"
+
+    def submit(self, files_data: List[tuple], session_id: str) -> bool:
+        # Копируем контекст, чтобы спан записи попал в трейс исходного запроса
+        nbytes = sum(len(contents) for contents, _ in files_data)
+        if self.put((contextvars.copy_context(), list(files_data), session_id), nbytes):
+            return True
+        logger.warning(
+            f"⚠️ Очередь отладочных файлов переполнена, сессия {session_id} не будет сохранена")
+        return False
 
-        # Читаем файл
-        contents = await file.read()
-        logger.info(f"📂 Размер файла: {len(contents)} байт")
+    def write_batch(self, batch: list) -> int:
+        return sum(1 for ctx, files_data, session_id in batch
+                   if ctx.run(write_debug_session, files_data, session_id))
 
-        # Временные размеры изображения (без PIL)
-        width, height = 800, 600
 
-        # Анализируем с Claude
-        description = analyze_image_with_claude(
-            contents, file.filename)
+debug_file_writer = DebugFileWriter(DEBUG_WRITER_MAX_PENDING, max_pending_bytes=DEBUG_WRITER_MAX_PENDING_BYTES)
 
-        # Кодируем изображение для возврата в браузер
-        image_base64 = base64.b64encode(contents).decode('utf-8')
 
-        return JSONResponse({
-            "success": True,
-            "result": {
-                "id": f"{file.filename}_{int(io.BytesIO(contents).tell())}",
-                "filename": file.filename,
-                "width": width,
-                "height": height,
-                "size_bytes": len(contents),
-                "image_preview": f"data:image/{file.filename.split('.')[-1]};base64,{image_base64}",
-                "description": description
-            }
-        })
+@app.on_event("shutdown")
+def flush_debug_files():
+    """Дописывает очередь отладочных файлов перед остановкой сервера"""
+    debug_file_writer.flush()
 
-    except Exception as e:
-        logger.error(
-            f"❌ Ошибка анализа одного изображения: {e}\n{traceback.format_exc()}")
-        return JSONResponse({
-            "success": False,
-            "error": str(e)
-        }, status_code=500)
 
+def save_debug_files(files_data: List[tuple], session_id: str, failed: bool = False, force: bool = False) -> str:
+    """
+    Ставит файлы сессии в очередь фоновой записи и возвращает путь к папке
+    Возвращает пустую строку, если сессия не попала в выборку или запись отключена
+    """
+    if not should_persist_debug_files(session_id, failed=failed, force=force):
+        return ""
 
-@app.post("/api/analyze-grouping")
-async def analyze_grouping_diagnostic(files: List[UploadFile] = File(...)):
-    """ДИАГНОСТИКА ГРУППИРОВКИ: показывает как Claude группирует изображения"""
-    try:
-        logger.info(f"🔍 ДИАГНОСТИКА ГРУППИРОВКИ: Получено {len(files)} файлов")
+    if not debug_file_writer.submit(files_data, session_id):
+        return ""
 
-        # Собираем все валидные изображения
-        image_batch = []
-        file_info = []
+    return os.path.join(STORAGE_BASE, "debug_images", session_id)
 
-        logger.info(f"📋 Порядок получения файлов:")
-        for i, file in enumerate(files):
-            logger.info(f"  {i}: {file.filename} ({file.content_type})")
 
-        # ИСПРАВЛЕНИЕ: НЕ сортируем файлы, сохраняем исходный порядок от пользователя
-        # Проблема была в том что сортировка ломала соответствие индексов!
-        logger.info(f"📋 Сохраняем исходный порядок файлов (БЕЗ сортировки):")
-        for i, file in enumerate(files):
-            logger.info(f"  {i}: {file.filename} ({file.content_type})")
+def write_debug_session(files_data: List[tuple], session_id: str) -> str:
+    """Сохраняет изображения сессии в хранилище blob'ов и метаданные в папку сессии"""
+    with trace_span("save_debug_files", **{
+            "session.id": session_id,
+            "image.count": len(files_data),
+            "image.bytes_total": sum(len(contents) for contents, _ in files_data)}):
+        try:
+            # Создаем папку для этой сессии
+            session_folder = os.path.join(STORAGE_BASE, "debug_images", session_id)
+            os.makedirs(session_folder, exist_ok=True)
+
+            # Изображения сохраняются один раз по хэшу, сессия хранит только ссылки
+            blobs = []
+            for idx, (contents, filename) in enumerate(files_data):
+                blob = store_blob(contents)
+                blobs.append(blob)
+                logger.info(
+                    f"💾 Файл {idx}: {filename} → blob {blob['sha256'][:12]}.{blob['ext']} "
+                    f"({'новый' if blob['created'] else 'уже в хранилище'}, {blob['size']} байт)")
 
-        for file in files:
-            if not file.content_type or not file.content_type.startswith('image/'):
-                logger.warning(
-                    f"⚠️ Пропускаем {file.filename} - неверный тип: {file.content_type}")
-                continue
+            # Создаем файл с метаданными
+            metadata = {
+                "session_id": session_id,
+                "trace_id": get_trace_id(),
+                "timestamp": datetime.now().isoformat(),
+                "total_files": len(files_data),
+                "files": [
+                    {
+                        "index": idx,
+                        "original_filename": filename,
+                        "debug_filename": f"{idx:02d}.{blob['ext']}",
+                        "sha256": blob["sha256"],
+                        "mime_type": blob["mime_type"],
+                        "blob": os.path.relpath(blob["path"], STORAGE_BASE),
+                        "size_bytes": blob["size"]
+                    }
+                    for idx, ((contents, filename), blob) in enumerate(zip(files_data, blobs))
+                ]
+            }
 
+            metadata_path = os.path.join(session_folder, "metadata.json")
+            with open(metadata_path, 'w', encoding='utf-8') as f:
+                json.dump(metadata, f, ensure_ascii=False, indent=2)
+
+            logger.info(f"📋 Создан файл метаданных: {metadata_path}")
+            return session_folder
+
+        except Exception as e:
+            logger.error(f"❌ Ошибка сохранения отладочных файлов: {e}")
+            return ""
+
+
+# ===== Хранилище отладочных файлов: срок хранения, квота и архивация =====
+# Живые сессии лежат папками в debug_images/ (метаданные со ссылками на blobs/),
+# старые сжимаются по дням в debug_images/archive/YYYY-MM-DD.zip. Фоновый уборщик
+# раз в DEBUG_JANITOR_INTERVAL секунд архивирует сессии старше DEBUG_COMPACT_AFTER_DAYS
+# дней (0 - не архивировать), удаляет всё старше DEBUG_RETENTION_DAYS и самое старое
+# сверх квоты DEBUG_MAX_MB, затем удаляет blob'ы, на которые никто не ссылается.
+DEBUG_IMAGES_DIR = os.path.join(STORAGE_BASE, "debug_images")
+DEBUG_ARCHIVE_DIR = os.path.join(DEBUG_IMAGES_DIR, "archive")
+DEBUG_RETENTION_DAYS = float(os.getenv("DEBUG_RETENTION_DAYS", "14"))
+DEBUG_MAX_BYTES = int(float(os.getenv("DEBUG_MAX_MB", "2048")) * 1024 * 1024)
+DEBUG_COMPACT_AFTER_DAYS = int(os.getenv("DEBUG_COMPACT_AFTER_DAYS", "1"))
+DEBUG_JANITOR_INTERVAL = int(os.getenv("DEBUG_JANITOR_INTERVAL", "3600"))
+
+os.makedirs(DEBUG_ARCHIVE_DIR, exist_ok=True)
+
+# Показатели хранилища на момент последнего прохода уборщика (для /api/health)
+debug_store_stats = {
+    "live_sessions": 0,
+    "live_bytes": 0,
+    "archive_files": 0,
+    "archive_bytes": 0,
+    "blob_files": 0,
+    "blob_bytes": 0,
+    "blob_gc_deleted": 0,
+    "total_bytes": 0,
+    "quota_bytes": DEBUG_MAX_BYTES,
+    "quota_used_pct": 0.0,
+    "compacted_sessions": 0,
+    "evicted_sessions": 0,
+    "evicted_archives": 0,
+    "last_run": None,
+    "last_run_ms": None
+}
+debug_janitor_lock = threading.Lock()
+
+
+def directory_size(path: str) -> int:
+    """Суммарный размер файлов в папке (рекурсивно)"""
+    total = 0
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
             try:
-                contents = await file.read()
-                if len(contents) > 20 * 1024 * 1024:  # 20MB
-                    logger.warning(
-                        f"⚠️ Пропускаем {file.filename} - слишком большой: {len(contents)/1024/1024:.1f}MB")
-                    continue
+                total += os.path.getsize(os.path.join(root, filename))
+            except OSError:
+                pass
+    return total
 
-                image_batch.append((contents, file.filename))
-                file_info.append({
-                    'filename': file.filename,
-                    'content_type': file.content_type,
-                    'size': len(contents),
-                    'contents': contents
-                })
 
-            except Exception as file_error:
-                logger.error(
-                    f"❌ Ошибка чтения файла {file.filename}: {file_error}")
+def read_session_metadata(session_folder: str) -> dict:
+    metadata_path = os.path.join(session_folder, "metadata.json")
+    try:
+        with open(metadata_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"files": []}
+
+
+def list_debug_sessions() -> List[dict]:
+    """Живые (не архивированные) сессии: id, путь, время изменения, размер и ссылки на blob'ы"""
+    sessions = []
+    with os.scandir(DEBUG_IMAGES_DIR) as entries:
+        for entry in entries:
+            if not entry.is_dir() or entry.path == DEBUG_ARCHIVE_DIR:
                 continue
-
-        if not image_batch:
-            raise HTTPException(
-                status_code=400, detail="Нет валидных изображений")
-
-        # Сохраняем отладочные файлы
-        session_id = f"diag_{int(time.time())}_{len(image_batch)}"
-        debug_folder = save_debug_files(image_batch, session_id)
-
-        logger.info(f"🔍 ДЕТАЛЬНАЯ ДИАГНОСТИКА:")
-        logger.info(f"  📁 Всего файлов получено: {len(files)}")
-        logger.info(f"  ✅ Валидных изображений: {len(image_batch)}")
-        logger.info(f"  📋 Порядок валидных файлов:")
-        for i, (_, filename) in enumerate(image_batch):
-            saved_filename = f"{i:02d}.webp"
-            logger.info(
-                f"    Индекс {i}: {saved_filename} (оригинал: {filename})")
-
-        # Подготавливаем изображения для batch запроса
-        image_contents = []
-        for i, (image_data, filename) in enumerate(image_batch):
-            logger.info(f"🖼️ Диагностика изображения {i}: {filename}")
-
-            # Изменяем размер изображения для соответствия ограничениям Claude
-            resized_image_data, mime_type = resize_image_for_claude(
-                image_data, max_size=2000)
-
-            # Кодируем изображение в base64
-            base64_image = base64.b64encode(resized_image_data).decode('utf-8')
-
-            image_contents.append({
-                "type": "image",
-                "source": {
-                    "type": "base64",
-                    "media_type": mime_type,
-                    "data": base64_image
-                }
+            sessions.append({
+                "session_id": entry.name,
+                "path": entry.path,
+                "mtime": entry.stat().st_mtime,
+                "size": directory_size(entry.path),
+                "blob_refs": blob_refs_from_metadata(read_session_metadata(entry.path))
             })
+    return sessions
 
-        # Создаем список файлов для промпта
-        file_list = [filename for _, filename in image_batch]
-
-        # Упрощенный промпт для точного анализа товаров - ТЕПЕРЬ ИСПОЛЬЗУЕТ ИМЕНА ФАЙЛОВ
-        diagnostic_prompt = f"""Проанализируй эти {len(image_batch)} изображений товаров и сгруппируй ОДИНАКОВЫЕ товары.
-
-СПИСОК ФАЙЛОВ (используйте ТОЧНЫЕ имена файлов):
-{chr(10).join([f"- {filename}" for filename in file_list])}
-
-ВАЖНО: Группируй только абсолютно идентичные товары:
-- Одинаковая модель, бренд, артикул
-- Одинаковый цвет и размер  
-- Одинаковая комплектация
-- Разные ракурсы одного товара = одна группа
-- Разные модели/цвета = разные группы
-- ИСПОЛЬЗУЙТЕ ТОЧНЫЕ ИМЕНА ФАЙЛОВ из списка выше
-
-Верни результат в JSON формате:
-[
-  {{
-    "group_id": 1,
-    "title": "Точное название товара с моделью",
-    "category": "Категория",
-    "subcategory": "Подкатегория", 
-    "color": "основной цвет",
-    "reasoning": "Почему эти фото в одной группе",
-    "image_filenames": ["точное_имя_файла1.jpg", "точное_имя_файла2.jpg"],
-    "description": "Подробное описание товара"
-  }}
-]
-
-Каждое имя файла должно использоваться только один раз."""
 
+def list_debug_archives(with_refs: bool = False) -> List[dict]:
+    """Архивы по дням: день, путь, размер и (по запросу) ссылки на blob'ы"""
+    archives = []
+    for filename in os.listdir(DEBUG_ARCHIVE_DIR):
+        if not filename.endswith(".zip"):
+            continue
+        path = os.path.join(DEBUG_ARCHIVE_DIR, filename)
         try:
-            # Инициализация клиента
-            api_key = os.getenv("ANTHROPIC_API_KEY")
-            if not api_key:
-                logger.error("❌ API ключ Anthropic не настроен!")
-                raise ValueError(
-                    "API ключ Anthropic не настроен в переменных окружения")
-
-            client = anthropic.Anthropic(
-                api_key=api_key,
-                timeout=120.0,  # Увеличиваем таймаут до 2 минут
-                max_retries=2   # Ограничиваем количество повторных попыток
-            )
-            logger.info(f"✅ API ключ найден: {api_key[:15]}...{api_key[-4:]}")
+            day = datetime.strptime(filename[:-4], "%Y-%m-%d").date()
+        except ValueError:
+            continue
+        archive = {"day": day, "path": path,
+                   "size": os.path.getsize(path), "blob_refs": {}}
+        if with_refs:
+            try:
+                with zipfile.ZipFile(path) as zf:
+                    for name in zf.namelist():
+                        if name.endswith("/metadata.json"):
+                            archive["blob_refs"].update(
+                                blob_refs_from_metadata(json.loads(zf.read(name))))
+            except (zipfile.BadZipFile, ValueError) as e:
+                logger.warning(f"⚠️ Не удалось прочитать архив {path}: {e}")
+        archives.append(archive)
+    return archives
+
+
+def compact_debug_sessions(sessions: List[dict], now: float) -> int:
+    """Переносит сессии старше DEBUG_COMPACT_AFTER_DAYS в архив своего дня"""
+    if DEBUG_COMPACT_AFTER_DAYS <= 0:
+        return 0
+
+    today = datetime.fromtimestamp(now).date()
+    by_day = {}
+    for session in sessions:
+        day = datetime.fromtimestamp(session["mtime"]).date()
+        if (today - day).days >= DEBUG_COMPACT_AFTER_DAYS:
+            by_day.setdefault(day, []).append(session)
+
+    compacted = 0
+    for day, day_sessions in sorted(by_day.items()):
+        archive_path = os.path.join(
+            DEBUG_ARCHIVE_DIR, f"{day.isoformat()}.zip")
+        try:
+            compacted += append_debug_archive(archive_path, day_sessions)
+        except zipfile.BadZipFile as e:
+            # Поврежденный архив откладываем в сторону и начинаем день заново
+            quarantine_debug_archive(archive_path, e)
+            compacted += append_debug_archive(archive_path, day_sessions)
+        logger.info(
+            f"🗜️ Архивировано {len(day_sessions)} сессий за {day.isoformat()}: {archive_path}")
+    return compacted
+
+
+def append_debug_archive(archive_path: str, day_sessions: List[dict]) -> int:
+    """Дописывает сессии в архив дня и удаляет их папки"""
+    compacted = 0
+    existing = set()
+    if os.path.exists(archive_path):
+        # В режиме 'a' zipfile молча дописывает новый архив в конец поврежденного,
+        # поэтому сначала читаем оглавление - BadZipFile уходит вызывающему
+        with zipfile.ZipFile(archive_path) as archive:
+            existing = set(archive.namelist())
+    # Изображения уже сжаты, поэтому храним без повторного сжатия
+    with zipfile.ZipFile(archive_path, 'a', compression=zipfile.ZIP_STORED) as archive:
+        for session in day_sessions:
+            for filename in sorted(os.listdir(session["path"])):
+                arcname = f"{session['session_id']}/{filename}"
+                if arcname not in existing:
+                    archive.write(os.path.join(
+                        session["path"], filename), arcname)
+            shutil.rmtree(session["path"], ignore_errors=True)
+            compacted += 1
+    return compacted
+
+
+def quarantine_debug_archive(archive_path: str, error: Exception) -> None:
+    """Переименовывает поврежденный архив в *.zip.bad - уборщик и поиск его больше не открывают"""
+    bad_path = f"{archive_path}.bad"
+    if os.path.exists(bad_path):
+        bad_path = f"{archive_path}.{int(time.time())}.bad"
+    os.replace(archive_path, bad_path)
+    logger.warning(f"⚠️ Поврежденный архив {archive_path} ({error}) перенесен в {bad_path}")
+
+
+def purge_quarantined_archives(now: float) -> int:
+    """Удаляет отложенные поврежденные архивы старше срока хранения"""
+    purged = 0
+    for filename in os.listdir(DEBUG_ARCHIVE_DIR):
+        path = os.path.join(DEBUG_ARCHIVE_DIR, filename)
+        try:
+            if filename.endswith(".bad") and now - os.path.getmtime(path) > max(DEBUG_RETENTION_DAYS, 1) * 86400:
+                os.remove(path)
+                purged += 1
+        except FileNotFoundError:
+            continue
+    return purged
 
-            logger.info("🚀 ОТПРАВЛЯЕМ ДИАГНОСТИЧЕСКИЙ ЗАПРОС В CLAUDE API...")
 
-            # Отправляем batch запрос к Claude с оптимальными параметрами для анализа товаров
-            try:
-                message = client.messages.create(
-                    model="claude-sonnet-4-20250514",  # Оставляем эту модель
-                    max_tokens=8192,
-                    temperature=0.3,  # Увеличиваем для более вдумчивого анализа
-                    system="""Ты эксперт по анализу товаров для интернет-магазина. Твоя задача:
-1. Внимательно изучить каждое изображение
-2. Сгруппировать фотографии одного и того же товара
-3. Определить точные названия, модели, цвета
-4. Создать структурированное описание для каждой группы
-5. Указать подходящие категории для сайта объявлений
+def debug_blob_refcounts(sessions: List[dict], archives: List[dict], protected: set) -> dict:
+    """Сколько отладочных сессий и архивов ссылается на каждый blob (кроме нужных загрузкам и группировкам)"""
+    counts = {}
+    for item in sessions + archives:
+        for sha256 in item["blob_refs"]:
+            if sha256 not in protected:
+                counts[sha256] = counts.get(sha256, 0) + 1
+    return counts
 
-Основные принципы:
-- Внимательно изучать детали на каждом изображении
-- Идентифицировать бренды, модели, артикулы, надписи
-- Различать цвета, размеры, варианты одного товара
-- Группировать только идентичные товары
-- Обращать внимание на упаковку, этикетки, состояние товара
 
-КРИТИЧЕСКИ ВАЖНО - ТОЧНОСТЬ ГРУППИРОВКИ:
-- Разные модели = разные группы (даже одного бренда)
-- Разные цвета = разные группы (даже одной модели)
-- Разные размеры = разные группы
-- Разные категории товаров = разные группы
-- Только абсолютно идентичные товары в одной группе
+def debug_store_bytes(sessions: List[dict], archives: List[dict], protected: set) -> int:
+    """Объем под квоту: сессии, архивы и blob'ы, на которые ссылается только отладка"""
+    blob_sizes = {}
+    for item in sessions + archives:
+        blob_sizes.update(item["blob_refs"])
+    return (sum(session["size"] for session in sessions) +
+            sum(archive["size"] for archive in archives) +
+            sum(blob_sizes[sha256] for sha256 in debug_blob_refcounts(sessions, archives, protected)))
 
-ПРИНЦИПЫ АНАЛИЗА:
-✅ Внимательно сравнивай каждую деталь
-✅ Читай надписи, бренды, модели на товарах
-✅ Различай даже похожие товары разных категорий
-✅ При сомнениях - создавай отдельные группы
-❌ НЕ объединяй похожие, но разные товары
-❌ НЕ игнорируй различия в цвете, размере, модели
 
-Анализируй изображения с максимальной точностью. Группируй только абсолютно идентичные товары.""",
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": [
-                                *image_contents,
-                                {
-                                    "type": "text",
-                                    "text": diagnostic_prompt
-                                }
-                            ],
-                        }
-                    ],
-                )
-            except anthropic.APITimeoutError as timeout_error:
-                logger.error(f"❌ ТАЙМАУТ CLAUDE API: {timeout_error}")
-                raise ValueError(
-                    f"Таймаут Claude API (попробуйте позже): {str(timeout_error)}")
-            except anthropic.RateLimitError as rate_error:
-                logger.error(
-                    f"❌ ПРЕВЫШЕН ЛИМИТ ЗАПРОСОВ CLAUDE API: {rate_error}")
-                raise ValueError(
-                    f"Превышен лимит запросов Claude API: {str(rate_error)}")
-            except anthropic.APIError as api_error:
-                logger.error(f"❌ ОШИБКА CLAUDE API: {api_error}")
-                raise ValueError(f"Ошибка Claude API: {str(api_error)}")
-            except Exception as api_error:
-                logger.error(
-                    f"❌ НЕИЗВЕСТНАЯ ОШИБКА ВЫЗОВА CLAUDE API: {api_error}")
-                raise ValueError(
-                    f"Неизвестная ошибка вызова Claude API: {str(api_error)}")
+def evict_debug_store(sessions: List[dict], archives: List[dict], protected: set, now: float) -> tuple[int, int]:
+    """Удаляет сессии и архивы старше срока хранения, затем самые старые сверх квоты.
 
-            # Проверяем что ответ содержит контент
-            if not message.content or len(message.content) == 0:
-                logger.error("❌ ПУСТОЙ CONTENT В ОТВЕТЕ CLAUDE!")
-                raise ValueError("Claude вернул пустой content")
+    В квоту входят только blob'ы отладки: изображения сессий загрузки и группировки
+    (protected) удалением отладочных файлов не освобождаются.
+    """
+    # Единый список элементов хранилища: (время, тип, элемент)
+    items = [(session["mtime"], "session", session) for session in sessions]
+    items += [(time.mktime(archive["day"].timetuple()), "archive", archive)
+              for archive in archives]
+    items.sort(key=lambda item: item[0])
+
+    refcounts = debug_blob_refcounts(sessions, archives, protected)
+    total_bytes = debug_store_bytes(sessions, archives, protected)
+    retention_cutoff = now - DEBUG_RETENTION_DAYS * 86400
+    evicted = {"session": 0, "archive": 0}
+
+    for timestamp, kind, item in items:
+        # Архив дня содержит сессии до конца этого дня
+        age_reference = timestamp + 86400 if kind == "archive" else timestamp
+        expired = DEBUG_RETENTION_DAYS > 0 and age_reference < retention_cutoff
+        over_quota = DEBUG_MAX_BYTES > 0 and total_bytes > DEBUG_MAX_BYTES
+        if not (expired or over_quota):
+            continue
 
-            response_text = message.content[0].text
-            logger.info(
-                f"✅ ПОЛУЧЕН ДИАГНОСТИЧЕСКИЙ ОТВЕТ! Длина: {len(response_text)} символов")
-            logger.info(f"🔍 ПОЛНЫЙ ОТВЕТ: {response_text}")
+        if kind == "session":
+            shutil.rmtree(item["path"], ignore_errors=True)
+        else:
+            try:
+                os.remove(item["path"])
+            except OSError as e:
+                logger.warning(f"⚠️ Не удалось удалить архив {item['path']}: {e}")
+                continue
+        total_bytes -= item["size"]
+        # blob освобождается, когда удалена последняя ссылающаяся на него отладочная запись
+        for sha256, size in item["blob_refs"].items():
+            if sha256 in refcounts:
+                refcounts[sha256] -= 1
+                if not refcounts[sha256]:
+                    del refcounts[sha256]
+                    total_bytes -= size
+        evicted[kind] += 1
+        logger.info(
+            f"🧹 Удален {'архив' if kind == 'archive' else 'сеанс'} {os.path.basename(item['path'])} "
+            f"({'срок хранения' if expired else 'квота'}, {item['size']} байт)")
+
+    return evicted["session"], evicted["archive"]
+
+
+def collect_referenced_blobs(sessions: List[dict], archives: List[dict]) -> set:
+    """Все хэши, на которые ссылаются живые и архивированные сессии"""
+    referenced = set()
+    for item in sessions + archives:
+        referenced.update(item["blob_refs"])
+    return referenced
+
+
+def run_debug_janitor() -> dict:
+    """Один проход уборщика: архивация, вытеснение и пересчет показателей"""
+    with debug_janitor_lock, trace_span("debug_janitor") as span:
+        started = time.time()
+        now = time.time()
+
+        compacted = compact_debug_sessions(list_debug_sessions(), now)
+        purge_quarantined_archives(now)
+
+        # Изображения загрузок и группировок не относятся к отладке и в квоту не входят
+        protected = upload_session_blob_refs(now) | grouping_session_blob_refs(now)
+        evicted_sessions, evicted_archives = evict_debug_store(
+            list_debug_sessions(), list_debug_archives(with_refs=True), protected, now)
+
+        # Удаляем изображения, на которые больше не ссылается ни одна сессия
+        sessions = list_debug_sessions()
+        archives = list_debug_archives(with_refs=True)
+        referenced = collect_referenced_blobs(sessions, archives) | protected
+        gc_deleted, _ = gc_blobs(referenced, now)
+        cleanup_upload_sessions(now)
+
+        live_bytes = sum(session["size"] for session in sessions)
+        archive_bytes = sum(archive["size"] for archive in archives)
+        blob_bytes = directory_size(BLOB_DIR)
+        total_bytes = debug_store_bytes(sessions, archives, protected)
+
+        debug_store_stats.update({
+            "live_sessions": len(sessions),
+            "live_bytes": live_bytes,
+            "archive_files": len(archives),
+            "archive_bytes": archive_bytes,
+            "blob_files": sum(len(files) for _, _, files in os.walk(BLOB_DIR)),
+            "blob_bytes": blob_bytes,
+            "blob_gc_deleted": debug_store_stats["blob_gc_deleted"] + gc_deleted,
+            "total_bytes": total_bytes,
+            "quota_used_pct": round(total_bytes / DEBUG_MAX_BYTES * 100, 1) if DEBUG_MAX_BYTES > 0 else 0.0,
+            "compacted_sessions": debug_store_stats["compacted_sessions"] + compacted,
+            "evicted_sessions": debug_store_stats["evicted_sessions"] + evicted_sessions,
+            "evicted_archives": debug_store_stats["evicted_archives"] + evicted_archives,
+            "last_run": datetime.now().isoformat(),
+            "last_run_ms": round((time.time() - started) * 1000, 1)
+        })
+        span.attributes.update({
+            "debug.compacted": compacted,
+            "debug.evicted_sessions": evicted_sessions,
+            "debug.evicted_archives": evicted_archives,
+            "debug.total_bytes": total_bytes
+        })
+        return dict(debug_store_stats)
 
-            # Проверяем что ответ не пустой
-            if not response_text or not response_text.strip():
-                logger.error("❌ ПУСТОЙ ОТВЕТ ОТ CLAUDE!")
-                raise ValueError("Claude вернул пустой ответ")
 
-            # Проверяем что ответ не является HTML (ошибка сети)
-            if response_text.strip().startswith('<'):
-                logger.error(
-                    "❌ ДИАГНОСТИКА: ПОЛУЧЕН HTML ВМЕСТО JSON! Возможно ошибка сети или перегрузка API")
-                logger.error(f"🔍 HTML ответ: {response_text[:500]}...")
-                raise ValueError(
-                    "Claude вернул HTML вместо JSON (ошибка сети или перегрузка API)")
-
-            # Парсим JSON ответ - ИСПРАВЛЕННАЯ ЛОГИКА ИЗВЛЕЧЕНИЯ ИЗ MARKDOWN
-            if response_text.strip().startswith('```'):
-                # Извлекаем JSON из markdown блока
-                lines = response_text.strip().split('\n')
-                json_lines = []
-                in_json = False
-                for line in lines:
-                    if line.strip() == '```json' or (line.strip() == '```' and in_json):
-                        in_json = not in_json
-                        continue
-                    if in_json:  # ИСПРАВЛЕНО: добавляем строки ТОЛЬКО когда внутри JSON блока
-                        json_lines.append(line)
-                response_text = '\n'.join(json_lines)
-                logger.info(
-                    f"🔧 Извлечен JSON из markdown блока, новая длина: {len(response_text)}")
-                # Показываем первые 200 символов
-                logger.info(f"🔧 Извлеченный JSON: {response_text[:200]}...")
-            else:
-                # Если нет markdown блоков, пытаемся найти JSON в тексте
-                # Ищем первый '[' и последний ']' для извлечения JSON массива
-                start_idx = response_text.find('[')
-                end_idx = response_text.rfind(']')
-                if start_idx != -1 and end_idx != -1 and end_idx > start_idx:
-                    response_text = response_text[start_idx:end_idx+1]
-                    logger.info(
-                        f"🔧 Извлечен JSON без markdown, длина: {len(response_text)}")
-                    logger.info(
-                        f"🔧 Извлеченный JSON: {response_text[:200]}...")
-
-            # Проверяем что после извлечения из markdown у нас есть контент
-            if not response_text.strip():
-                logger.error("❌ ПУСТОЙ JSON ПОСЛЕ ИЗВЛЕЧЕНИЯ ИЗ MARKDOWN!")
-                raise ValueError("Не удалось извлечь JSON из ответа Claude")
-
-            # ДЕТАЛЬНАЯ ДИАГНОСТИКА ПЕРЕД ПАРСИНГОМ JSON
-            logger.info(f"🔍 ДИАГНОСТИЧЕСКАЯ ФИНАЛЬНАЯ ДИАГНОСТИКА JSON:")
-            logger.info(f"  📏 Длина: {len(response_text)}")
-            logger.info(f"  🔤 Первые 10 символов: {repr(response_text[:10])}")
-            logger.info(
-                f"  🔤 Последние 10 символов: {repr(response_text[-10:])}")
-            logger.info(f"  ✂️ После strip(): {len(response_text.strip())}")
-            logger.info(
-                f"  🎯 Начинается с '[': {response_text.strip().startswith('[')}")
+async def debug_janitor_loop():
+    """Фоновая задача: периодически запускает уборщика в отдельном потоке"""
+    while True:
+        try:
+            stats = await asyncio.to_thread(run_debug_janitor)
             logger.info(
-                f"  🎯 Заканчивается на ']': {response_text.strip().endswith(']')}")
-
-            # Попытка парсинга с детальной диагностикой
+                f"🧹 Уборка debug_images: {stats['live_sessions']} сессий, {stats['archive_files']} архивов, "
+                f"{stats['total_bytes']/1024/1024:.1f}MB ({stats['quota_used_pct']}% квоты)")
+        except Exception as e:
+            logger.error(
+                f"❌ Ошибка уборки debug_images: {e}\n{traceback.format_exc()}")
+        await asyncio.sleep(DEBUG_JANITOR_INTERVAL)
+
+
+@app.on_event("startup")
+async def start_debug_janitor():
+    """Запускает фоновую уборку хранилища отладочных файлов"""
+    if DEBUG_JANITOR_INTERVAL > 0:
+        app.state.debug_janitor = asyncio.create_task(debug_janitor_loop())
+
+
+@app.on_event("shutdown")
+async def stop_debug_janitor():
+    """Останавливает фоновую уборку"""
+    task = getattr(app.state, "debug_janitor", None)
+    if task:
+        task.cancel()
+
+
+class DebugArchiveIndex:
+    """Индекс session_id -> архив дня; архив перечитывается, только если изменился с прошлого раза"""
+
+    def __init__(self):
+        self.sessions = {}
+        self.scanned = {}
+        self._lock = threading.Lock()
+
+    def find(self, session_id: str) -> Optional[str]:
+        with self._lock:
+            path = self.sessions.get(session_id)
+            if path and os.path.exists(path):
+                return path
+            self._refresh()
+            return self.sessions.get(session_id)
+
+    def _refresh(self) -> None:
+        archives = sorted(list_debug_archives(), key=lambda a: a["day"])
+        current = {archive["path"] for archive in archives}
+        # Забываем удаленные уборщиком архивы
+        for path in [path for path in self.scanned if path not in current]:
+            del self.scanned[path]
+        self.sessions = {session_id: path for session_id, path in self.sessions.items() if path in current}
+
+        for archive in archives:
+            path = archive["path"]
             try:
-                products = json.loads(response_text)
-                logger.info(
-                    f"✅ ДИАГНОСТИКА: JSON успешно распарсен! Тип: {type(products)}, длина: {len(products) if isinstance(products, list) else 'не список'}")
-            except json.JSONDecodeError as json_error:
-                logger.error(
-                    f"❌ ДИАГНОСТИКА: ОШИБКА JSON ПАРСИНГА: {json_error}")
-                logger.error(
-                    f"🔍 Позиция ошибки: строка {json_error.lineno}, колонка {json_error.colno}")
-                logger.error(
-                    f"🔍 Проблемный фрагмент: {repr(response_text[max(0, json_error.pos-20):json_error.pos+20])}")
-                raise
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+            if self.scanned.get(path) == mtime:
+                continue
+            try:
+                with zipfile.ZipFile(path) as zf:
+                    names = zf.namelist()
+            except zipfile.BadZipFile:
+                logger.warning(f"⚠️ Поврежденный архив: {path}")
+                names = []
+            self.scanned[path] = mtime
+            # Более поздний день перекрывает ранний, как при поиске с конца
+            for name in names:
+                self.sessions[name.split("/", 1)[0]] = path
+
+
+debug_archive_index = DebugArchiveIndex()
+
+
+def find_archived_session(session_id: str) -> Optional[str]:
+    """Ищет архив, в который была перенесена сессия"""
+    return debug_archive_index.find(session_id)
+
+
+# ===== Загрузка по частям =====
+# Продавцы часто грузят десятки фото через мобильный интернет: один обрыв в
+# multipart-запросе на 50 файлов означает повторную отправку всего пакета.
+# Поэтому файлы можно загружать по одному и частями в сессию загрузки:
+#   POST /api/uploads                         - объявить файлы (имя, размер, sha256)
+#   PUT  /api/uploads/{id}/files/{sha256}     - дослать часть файла с ?offset=N
+#   GET  /api/uploads/{id}                    - узнать, что уже получено (для продолжения)
+#   POST /api/uploads/{id}/analyze            - запустить анализ по сессии
+# Готовые файлы сразу попадают в blob-хранилище, уже известные хэши не загружаются повторно.
+UPLOAD_SESSIONS_DIR = os.path.join(STORAGE_BASE, "uploads", "sessions")
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(512 * 1024)))
+UPLOAD_MAX_FILE_BYTES = 20 * 1024 * 1024  # 20MB, как и в multipart-загрузке
+UPLOAD_MAX_FILES = 50
+UPLOAD_SESSION_TTL = int(os.getenv("UPLOAD_SESSION_TTL", str(24 * 3600)))
+
+os.makedirs(UPLOAD_SESSIONS_DIR, exist_ok=True)
+
+# Глобальная блокировка защищает только таблицу блокировок отдельных файлов:
+# запись, хэш и сохранение файла идут под его собственной блокировкой
+upload_sessions_lock = threading.Lock()
+upload_file_locks = {}
+
+
+@contextmanager
+def upload_file_lock(upload_id: str, sha256: str):
+    """Блокировка одного файла сессии загрузки; удаляется, когда ее никто не держит и не ждет"""
+    key = (upload_id, sha256)
+    with upload_sessions_lock:
+        lock, users = upload_file_locks.get(key, (None, 0))
+        lock = lock or threading.Lock()
+        upload_file_locks[key] = (lock, users + 1)
+    try:
+        with lock:
+            yield
+    finally:
+        with upload_sessions_lock:
+            lock, users = upload_file_locks[key]
+            if users > 1:
+                upload_file_locks[key] = (lock, users - 1)
+            else:
+                del upload_file_locks[key]
 
-            if not isinstance(products, list):
-                raise ValueError("Ответ Claude не является списком")
 
-            # Используем новую функцию для обработки результатов с именами файлов
-            results = process_claude_results_with_filenames(
-                products, image_batch, file_info)
+def is_upload_id(value: str) -> bool:
+    return bool(re.fullmatch(r"up_\d+_[0-9a-f]{8}", value))
 
-            return JSONResponse({
-                "success": True,
-                "diagnostic_mode": "grouping",
-                "total_images": len(image_batch),
-                "groups": results,
-                "raw_response": response_text,
-                "debug_folder": debug_folder,
-                "session_id": session_id,
-                "file_order": [{"index": i, "filename": filename} for i, (_, filename) in enumerate(image_batch)],
-                "image_urls": [f"/debug-files/{session_id}/{i:02d}.webp" for i, (_, filename) in enumerate(image_batch)],
-                "message": "Диагностика группировки завершена"
-            })
 
-        except (json.JSONDecodeError, ValueError) as e:
-            logger.error(f"❌ КРИТИЧЕСКАЯ ОШИБКА ПАРСИНГА JSON: {e}")
-            logger.error(f"🔍 ПОЛНЫЙ ОТВЕТ CLAUDE: {response_text}")
-            logger.error(f"🔍 ТИП ОТВЕТА: {type(response_text)}")
-            logger.error(f"🔍 ДЛИНА ОТВЕТА: {len(response_text)} символов")
-            # НЕ ИСПОЛЬЗУЕМ FALLBACK! Возвращаем ошибку как в диагностике
-            return JSONResponse({
-                "success": False,
-                "error": f"Ошибка парсинга JSON от Claude: {str(e)}",
-                "raw_response": response_text,
-                "debug_folder": debug_folder,
-                "session_id": session_id
-            }, status_code=500)
-
-        # НЕТ FALLBACK! Если дошли сюда, значит есть ошибка в логике
-        logger.error("❌ НЕДОСТИЖИМЫЙ КОД: дошли до конца функции без return")
-        return JSONResponse({
-            "success": False,
-            "error": "Внутренняя ошибка: недостижимый код выполнен"
-        }, status_code=500)
+def upload_session_path(upload_id: str) -> str:
+    return os.path.join(UPLOAD_SESSIONS_DIR, f"{upload_id}.json")
 
-    except Exception as e:
-        logger.error(f"❌ Ошибка запроса к Claude: {e}")
-        return JSONResponse({
-            "success": False,
-            "error": f"Ошибка Claude API: {str(e)}"
-        }, status_code=500)
 
-    except Exception as e:
-        logger.error(
-            f"❌ Ошибка диагностики группировки: {e}\n{traceback.format_exc()}")
-        return JSONResponse({
-            "success": False,
-            "error": f"Ошибка сервера: {str(e)}"
-        }, status_code=500)
+def upload_part_path(upload_id: str, sha256: str) -> str:
+    return os.path.join(UPLOAD_SESSIONS_DIR, upload_id, f"{sha256}.part")
 
 
-@app.post("/api/analyze-individual")
-async def analyze_individual_images(files: List[UploadFile] = File(...)):
-    """ДИАГНОСТИЧЕСКИЙ эндпоинт: анализ каждого изображения отдельно"""
+def load_upload_session(upload_id: str) -> Optional[dict]:
+    if not is_upload_id(upload_id):
+        return None
     try:
-        logger.info(
-            f"🔍 ДИАГНОСТИКА: Получено {len(files)} файлов для индивидуального анализа")
+        with open(upload_session_path(upload_id), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
 
-        # Собираем все валидные изображения
-        image_batch = []
-        file_info = []
-
-        logger.info(f"📋 Порядок получения файлов:")
-        for i, file in enumerate(files):
-            logger.info(f"  {i}: {file.filename} ({file.content_type})")
 
-        for i, file in enumerate(files):
-            logger.info(f"  {i}: {file.filename} ({file.content_type})")
+def save_upload_session(manifest: dict) -> None:
+    path = upload_session_path(manifest["upload_id"])
+    tmp_path = f"{path}.{secrets.token_hex(4)}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
 
-        for file in files:
-            if not file.content_type or not file.content_type.startswith('image/'):
-                logger.warning(
-                    f"⚠️ Пропускаем {file.filename} - неверный тип: {file.content_type}")
-                continue
 
-            try:
-                contents = await file.read()
-                if len(contents) > 20 * 1024 * 1024:  # 20MB
-                    logger.warning(
-                        f"⚠️ Пропускаем {file.filename} - слишком большой: {len(contents)/1024/1024:.1f}MB")
-                    continue
+def upload_file_status(upload_id: str, entry: dict) -> dict:
+    """Состояние файла в сессии: сколько байт получено и готов ли он"""
+    complete = find_blob(entry["sha256"]) is not None
+    received = entry["size"]
+    if not complete:
+        try:
+            received = os.path.getsize(upload_part_path(upload_id, entry["sha256"]))
+        except OSError:
+            received = 0
+    return {**entry, "received": received, "complete": complete}
+
+
+def describe_upload_session(manifest: dict) -> dict:
+    files = [upload_file_status(manifest["upload_id"], entry)
+             for entry in manifest["files"]]
+    return {
+        "upload_id": manifest["upload_id"],
+        "created": manifest["created"],
+        "chunk_size": UPLOAD_CHUNK_SIZE,
+        "files": files,
+        "complete_files": sum(1 for entry in files if entry["complete"]),
+        "total_files": len(files),
+        "ready": all(entry["complete"] for entry in files)
+    }
 
-                image_batch.append((contents, file.filename))
-                file_info.append({
-                    'filename': file.filename,
-                    'content_type': file.content_type,
-                    'size': len(contents),
-                    'contents': contents
-                })
 
-            except Exception as file_error:
-                logger.error(
-                    f"❌ Ошибка чтения файла {file.filename}: {file_error}")
-                continue
+def parse_declared_files(declared: list) -> tuple[List[dict], List[str]]:
+    """Проверяет список объявленных файлов, убирая повторы по хэшу"""
+    files, errors, seen = [], [], set()
+    for item in declared[:UPLOAD_MAX_FILES]:
+        if not isinstance(item, dict):
+            continue
+        name = str(item.get("name") or "image")
+        sha256 = str(item.get("sha256") or "").lower()
+        try:
+            size = int(item.get("size") or 0)
+        except (TypeError, ValueError):
+            size = 0
+        if not is_sha256(sha256):
+            errors.append(f"{name}: неверный sha256")
+            continue
+        if size <= 0 or size > UPLOAD_MAX_FILE_BYTES:
+            errors.append(f"{name}: недопустимый размер {size}")
+            continue
+        if sha256 in seen:
+            logger.info(f"♻️ {name}: повтор уже объявленного файла, пропускаем")
+            continue
+        seen.add(sha256)
+        files.append({"name": name, "sha256": sha256, "size": size})
+    return files, errors
+
+
+class UploadNotImage(ValueError):
+    """Собранный файл не является изображением"""
+
+
+def append_upload_chunk(upload_id: str, entry: dict, offset: int, chunk: bytes) -> dict:
+    """Дописывает часть файла; когда файл собран целиком, проверяет хэш и кладет его в blob-хранилище"""
+    with upload_file_lock(upload_id, entry["sha256"]):
+        status = upload_file_status(upload_id, entry)
+        if status["complete"]:
+            return status
+        if offset != status["received"]:
+            raise ValueError(f"offset {offset} не совпадает с полученным {status['received']}")
+        if offset + len(chunk) > entry["size"]:
+            raise ValueError("часть выходит за объявленный размер файла")
+
+        part_path = upload_part_path(upload_id, entry["sha256"])
+        os.makedirs(os.path.dirname(part_path), exist_ok=True)
+        with open(part_path, 'ab') as f:
+            f.write(chunk)
+
+        if offset + len(chunk) < entry["size"]:
+            return upload_file_status(upload_id, entry)
+
+        with open(part_path, 'rb') as f:
+            data = f.read()
+        os.remove(part_path)
+        if hashlib.sha256(data).hexdigest() != entry["sha256"]:
+            raise ValueError("sha256 собранного файла не совпадает, загрузите его заново")
+        # Тип - по сигнатуре: в хранилище попадают только изображения
+        if detect_image_type(data)[0] == "bin":
+            raise UploadNotImage(f"{entry['name']} не является изображением")
+        blob = store_blob(data, entry["sha256"])
+        logger.info(
+            f"📥 Загрузка {upload_id}: {entry['name']} собран ({len(data)/1024:.0f}KB, blob {entry['sha256'][:12]})")
+        return {**entry, "received": blob["size"], "complete": True}
 
-        if not image_batch:
-            raise HTTPException(
-                status_code=400, detail="Нет валидных изображений")
 
-        # Сохраняем отладочные файлы
-        session_id = f"{int(time.time())}_{len(image_batch)}"
-        debug_folder = save_debug_files(image_batch, session_id)
+def upload_session_blob_refs(now: float) -> set:
+    """Хэши файлов из живых сессий загрузки (их нельзя удалять сборщиком blob'ов)"""
+    referenced = set()
+    for manifest_name in os.listdir(UPLOAD_SESSIONS_DIR):
+        if not manifest_name.endswith(".json"):
+            continue
+        manifest = load_upload_session(manifest_name[:-len(".json")])
+        if manifest and now - manifest["created"] < UPLOAD_SESSION_TTL:
+            referenced.update(entry["sha256"] for entry in manifest["files"])
+    return referenced
 
-        # Создаем промпт для индивидуального анализа
-        individual_descriptions = []
 
-        for i, (image_data, filename) in enumerate(image_batch):
-            logger.info(f"🔍 Анализируем изображение {i}: {filename}")
+def cleanup_upload_sessions(now: float) -> int:
+    """Удаляет просроченные сессии загрузки вместе с недогруженными частями"""
+    removed = 0
+    for name in os.listdir(UPLOAD_SESSIONS_DIR):
+        path = os.path.join(UPLOAD_SESSIONS_DIR, name)
+        try:
+            if now - os.path.getmtime(path) < UPLOAD_SESSION_TTL:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+                removed += name.endswith(".json") and not name.endswith(".groups.json")
+        except OSError as e:
+            logger.warning(f"⚠️ Не удалось удалить сессию загрузки {name}: {e}")
+    if removed:
+        logger.info(f"🧹 Удалено {removed} просроченных сессий загрузки")
+    return removed
+
+
+# ===== Повторный анализ измененных групп =====
+# После группировки пользователь перетаскивает фото между товарами. Чтобы не
+# отправлять весь пакет заново, результат группировки сохраняется рядом с
+# сессиями загрузки ({session_id}.groups.json, ссылки на blob'ы по sha256), а
+# /api/sessions/{id}/reanalyze отправляет в Claude только измененные группы.
+# Подготовленные для Claude изображения (уменьшенные) кэшируются по хэшу.
+# Изображения и группы пишутся фоновой очередью (до GROUPING_WRITER_MAX_PENDING_MB
+# байт изображений), GROUPING_SESSIONS_ENABLED=false отключает сохранение совсем.
+GROUPING_SESSIONS_ENABLED = env_flag("GROUPING_SESSIONS_ENABLED", True)
+GROUPING_WRITER_MAX_PENDING_BYTES = int(float(os.getenv("GROUPING_WRITER_MAX_PENDING_MB", "64")) * 1024 * 1024)
+IMAGE_BLOCK_CACHE_MAX_BYTES = int(float(os.getenv("IMAGE_BLOCK_CACHE_MB", "64")) * 1024 * 1024)
+
+
+class ImageBlockCache:
+    """LRU-кэш изображений, подготовленных для Claude: sha256 -> (mime_type, уменьшенные байты)"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.size = 0
+        self.stats = {"hits": 0, "misses": 0}
+        self._lock = threading.Lock()
+
+    def get(self, sha256: str) -> Optional[tuple[str, bytes]]:
+        with self._lock:
+            item = self.items.get(sha256)
+            if item is None:
+                self.stats["misses"] += 1
+                return None
+            self.items.move_to_end(sha256)
+            self.stats["hits"] += 1
+            return item
+
+    def put(self, sha256: str, mime_type: str, data: bytes) -> None:
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            if sha256 in self.items:
+                return
+            self.items[sha256] = (mime_type, data)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self.items.popitem(last=False)
+                self.size -= len(evicted)
+
+
+image_block_cache = ImageBlockCache(IMAGE_BLOCK_CACHE_MAX_BYTES)
+
+
+def prepare_image_block(image_data: bytes, sha256: Optional[str] = None) -> dict:
+    """Изображение в формате блока сообщения Claude (уменьшенное), с кэшем по хэшу.
+    В base64 оно кодируется только при отправке - см. Base64Payload"""
+    sha256 = sha256 or hashlib.sha256(image_data).hexdigest()
+    cached = image_block_cache.get(sha256)
+    if cached is None:
+        resized_image_data, mime_type = resize_image_for_claude(
+            image_data, max_size=CLAUDE_MAX_IMAGE_SIZE)
+        cached = (mime_type, resized_image_data)
+        image_block_cache.put(sha256, *cached)
+    mime_type, data = cached
+    return {
+        "type": "image",
+        "source": {
+            "type": "base64",
+            "media_type": mime_type,
+            "data": Base64Payload(data)
+        }
+    }
 
-            # Изменяем размер изображения для соответствия ограничениям Claude
-            resized_image_data, mime_type = resize_image_for_claude(
-                image_data, max_size=2000)
 
-            # Кодируем изображение в base64
-            image_base64 = base64.b64encode(resized_image_data).decode('utf-8')
+def extract_json_from_response(response_text: str) -> str:
+    """Достает JSON из ответа Claude: из блока ```json или по первой/последней скобке"""
+    text = response_text.strip()
+    match = re.search(r"```(?:json)?\s*\n(.*?)\n\s*```", text, re.S)
+    if match:
+        return match.group(1).strip()
+    start = min((i for i in (text.find('['), text.find('{')) if i != -1), default=-1)
+    end = max(text.rfind(']'), text.rfind('}'))
+    if start != -1 and end > start:
+        return text[start:end + 1]
+    return text
 
-            # Простой промпт для описания одного изображения
-            simple_prompt = f"""Опишите что изображено на этой фотографии одним предложением.
 
-Формат ответа:
-"Индекс {i}: [Название товара] - [краткое описание]"
+def is_grouping_session_id(value: str) -> bool:
+    return bool(re.fullmatch(r"[A-Za-z0-9_]{1,64}", value))
 
-Например: "Индекс 0: Стиральная машина LG - белая стиральная машина с фронтальной загрузкой"
 
-ВЕРНИТЕ ТОЛЬКО ОДНО ПРЕДЛОЖЕНИЕ."""
+def grouping_session_path(session_id: str) -> str:
+    return os.path.join(UPLOAD_SESSIONS_DIR, f"{session_id}.groups.json")
 
-            try:
-                # Инициализация клиента
-                api_key = os.getenv("ANTHROPIC_API_KEY")
-                client = anthropic.Anthropic(api_key=api_key, timeout=60.0)
-
-                # Отправляем запрос к Claude
-                message = client.messages.create(
-                    model="claude-sonnet-4-20250514",
-                    max_tokens=200,
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": [
-                                {
-                                    "type": "image",
-                                    "source": {
-                                        "type": "base64",
-                                        "media_type": mime_type,
-                                        "data": image_base64,
-                                    },
-                                },
-                                {
-                                    "type": "text",
-                                    "text": simple_prompt
-                                }
-                            ],
-                        }
-                    ],
-                )
-
-                description = message.content[0].text.strip()
-                individual_descriptions.append({
-                    "index": i,
-                    "filename": filename,
-                    "description": description
-                })
 
-                logger.info(f"✅ Индекс {i}: {description}")
+def load_grouping_session(session_id: str) -> Optional[dict]:
+    if not is_grouping_session_id(session_id):
+        return None
+    try:
+        with open(grouping_session_path(session_id), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_grouping_session(record: dict) -> None:
+    record["updated"] = time.time()
+    path = grouping_session_path(record["session_id"])
+    tmp_path = f"{path}.{secrets.token_hex(4)}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(record, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def group_record(result: dict) -> dict:
+    """Группа в том виде, в котором она хранится для повторного анализа"""
+    return {
+        "id": result["id"],
+        "title": result.get("title", ""),
+        "category": result.get("category", ""),
+        "subcategory": result.get("subcategory", ""),
+        "color": result.get("color", ""),
+        "image_hashes": result.get("image_hashes", [])
+    }
 
-            except Exception as e:
-                error_desc = f"Ошибка анализа: {str(e)}"
-                individual_descriptions.append({
-                    "index": i,
-                    "filename": filename,
-                    "description": error_desc
-                })
-                logger.error(f"❌ Ошибка анализа изображения {i}: {e}")
 
-        return JSONResponse({
-            "success": True,
-            "diagnostic_mode": True,
-            "total_images": len(image_batch),
-            "descriptions": individual_descriptions,
-            "debug_folder": debug_folder,
+def store_grouping_session(session_id: str, file_info: List[dict], groups: List[dict]) -> None:
+    """Сохраняет изображения в blob-хранилище и группы (см. group_record) - для последующих правок"""
+    with trace_span("store_grouping_session", **{"session.id": session_id, "group.count": len(groups)}):
+        for info in file_info:
+            store_blob(info['contents'], info['sha256'])
+        save_grouping_session({
             "session_id": session_id,
-            "image_urls": [f"/debug-files/{session_id}/{i:02d}.webp" for i, (_, filename) in enumerate(image_batch)],
-            "message": "Диагностический анализ завершен - каждое изображение описано отдельно"
+            "created": time.time(),
+            "images": {info['sha256']: info['filename'] for info in file_info},
+            "groups": groups
         })
 
-    except Exception as e:
-        logger.error(
-            f"❌ Ошибка диагностического анализа: {e}\n{traceback.format_exc()}")
-        return JSONResponse({
-            "success": False,
-            "error": f"Ошибка сервера: {str(e)}"
-        }, status_code=500)
 
+class GroupingSessionWriter(BackgroundWriter):
+    """Фоновая запись сохраненных группировок - ответ группировки не ждет диск"""
 
-@app.post("/api/analyze-multiple")
-async def analyze_multiple_images(files: List[UploadFile] = File(...)):
-    """Основная функция группировки товаров - использует проверенную логику диагностики"""
-    try:
-        logger.info(f"🔍 ОСНОВНАЯ ГРУППИРОВКА: Получено {len(files)} файлов")
+    thread_name = "grouping-session-writer"
 
-        # Собираем все валидные изображения
-        image_batch = []
-        file_info = []
+    def submit(self, session_id: str, file_info: List[dict], results: List[dict]) -> bool:
+        if not GROUPING_SESSIONS_ENABLED:
+            return False
+        # Копируем контекст, чтобы спан записи попал в трейс исходного запроса
+        job = (contextvars.copy_context(), session_id, list(file_info), [group_record(result) for result in results])
+        if self.put(job, sum(len(info['contents']) for info in file_info)):
+            return True
+        logger.warning(f"⚠️ Очередь сохранения групп переполнена, сессия {session_id} не будет сохранена")
+        return False
 
-        logger.info(f"📋 Порядок получения файлов:")
-        for i, file in enumerate(files):
-            logger.info(f"  {i}: {file.filename} ({file.content_type})")
+    def write_batch(self, batch: list) -> int:
+        written = 0
+        for ctx, session_id, file_info, groups in batch:
+            try:
+                ctx.run(store_grouping_session, session_id, file_info, groups)
+                written += 1
+            except Exception as store_error:
+                logger.warning(f"⚠️ Не удалось сохранить группы сессии {session_id}: {store_error}")
+        return written
 
-        # НЕ сортируем файлы, сохраняем исходный порядок от пользователя
-        logger.info(f"📋 Сохраняем исходный порядок файлов (БЕЗ сортировки):")
-        for i, file in enumerate(files):
-            logger.info(f"  {i}: {file.filename} ({file.content_type})")
 
-        for file in files:
-            if not file.content_type or not file.content_type.startswith('image/'):
-                logger.warning(
-                    f"⚠️ Пропускаем {file.filename} - неверный тип: {file.content_type}")
-                continue
+grouping_session_writer = GroupingSessionWriter(
+    DEBUG_WRITER_MAX_PENDING, max_pending_bytes=GROUPING_WRITER_MAX_PENDING_BYTES)
 
-            try:
-                contents = await file.read()
-                if len(contents) > 20 * 1024 * 1024:  # 20MB
-                    logger.warning(
-                        f"⚠️ Пропускаем {file.filename} - слишком большой: {len(contents)/1024/1024:.1f}MB")
-                    continue
 
-                image_batch.append((contents, file.filename))
-                file_info.append({
-                    'filename': file.filename,
-                    'content_type': file.content_type,
-                    'size': len(contents),
-                    'contents': contents
-                })
+@app.on_event("shutdown")
+def flush_grouping_sessions():
+    """Дописывает очередь сохраненных группировок перед остановкой сервера"""
+    grouping_session_writer.flush()
 
-            except Exception as file_error:
-                logger.error(
-                    f"❌ Ошибка чтения файла {file.filename}: {file_error}")
-                continue
 
-        if not image_batch:
-            raise HTTPException(
-                status_code=400, detail="Нет валидных изображений")
+def grouping_session_blob_refs(now: float) -> set:
+    """Хэши изображений из сохраненных группировок, которые еще можно править"""
+    referenced = set()
+    for name in os.listdir(UPLOAD_SESSIONS_DIR):
+        if not name.endswith(".groups.json"):
+            continue
+        record = load_grouping_session(name[:-len(".groups.json")])
+        if record and now - record.get("updated", record["created"]) < UPLOAD_SESSION_TTL:
+            referenced.update(record["images"])
+    return referenced
+
+
+async def create_claude_message(client: anthropic.AsyncAnthropic, **kwargs):
+    """Вызов Claude API внутри спана трассировки: размеры запроса и расход токенов"""
+    content = kwargs["messages"][0]["content"]
+    image_blocks = [block for block in content if block.get("type") == "image"] if isinstance(content, list) else []
+    with trace_span("claude.messages.create", **{
+        "claude.model": kwargs.get("model"),
+        "claude.max_tokens": kwargs.get("max_tokens"),
+        "image.count": len(image_blocks),
+        "image.base64_bytes": sum(len(block["source"]["data"]) for block in image_blocks)
+    }) as span:
+        message = await client.messages.create(**kwargs)
+        usage = getattr(message, "usage", None)
+        if usage:
+            span.set_attribute("claude.input_tokens", usage.input_tokens)
+            span.set_attribute("claude.output_tokens", usage.output_tokens)
+        return message
 
-        # Сохраняем отладочные файлы
-        session_id = f"main_{int(time.time())}_{len(image_batch)}"
-        debug_folder = save_debug_files(image_batch, session_id)
 
-        logger.info(f"🔍 ДЕТАЛЬНАЯ ДИАГНОСТИКА:")
-        logger.info(f"  📁 Всего файлов получено: {len(files)}")
-        logger.info(f"  ✅ Валидных изображений: {len(image_batch)}")
-        logger.info(f"  📋 Порядок валидных файлов:")
-        for i, (_, filename) in enumerate(image_batch):
-            saved_filename = f"{i:02d}.webp"
-            logger.info(
-                f"    Индекс {i}: {saved_filename} (оригинал: {filename})")
-
-        # Подготавливаем изображения для batch запроса
-        image_contents = []
-        for i, (image_data, filename) in enumerate(image_batch):
-            logger.info(f"🖼️ Обработка изображения {i}: {filename}")
-
-            # Изменяем размер изображения для соответствия ограничениям Claude
-            resized_image_data, mime_type = resize_image_for_claude(
-                image_data, max_size=2000)
-
-            # Кодируем изображение в base64
-            base64_image = base64.b64encode(resized_image_data).decode('utf-8')
-
-            image_contents.append({
-                "type": "image",
-                "source": {
-                    "type": "base64",
-                    "media_type": mime_type,
-                    "data": base64_image
-                }
-            })
+def smart_group_products(descriptions: List[dict]) -> List[dict]:
+    """Умная группировка товаров на основе их описаний"""
+    groups = []
+    used_indices = set()
+
+    for i, desc1 in enumerate(descriptions):
+        if i in used_indices:
+            continue
+
+        # Начинаем новую группу
+        group = {
+            "title": desc1.get("title", "Товар"),
+            "category": desc1.get("category", "Разное"),
+            "subcategory": desc1.get("subcategory", ""),
+            "color": desc1.get("color", ""),
+            "image_indexes": [i],
+            "descriptions": [desc1.get("description", "")]
+        }
+        used_indices.add(i)
+
+        # Ищем похожие товары
+        for j, desc2 in enumerate(descriptions):
+            if j <= i or j in used_indices:
+                continue
+
+            # Простое сравнение по названию и категории
+            if (desc1.get("title", "").lower() == desc2.get("title", "").lower() and
+                    desc1.get("category", "").lower() == desc2.get("category", "").lower()):
+                group["image_indexes"].append(j)
+                group["descriptions"].append(desc2.get("description", ""))
+                used_indices.add(j)
+
+        groups.append(group)
+
+    return groups
+
+
+def process_claude_results_with_filenames(products: List[dict], image_batch: List[tuple[bytes, str]], file_info: List[dict]) -> List[dict]:
+    """
+    Обрабатывает результаты Claude с использованием имен файлов вместо индексов
+    Возвращает список товаров с изображениями
+    """
+    # Создаем словарь filename -> index для обратного поиска
+    filename_to_index = {filename: i for i,
+                         (_, filename) in enumerate(image_batch)}
+    all_filenames = set(filename_to_index.keys())
+
+    logger.info(
+        f"🔧 Валидация имен файлов: всего файлов = {len(all_filenames)}")
+    logger.info(f"📋 Доступные файлы: {sorted(all_filenames)}")
+
+    # Собираем все использованные имена файлов
+    all_used_filenames = []
+    for product in products:
+        original_filenames = product.get('image_filenames')
+        if original_filenames is None:
+            # Ответ с номерами фото вместо имен файлов (старый формат промпта)
+            original_filenames = [image_batch[i][1] for i in product.get('image_indexes') or []
+                                  if isinstance(i, int) and 0 <= i < len(image_batch)]
+        valid_filenames = []
+
+        for filename in original_filenames:
+            if filename in filename_to_index:
+                valid_filenames.append(filename)
+                all_used_filenames.append(filename)
+            else:
+                logger.warning(
+                    f"⚠️ Товар {product.get('title', '?')}: неверное имя файла '{filename}'")
+                logger.warning(f"   Доступные файлы: {sorted(all_filenames)}")
+
+        product['image_filenames'] = valid_filenames
+        # Конвертируем в индексы для обратной совместимости
+        product['image_indexes'] = [filename_to_index[f]
+                                    for f in valid_filenames]
+
+        if original_filenames != valid_filenames:
+            logger.info(
+                f"✅ Товар {product.get('title', '?')}: исправлены файлы {original_filenames} → {valid_filenames}")
+
+    # Проверяем на пропущенные и дублированные файлы
+    used_filenames = set(all_used_filenames)
+    missing_filenames = all_filenames - used_filenames
+    duplicate_filenames = [
+        f for f in all_used_filenames if all_used_filenames.count(f) > 1]
+
+    if missing_filenames:
+        logger.warning(
+            f"⚠️ Пропущенные файлы: {sorted(missing_filenames)}")
+    if duplicate_filenames:
+        logger.warning(
+            f"⚠️ Дублированные файлы: {sorted(set(duplicate_filenames))}")
+
+    logger.info(
+        f"📊 Статистика файлов: использовано {len(used_filenames)}/{len(all_filenames)}")
+
+    # Формируем результаты по группам товаров
+    results = []
+
+    for product_idx, product in enumerate(products):
+        title = product.get('title', f'Товар {product_idx + 1}')
+        # Приводим категорию к узлу дерева Somon.tj (опечатки, выдуманные категории)
+        normalize_product_categories(product)
+        category = product.get('category') or 'Разное'
+        subcategory = product.get('subcategory', '')
+        color = product.get('color', '')
+        image_filenames = product.get('image_filenames', [])
+        image_indexes = product.get(
+            'image_indexes', [])  # Уже валидированы выше
+
+        logger.info(
+            f"🔍 Обрабатываем товар {product_idx}: '{title}' с файлами {image_filenames}")
+
+        # Используем уже валидированные индексы без повторной проверки
+        valid_indexes = image_indexes
+
+        # Если нет валидных индексов, используем первый доступный
+        if not valid_indexes and file_info:
+            valid_indexes = [0]
+            image_filenames = [file_info[0]['filename']]
+            logger.info(
+                f"✅ Fallback: назначен файл {file_info[0]['filename']} для товара '{title}'")
+
+        # Собираем изображения для этого товара
+        product_images = []
+        actual_filenames = []
+
+        for img_idx in valid_indexes:
+            if img_idx < len(file_info):
+                info = file_info[img_idx]
+                product_images.append(image_data_url(info))
+                actual_filenames.append(info['filename'])
+                logger.info(
+                    f"  ✅ Добавлено изображение: {info['filename']}")
+
+        if not product_images and file_info:  # Fallback если нет изображений
+            info = file_info[0]
+            product_images.append(image_data_url(info))
+            valid_indexes = [0]
+            actual_filenames = [info['filename']]
+
+        logger.info(
+            f"  📸 Итого изображений для '{title}': {len(product_images)} ({actual_filenames})")
+
+        # Создаем краткое описание товара
+        description_parts = [f"🏷️ {title}"]
+        if color:
+            description_parts.append(f"🎨 Цвет: {color}")
+        description_parts.append(f"📂 {category}")
+        if subcategory:
+            description_parts.append(f"📂 {subcategory}")
+
+        description = "\n".join(description_parts)
+
+        results.append({
+            "id": f"product_{product_idx}_{int(time.time())}",
+            "filename": f"grouped_product_{product_idx}",
+            "width": 800,
+            "height": 600,
+            "size_bytes": sum(file_info[i]['size'] for i in valid_indexes if i < len(file_info)),
+            "images": product_images,
+            "image_preview": product_images[0] if product_images else "",
+            "description": description,
+            "title": title,
+            "category": category,
+            "subcategory": subcategory,
+            "category_confidence": product["category_confidence"],
+            "category_match": product["category_match"],
+            "color": color,
+            "image_indexes": valid_indexes,
+            "image_filenames": actual_filenames,
+            "image_hashes": [file_info[i]['sha256'] for i in valid_indexes if i < len(file_info) and 'sha256' in file_info[i]]
+        })
+
+    logger.info(f"✅ Сформировано {len(results)} товарных групп")
+    return results
+
+
+# ===== Журнал расхода Claude =====
+# Каждый вызов Claude - строка в SQLite (USAGE_DB_PATH): эндпоинт, сессия, число
+# изображений, токены (входные, выходные, из кэша), время с учетом очереди и
+# повторов, число повторов, итог и оценка стоимости. По журналу видно, какие
+# эндпоинты и размеры пакетов дороги или медленны в пересчете на фото
+# (/api/usage). Запись идет фоновым потоком пачками - вызов не ждет диск.
+USAGE_DB_PATH = os.getenv("USAGE_DB_PATH", os.path.join(STORAGE_BASE, "usage.sqlite3"))
+# Цены CLAUDE_MODEL, USD за миллион токенов
+CLAUDE_PRICES_PER_MTOK = {"input": 3.0, "output": 15.0, "cache_write": 3.75, "cache_read": 0.30}
+USAGE_REPORT_MAX_DAYS = 90
+
+USAGE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS claude_calls (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    day TEXT NOT NULL,
+    endpoint TEXT NOT NULL,
+    session_id TEXT,
+    trace_id TEXT,
+    model TEXT,
+    api_key TEXT,
+    image_count INTEGER NOT NULL,
+    input_tokens INTEGER NOT NULL,
+    output_tokens INTEGER NOT NULL,
+    cache_read_tokens INTEGER NOT NULL,
+    cache_creation_tokens INTEGER NOT NULL,
+    latency_ms INTEGER NOT NULL,
+    retries INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    cost_usd REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS claude_calls_day_endpoint ON claude_calls (day, endpoint);
+"""
+USAGE_COLUMNS = ("ts", "day", "endpoint", "session_id", "trace_id", "model", "api_key", "image_count",
+                 "input_tokens", "output_tokens", "cache_read_tokens", "cache_creation_tokens",
+                 "latency_ms", "retries", "status", "cost_usd")
+
+# Сессия анализа для строк журнала (ставят execute_analysis и повторный анализ)
+_current_session_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "usage_session_id", default=None)
+
+
+def open_usage_db() -> sqlite3.Connection:
+    connection = sqlite3.connect(USAGE_DB_PATH, timeout=10)
+    # WAL: отчет читает, пока фоновый поток пишет
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.executescript(USAGE_SCHEMA)
+    return connection
+
+
+def claude_call_cost(input_tokens: int, output_tokens: int, cache_read: int, cache_creation: int) -> float:
+    prices = CLAUDE_PRICES_PER_MTOK
+    return (input_tokens * prices["input"] + output_tokens * prices["output"]
+            + cache_read * prices["cache_read"] + cache_creation * prices["cache_write"]) / 1_000_000
+
+
+class UsageLedger(BackgroundWriter):
+    """Фоновая запись строк журнала расхода Claude в SQLite"""
+
+    thread_name = "usage-ledger"
+    error_message = "❌ Ошибка записи журнала расхода Claude"
+
+    def __init__(self, max_pending: int = 10000):
+        super().__init__(max_pending)
+        self._connection = None
+
+    def record(self, endpoint: str, kwargs: dict, message, status: str, retries: int,
+               seconds: float, api_key: Optional[str]):
+        """Строка журнала по итогу вызова (message - ответ Claude или None при ошибке)"""
+        content = kwargs["messages"][0]["content"]
+        usage = getattr(message, "usage", None)
+        tokens = [getattr(usage, field, None) or 0 for field in (
+            "input_tokens", "output_tokens", "cache_read_input_tokens", "cache_creation_input_tokens")]
+        now = time.time()
+        self.put((now, time.strftime("%Y-%m-%d", time.gmtime(now)), endpoint, _current_session_id.get(),
+                  get_trace_id(), kwargs.get("model"), api_key,
+                  sum(1 for block in content if block.get("type") == "image"),
+                  *tokens, int(seconds * 1000), retries, status, claude_call_cost(*tokens)))
+
+    def write_batch(self, batch: list) -> int:
+        try:
+            self._connection = self._connection or open_usage_db()
+            with self._connection:
+                self._connection.executemany(
+                    f"INSERT INTO claude_calls ({', '.join(USAGE_COLUMNS)}) "
+                    f"VALUES ({', '.join('?' * len(USAGE_COLUMNS))})", batch)
+        except sqlite3.Error:
+            # Следующая пачка откроет соединение заново
+            self._connection = None
+            raise
+        return len(batch)
+
+
+usage_ledger = UsageLedger()
+
+
+@app.on_event("shutdown")
+def flush_usage_ledger():
+    """Дописывает журнал расхода Claude перед остановкой сервера"""
+    usage_ledger.flush()
+
+
+def usage_report(days: int, endpoint: Optional[str] = None) -> dict:
+    """Расход Claude по дням (UTC) и эндпоинтам за последние days дней"""
+    since = time.strftime("%Y-%m-%d", time.gmtime(time.time() - (days - 1) * 86400))
+    where, params = "day >= ?", [since]
+    if endpoint:
+        where, params = where + " AND endpoint = ?", params + [endpoint]
+    connection = open_usage_db()
+    try:
+        connection.row_factory = sqlite3.Row
+        rows = connection.execute(f"""
+            SELECT day, endpoint,
+                   COUNT(*) AS calls,
+                   SUM(status != 'ok') AS failed_calls,
+                   COUNT(DISTINCT session_id) AS sessions,
+                   SUM(image_count) AS images,
+                   SUM(input_tokens) AS input_tokens,
+                   SUM(output_tokens) AS output_tokens,
+                   SUM(cache_read_tokens) AS cache_read_tokens,
+                   SUM(cache_creation_tokens) AS cache_creation_tokens,
+                   SUM(retries) AS retries,
+                   SUM(latency_ms) AS latency_ms,
+                   MAX(latency_ms) AS max_latency_ms,
+                   SUM(cost_usd) AS cost_usd
+            FROM claude_calls WHERE {where}
+            GROUP BY day, endpoint ORDER BY day DESC, cost_usd DESC""", params).fetchall()
+    finally:
+        connection.close()
+
+    report = []
+    for row in rows:
+        item = dict(row)
+        images = item["images"] or 0
+        item["avg_latency_seconds"] = round(item["latency_ms"] / item["calls"] / 1000, 3)
+        item["max_latency_seconds"] = round(item.pop("max_latency_ms") / 1000, 3)
+        # Пересчет на фото - сравнимо между пакетами разного размера
+        item["seconds_per_image"] = round(item["latency_ms"] / images / 1000, 3) if images else None
+        item["input_tokens_per_image"] = round(item["input_tokens"] / images) if images else None
+        item["cost_per_image_usd"] = round(item["cost_usd"] / images, 5) if images else None
+        item["cost_usd"] = round(item["cost_usd"], 4)
+        del item["latency_ms"]
+        report.append(item)
+    return {
+        "days": days,
+        "since": since,
+        "rows": report,
+        "total": {
+            "calls": sum(item["calls"] for item in report),
+            "images": sum(item["images"] or 0 for item in report),
+            "input_tokens": sum(item["input_tokens"] for item in report),
+            "output_tokens": sum(item["output_tokens"] for item in report),
+            "cost_usd": round(sum(item["cost_usd"] for item in report), 4)
+        }
+    }
+
+
+# ===== Конвейер анализа =====
+# Все эндпоинты анализа проходят одни и те же стадии:
+# ingest → dedup → preprocess → infer → parse → assemble.
+# Эндпоинт описывает только свое (AnalysisSpec): промпт, параметры модели, ожидаемый
+# формат ответа и сборку результата. Чтение и проверка файлов, кэш подготовленных
+# изображений, клиент Claude и разбор ошибок API - общие для всех путей.
+CLAUDE_MODEL = "claude-sonnet-4-20250514"
+CLAUDE_TIMEOUT = 120.0
+CLAUDE_MAX_RETRIES = 2  # повторы делает timed_claude_call, в пределах дедлайна запроса
+# Поднимать при изменении промптов или сборки ответа: входит в ключ общих вычислений
+PROMPT_VERSION = "1"
+
+# --- Пул ключей Anthropic ---
+# Пропускная способность ограничена лимитами ключа, поэтому ключей может быть
+# несколько: ANTHROPIC_API_KEYS через запятую (ключи одной организации или разных
+# workspace), без него - один ANTHROPIC_API_KEY. У каждого ключа свои токен-бакеты
+# тех же CLAUDE_RPM_LIMIT / CLAUDE_ITPM_LIMIT. Попытка вызова уходит на наименее
+# загруженный ключ, а ключ, получивший 429, отдыхает retry-after секунд (или
+# CLAUDE_KEY_COOLDOWN_SECONDS) - повтор сразу идет на другой ключ.
+CLAUDE_KEY_COOLDOWN_SECONDS = float(os.getenv("CLAUDE_KEY_COOLDOWN_SECONDS", "30"))
+
+
+def configured_api_keys() -> List[str]:
+    keys = [key.strip() for key in os.getenv("ANTHROPIC_API_KEYS", "").split(",") if key.strip()]
+    if not keys and os.getenv("ANTHROPIC_API_KEY"):
+        keys = [os.getenv("ANTHROPIC_API_KEY")]
+    return list(dict.fromkeys(keys))
+
+
+def mask_api_key(api_key: str) -> str:
+    return f"{api_key[:10]}...{api_key[-4:]}"
+
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """Заголовок retry-after ошибки API в секундах"""
+    response = getattr(error, "response", None)
+    try:
+        return max(0.0, float(response.headers.get("retry-after", ""))) if response is not None else None
+    except ValueError:
+        return None
+
+
+class ClaudeCredential:
+    """Ключ Anthropic в пуле: свой клиент, лимиты, отдых после 429 и счетчики"""
+
+    def __init__(self, api_key: str, http_client: httpx.AsyncClient):
+        self.label = mask_api_key(api_key)
+        self.client = anthropic.AsyncAnthropic(
+            api_key=api_key, timeout=CLAUDE_TIMEOUT, max_retries=0, http_client=http_client)
+        self.requests = TokenBucket(CLAUDE_RPM_LIMIT)
+        self.input_tokens = TokenBucket(CLAUDE_ITPM_LIMIT)
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.stats = {"calls": 0, "errors": 0, "rate_limited": 0, "input_tokens": 0, "output_tokens": 0}
+
+    def cooling(self) -> bool:
+        return time.monotonic() < self.cooldown_until
+
+    def ready_in(self, cost: int) -> float:
+        """Через сколько секунд лимитов ключа хватит на вызов стоимостью cost входных токенов"""
+        return max(self.requests.wait_time(1), self.input_tokens.wait_time(cost))
+
+    def reserve(self, cost: int):
+        # Зарезервированный вызов уже занимает ключ: следующие выберут другой
+        self.in_flight += 1
+        self.requests.take(1)
+        self.input_tokens.take(cost)
+
+    def release(self, cost: int):
+        """Возвращает лимит вызова, который так и не был отправлен"""
+        self.in_flight -= 1
+        self.requests.take(-1)
+        self.input_tokens.take(-cost)
+
+    def load(self) -> float:
+        """Вызовы в работе + самая израсходованная доля лимитов ключа"""
+        spent = []
+        for bucket in (self.requests, self.input_tokens):
+            if bucket.capacity:
+                bucket.refill()
+                spent.append(1 - bucket.tokens / bucket.capacity)
+        return self.in_flight + max(spent, default=0.0)
+
+    @contextmanager
+    def in_use(self):
+        """Учет одной попытки вызова через этот ключ (лимит и место зарезервировал планировщик)"""
+        self.stats["calls"] += 1
+        try:
+            yield
+        except anthropic.RateLimitError as error:
+            self.stats["rate_limited"] += 1
+            cooldown = retry_after_seconds(error) or CLAUDE_KEY_COOLDOWN_SECONDS
+            self.cooldown_until = time.monotonic() + cooldown
+            logger.warning(f"🔑 Ключ {self.label} получил 429, отдыхает {cooldown:.0f}с")
+            raise
+        except Exception:
+            self.stats["errors"] += 1
+            raise
+        finally:
+            self.in_flight -= 1
+
+    def record_usage(self, estimated: int, usage):
+        self.input_tokens.take(usage.input_tokens - estimated)
+        self.stats["input_tokens"] += usage.input_tokens
+        self.stats["output_tokens"] += usage.output_tokens
+
+    def snapshot(self) -> dict:
+        remaining = self.cooldown_until - time.monotonic()
+        return {
+            "key": self.label,
+            "in_flight": self.in_flight,
+            "cooldown_seconds": round(remaining, 1) if remaining > 0 else 0,
+            "requests_available": round(self.requests.tokens, 1) if self.requests.capacity else None,
+            "input_tokens_available": round(self.input_tokens.tokens) if self.input_tokens.capacity else None,
+            **self.stats
+        }
+
+
+class ClaudeCredentialPool:
+    """Ключи Anthropic с выбором наименее загруженного"""
+
+    def __init__(self, api_keys: List[str]):
+        # Один HTTP-клиент на все ключи: соединения с API общие
+        http_client = ClaudeHttpClient()
+        self.credentials = [ClaudeCredential(api_key, http_client) for api_key in api_keys]
+
+    def candidates(self) -> List[ClaudeCredential]:
+        ready = [credential for credential in self.credentials if not credential.cooling()]
+        # Отдыхают все - ключ, который освободится раньше
+        return ready or [min(self.credentials, key=lambda credential: credential.cooldown_until)]
+
+    def ready_in(self, cost: int) -> float:
+        """Через сколько секунд хотя бы у одного ключа хватит лимита на вызов"""
+        return min(credential.ready_in(cost) for credential in self.candidates())
+
+    def reserve(self, cost: int) -> ClaudeCredential:
+        """Наименее загруженный ключ из тех, у кого хватает лимита; лимит вызова списывается с него"""
+        candidates = self.candidates()
+        fits = [credential for credential in candidates if credential.ready_in(cost) == 0] or candidates
+        credential = min(fits, key=lambda credential: credential.load())
+        credential.reserve(cost)
+        return credential
+
+    def available(self) -> int:
+        return sum(not credential.cooling() for credential in self.credentials)
+
+    def snapshot(self) -> List[dict]:
+        return [credential.snapshot() for credential in self.credentials]
+
+
+_claude_pool: Optional[tuple[tuple, ClaudeCredentialPool]] = None
+_claude_pool_lock = threading.Lock()
+
+
+def get_claude_pool() -> ClaudeCredentialPool:
+    """Общий пул ключей Claude: клиенты и соединения переиспользуются между запросами"""
+    global _claude_pool
+    api_keys = tuple(configured_api_keys())
+    if not api_keys:
+        logger.error("❌ API ключ Anthropic не настроен!")
+        raise ValueError(
+            "API ключ Anthropic не настроен в переменных окружения")
+    with _claude_pool_lock:
+        # Ключи в окружении сменились - создаем пул заново
+        if _claude_pool is None or _claude_pool[0] != api_keys:
+            _claude_pool = (api_keys, ClaudeCredentialPool(list(api_keys)))
+            if len(api_keys) > 1:
+                logger.info(f"🔑 Пул ключей Anthropic: {len(api_keys)}")
+        return _claude_pool[1]
+
+
+def claude_pool_metrics() -> List[dict]:
+    return _claude_pool[1].snapshot() if _claude_pool else []
+
+
+class AnalysisSpec:
+    """Описание эндпоинта для конвейера анализа"""
+
+    def __init__(self, name: str, prompt=None, assemble=None, expect: type = list,
+                 system: Optional[str] = None, max_tokens: int = 8192,
+                 temperature: Optional[float] = None, per_image: bool = False,
+                 session_prefix: str = "", debug: str = "sampled", hedge: bool = False,
+                 priority: str = "bulk", calls=None):
+        self.name = name
+        # prompt(run, indexes) -> текст запроса для изображений run.file_info[indexes]
+        self.prompt = prompt
+        # calls(run) -> списки индексов run.file_info, по одному на вызов Claude
+        # (по умолчанию все изображения одним вызовом или по одному при per_image)
+        self.calls = calls
+        # assemble(run) -> поля успешного ответа эндпоинта
+        self.assemble = assemble
+        # list / dict - JSON-ответ, str - свободный текст
+        self.expect = expect
+        self.system = system
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        # Отдельный вызов Claude на каждое изображение; ошибка одного не прерывает остальные
+        self.per_image = per_image
+        self.session_prefix = session_prefix
+        # "force" - всегда сохранять отладочные файлы, "sampled" - по выборке, "off" - никогда
+        self.debug = debug
+        # Интерактивный запрос: при CLAUDE_HEDGE_ENABLED медленный вызов дублируется
+        self.hedge = hedge
+        # Класс в очереди планировщика вызовов Claude (CLAUDE_PRIORITIES)
+        self.priority = priority
+
+
+class AnalysisRun:
+    """Один проход конвейера: изображения, ответы Claude и их разбор"""
+
+    def __init__(self, spec: AnalysisSpec, file_info: List[dict], total_files: int,
+                 session_id: str, description: Optional[str] = None, context: Optional[dict] = None):
+        self.spec = spec
+        self.file_info = file_info
+        self.total_files = total_files
+        self.session_id = session_id
+        self.description = description
+        # Данные эндпоинта для prompt/calls/assemble (например, группы повторного анализа)
+        self.context = context or {}
+        self.debug_folder = None
+        self.response_text = ""
+        # Разобранные ответы по вызовам; для per_image - исключение вместо ответа при ошибке
+        self.outputs = []
+
+    @property
+    def image_batch(self) -> List[tuple[bytes, str]]:
+        return [(info['contents'], info['filename']) for info in self.file_info]
+
+    @property
+    def filenames(self) -> List[str]:
+        return [info['filename'] for info in self.file_info]
+
+
+def image_info(filename: str, contents: bytes, content_type: Optional[str] = None,
+               sha256: Optional[str] = None) -> dict:
+    return {
+        'filename': filename,
+        'content_type': content_type or detect_image_type(contents)[1],
+        'size': len(contents),
+        'sha256': sha256 or hashlib.sha256(contents).hexdigest(),
+        'contents': contents
+    }
+
+
+async def ingest_uploads(files: List[UploadFile]) -> List[dict]:
+    """ingest: читает загруженные файлы в исходном порядке, пропуская не-изображения и слишком большие"""
+    await admit_images([file.file for file in files])
+    file_info = []
+    deadline = current_deadline()
+    logger.info(f"📋 Порядок получения файлов (БЕЗ сортировки):")
+    with trace_span("ingest", **{"upload.file_count": len(files)}) as ingest_span:
+        for i, file in enumerate(files):
+            deadline.check("ingest")
+            logger.info(f"  {i}: {file.filename} ({file.content_type})")
+            if not file.content_type or not file.content_type.startswith('image/'):
+                logger.warning(
+                    f"⚠️ Пропускаем {file.filename} - неверный тип: {file.content_type}")
+                continue
+
+            try:
+                contents = await file.read()
+            except Exception as file_error:
+                logger.error(
+                    f"❌ Ошибка чтения файла {file.filename}: {file_error}")
+                continue
+
+            if len(contents) > UPLOAD_MAX_FILE_BYTES:
+                logger.warning(
+                    f"⚠️ Пропускаем {file.filename} - слишком большой: {len(contents)/1024/1024:.1f}MB")
+                continue
+
+            file_info.append(image_info(file.filename, contents, file.content_type))
+        ingest_span.set_attribute("image.count", len(file_info))
+        ingest_span.set_attribute(
+            "image.bytes_total", sum(info['size'] for info in file_info))
+    return file_info
+
+
+def ingest_blobs(entries: List[tuple[str, str]]) -> List[dict]:
+    """ingest для изображений из blob-хранилища: [(sha256, имя файла)]"""
+    file_info = []
+    deadline = current_deadline()
+    with trace_span("ingest", **{"image.count": len(entries)}) as ingest_span:
+        for sha256, filename in entries:
+            deadline.check("ingest")
+            path = find_blob(sha256)
+            if not path:
+                raise ValueError(
+                    f"Изображение {sha256[:12]} больше не хранится на сервере")
+            with open(path, 'rb') as f:
+                contents = f.read()
+            file_info.append(image_info(filename, contents, sha256=sha256))
+        ingest_span.set_attribute(
+            "image.bytes_total", sum(info['size'] for info in file_info))
+    return file_info
+
+
+def dedup_images(file_info: List[dict]) -> List[dict]:
+    """dedup: одинаковые фото отправляются в Claude один раз, одинаковые имена разных фото получают суффикс"""
+    unique = []
+    seen_hashes = {}
+    used_names = set()
+    with trace_span("dedup", **{"image.count": len(file_info)}) as dedup_span:
+        for info in file_info:
+            if info['sha256'] in seen_hashes:
+                logger.info(
+                    f"♻️ {info['filename']} совпадает с {seen_hashes[info['sha256']]} - пропускаем дубликат")
+                continue
+            seen_hashes[info['sha256']] = info['filename']
+
+            # Claude отвечает именами файлов, поэтому они должны быть уникальными
+            # (камеры телефонов часто называют все фото image.jpg)
+            filename = info['filename']
+            base, ext = os.path.splitext(filename)
+            suffix = 2
+            while filename in used_names:
+                filename = f"{base}_{suffix}{ext}"
+                suffix += 1
+            used_names.add(filename)
+            unique.append(info if filename == info['filename'] else {**info, 'filename': filename})
+        dedup_span.set_attribute("image.duplicates", len(file_info) - len(unique))
+    return unique
+
+
+async def preprocess_images(file_info: List[dict]) -> List[dict]:
+    """preprocess: блоки изображений для Claude (уменьшенные, base64, из кэша по хэшу)"""
+    deadline = current_deadline()
+    blocks = []
+    with trace_span("preprocess", **{"image.count": len(file_info)}):
+        # По одному изображению за раз: отмена запроса или истекший срок останавливают оставшиеся
+        for info in file_info:
+            deadline.check("preprocess")
+            blocks.append(await asyncio.to_thread(prepare_image_block, info['contents'], info['sha256']))
+    return blocks
+
+
+# --- Хеджирование вызовов Claude ---
+# У времени ответа Claude длинный хвост: один медленный вызов растягивает
+# интерактивный запрос до минуты. Для эндпоинтов с hedge=True, если ответа нет
+# дольше CLAUDE_HEDGE_PERCENTILE-го перцентиля недавних вызовов этого эндпоинта,
+# отправляется второй такой же запрос: берется первый успешный ответ, другой
+# отменяется. Дубли ограничены бюджетом - CLAUDE_HEDGE_BUDGET на каждый вызов.
+CLAUDE_HEDGE_ENABLED = env_flag("CLAUDE_HEDGE_ENABLED", False)
+CLAUDE_HEDGE_PERCENTILE = float(os.getenv("CLAUDE_HEDGE_PERCENTILE", "95"))
+CLAUDE_HEDGE_BUDGET = float(os.getenv("CLAUDE_HEDGE_BUDGET", "0.1"))
+# Дубль не раньше этой задержки, даже если обычно Claude отвечает быстрее
+CLAUDE_HEDGE_MIN_DELAY = float(os.getenv("CLAUDE_HEDGE_MIN_DELAY", "2"))
+# Пока замеров меньше, перцентиль ненадежен - без дублей
+CLAUDE_HEDGE_MIN_SAMPLES = 20
+CLAUDE_HEDGE_BURST = 3.0
+CLAUDE_LATENCY_WINDOW = 200
+
+
+class LatencyTracker:
+    """Время последних успешных вызовов Claude по эндпоинтам"""
+
+    def __init__(self, window: int):
+        self.window = window
+        self.samples = {}
+
+    def record(self, name: str, seconds: float):
+        self.samples.setdefault(name, deque(maxlen=self.window)).append(seconds)
+
+    def count(self, name: str) -> int:
+        return len(self.samples.get(name, ()))
+
+    def percentile(self, name: str, pct: float) -> Optional[float]:
+        samples = sorted(self.samples.get(name, ()))
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, max(0, math.ceil(pct / 100 * len(samples)) - 1))]
+
+    def expected_remaining(self, name: str, elapsed: float) -> float:
+        """Сколько еще шел бы вызов, уже длящийся elapsed секунд (медиана по более долгим)"""
+        longer = sorted(seconds for seconds in self.samples.get(name, ()) if seconds > elapsed)
+        return longer[len(longer) // 2] - elapsed if longer else 0.0
+
+    def snapshot(self) -> dict:
+        return {
+            name: {
+                "count": len(samples),
+                **{f"p{pct}": round(self.percentile(name, pct), 3) for pct in (50, 95, 99)}
+            }
+            for name, samples in self.samples.items() if samples
+        }
+
+
+class HedgeBudget:
+    """Бюджет дублей: каждый вызов добавляет ratio, дубль тратит единицу"""
+
+    def __init__(self, ratio: float, burst: float):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = burst
+
+    def on_call(self):
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+# Состояние меняется только из цикла событий - без блокировок
+claude_latency = LatencyTracker(CLAUDE_LATENCY_WINDOW)
+claude_hedge_budget = HedgeBudget(CLAUDE_HEDGE_BUDGET, CLAUDE_HEDGE_BURST)
+claude_hedge_stats = {"calls": 0, "hedged": 0, "hedge_wins": 0, "budget_exhausted": 0, "saved_seconds": 0.0}
+
+
+def hedge_delay(spec: AnalysisSpec) -> Optional[float]:
+    """Через сколько секунд без ответа отправлять дубль; None - не дублировать"""
+    if not (CLAUDE_HEDGE_ENABLED and spec.hedge) or claude_latency.count(spec.name) < CLAUDE_HEDGE_MIN_SAMPLES:
+        return None
+    return max(CLAUDE_HEDGE_MIN_DELAY, claude_latency.percentile(spec.name, CLAUDE_HEDGE_PERCENTILE))
+
+
+# --- Планировщик вызовов Claude ---
+# Все эндпоинты делят лимиты Anthropic (запросы и входные токены в минуту).
+# Без порядка пакетная группировка на 50 фото выбирает лимит, и анализ одного
+# фото ждет вместе с ней. Каждая попытка вызова проходит через планировщик:
+# лимиты - токен-бакеты CLAUDE_RPM_LIMIT и CLAUDE_ITPM_LIMIT каждого ключа пула
+# (своих бакетов у очереди нет: вызов ждет, пока лимита хватит хотя бы одному
+# ключу, и списывается с него), а очередь - строгий
+# приоритет классов (CLAUDE_PRIORITIES, у AnalysisSpec.priority), внутри класса -
+# взвешенная честная очередь по клиентам (вес - оценка токенов вызова), чтобы
+# один большой импорт не забирал весь класс. Лимиты по умолчанию выключены (0):
+# значения берутся из лимитов организации в консоли Anthropic.
+CLAUDE_RPM_LIMIT = int(os.getenv("CLAUDE_RPM_LIMIT", "0"))
+CLAUDE_ITPM_LIMIT = int(os.getenv("CLAUDE_ITPM_LIMIT", "0"))
+CLAUDE_PRIORITIES = ("interactive", "grouping", "detailed", "bulk")
+# Верхняя оценка токенов изображения: Claude уменьшает картинки до ~1.15 Мп (~1600 токенов)
+CLAUDE_IMAGE_TOKENS = 1600
+
+
+class TokenBucket:
+    """Токен-бакет лимита в минуту; capacity=0 - без лимита"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, cost: float) -> float:
+        """Через сколько секунд хватит токенов на cost (вызов дороже емкости ждет полный бакет)"""
+        if not self.capacity:
+            return 0.0
+        self.refill()
+        return max(0.0, (min(cost, self.capacity) - self.tokens) / self.rate)
+
+    def take(self, cost: float):
+        # Бакет может уйти в минус: дорогой вызов отодвигает следующие
+        if self.capacity:
+            self.tokens -= cost
+
+
+class ClaudeScheduler:
+    """Очередь вызовов Claude: строгий приоритет классов, внутри класса - честная очередь по клиентам"""
+
+    def __init__(self):
+        self.pool: Optional[ClaudeCredentialPool] = None
+        self.queues = {priority: [] for priority in CLAUDE_PRIORITIES}
+        # Виртуальное время класса и последний finish-тег клиента (WFQ)
+        self.virtual_time = {priority: 0.0 for priority in CLAUDE_PRIORITIES}
+        self.finish_tags = {}
+        self.sequence = 0
+        self.changed: Optional[asyncio.Event] = None
+        self.dispatcher: Optional[asyncio.Task] = None
+        self.waits = LatencyTracker(CLAUDE_LATENCY_WINDOW)
+        self.stats = {priority: {"dispatched": 0, "queued": 0} for priority in CLAUDE_PRIORITIES}
+
+    @property
+    def limited(self) -> bool:
+        return bool(CLAUDE_RPM_LIMIT or CLAUDE_ITPM_LIMIT)
+
+    def dispatch(self, priority: str, cost: int) -> ClaudeCredential:
+        self.stats[priority]["dispatched"] += 1
+        return self.pool.reserve(cost)
+
+    async def acquire(self, pool: ClaudeCredentialPool, priority: str, client: str, cost: int) -> ClaudeCredential:
+        """Ждет очереди на вызов Claude стоимостью cost входных токенов; возвращает ключ для вызова"""
+        started = time.monotonic()
+        # Ключи в окружении сменились - лимиты считаем по новому пулу
+        self.pool = pool
+        if not self.limited or (not any(self.queues.values()) and pool.ready_in(cost) == 0):
+            self.waits.record(priority, 0.0)
+            return self.dispatch(priority, cost)
+
+        # finish-тег: клиент с большими вызовами уступает очередь клиентам с малыми
+        key = (priority, client)
+        start_tag = max(self.virtual_time[priority], self.finish_tags.get(key, 0.0))
+        self.finish_tags[key] = start_tag + cost
+        self.sequence += 1
+        entry = [start_tag + cost, self.sequence, cost, asyncio.get_running_loop().create_future()]
+        heapq.heappush(self.queues[priority], entry)
+        self.stats[priority]["queued"] += 1
+        if self.dispatcher is None or self.dispatcher.done():
+            self.changed = asyncio.Event()
+            self.dispatcher = asyncio.ensure_future(self._dispatch_loop())
+        self.changed.set()
+        try:
+            credential = await entry[3]
+        except asyncio.CancelledError:
+            if entry[3].done() and not entry[3].cancelled():
+                # Очередь уже подошла, но вызов не состоится - возвращаем лимит ключу
+                entry[3].result().release(cost)
+            raise
+        self.waits.record(priority, time.monotonic() - started)
+        return credential
+
+    def _head(self) -> Optional[tuple[str, list]]:
+        for priority in CLAUDE_PRIORITIES:
+            queue = self.queues[priority]
+            while queue and queue[0][3].done():  # отмененные ожидающие
+                heapq.heappop(queue)
+            if queue:
+                return priority, queue[0]
+        return None
+
+    async def _dispatch_loop(self):
+        while True:
+            head = self._head()
+            if head is None:
+                # Очереди пусты: теги клиентов позади виртуального времени больше не нужны
+                self.finish_tags = {key: tag for key, tag in self.finish_tags.items()
+                                    if tag > self.virtual_time[key[0]]}
+                return
+            priority, entry = head
+            wait = self.pool.ready_in(entry[2])
+            if wait > 0:
+                # Пришел вызов важнее - пересчитываем, кто следующий
+                self.changed.clear()
+                try:
+                    await asyncio.wait_for(self.changed.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self.queues[priority])
+            self.virtual_time[priority] = entry[0]
+            entry[3].set_result(self.dispatch(priority, entry[2]))
+
+    def snapshot(self) -> dict:
+        # Емкость очереди - сумма лимитов ключей текущего пула
+        credentials = self.pool.credentials if self.pool else []
+        for credential in credentials:
+            credential.requests.refill()
+            credential.input_tokens.refill()
+        return {
+            "rpm_limit": CLAUDE_RPM_LIMIT * len(credentials),
+            "itpm_limit": CLAUDE_ITPM_LIMIT * len(credentials),
+            "requests_available": round(sum(credential.requests.tokens for credential in credentials), 1)
+            if CLAUDE_RPM_LIMIT and credentials else None,
+            "input_tokens_available": round(sum(credential.input_tokens.tokens for credential in credentials))
+            if CLAUDE_ITPM_LIMIT and credentials else None,
+            "queue_depth": {priority: sum(not entry[3].done() for entry in queue)
+                            for priority, queue in self.queues.items()},
+            "classes": self.stats,
+            "wait_seconds": self.waits.snapshot()
+        }
+
+
+claude_scheduler = ClaudeScheduler()
+_current_client: contextvars.ContextVar[str] = contextvars.ContextVar("claude_client", default="-")
+
+
+def estimate_input_tokens(kwargs: dict) -> int:
+    """Оценка входных токенов вызова: изображения по верхней границе, текст ~3 символа на токен"""
+    content = kwargs["messages"][0]["content"]
+    images = sum(1 for block in content if block.get("type") == "image")
+    text = sum(len(block.get("text", "")) for block in content) + len(kwargs.get("system") or "")
+    return images * CLAUDE_IMAGE_TOKENS + text // 3
+
+
+# Число прокси перед сервисом (на Render - 1, балансировщик). Каждый дописывает
+# в X-Forwarded-For адрес, с которого к нему пришли, поэтому адрес клиента -
+# TRUSTED_PROXY_HOPS-й справа; всё левее клиент мог подставить сам. 0 - заголовок
+# не учитывается, ключ клиента - адрес сокета.
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "0"))
+
+
+def client_address(scope) -> str:
+    """Адрес клиента: самый правый адрес X-Forwarded-For, не добавленный доверенными прокси, или адрес сокета"""
+    peer = (scope.get("client") or ("-",))[0]
+    if TRUSTED_PROXY_HOPS <= 0:
+        return peer
+    forwarded = [address.strip() for header in Headers(scope=scope).getlist("x-forwarded-for")
+                 for address in header.split(",") if address.strip()]
+    if not forwarded:
+        return peer
+    return forwarded[-min(TRUSTED_PROXY_HOPS, len(forwarded))]
+
+
+class ClientKeyMiddleware:
+    """ASGI-middleware: ключ клиента (см. client_address) для планировщика"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        token = _current_client.set(client_address(scope))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _current_client.reset(token)
+
+
+app.add_middleware(ClientKeyMiddleware)
+
+
+# --- Повторы вызовов Claude ---
+# Повторяет сам сервис, а не SDK (у клиента max_retries=0): SDK не знает срока
+# запроса и начал бы повтор, который заведомо не успеет закончиться. Каждая
+# попытка получает таймаут не больше остатка дедлайна.
+CLAUDE_RETRY_BASE_DELAY = 0.5
+CLAUDE_RETRY_MAX_DELAY = 8.0
+CLAUDE_RETRY_STATUSES = {408, 409, 429}
+claude_retry_stats = {"retries": 0, "skipped_deadline": 0}
+
+
+def claude_retry_delay(error: Exception, attempt: int) -> Optional[float]:
+    """Пауза перед повтором; None - ошибка не временная, повторять бессмысленно"""
+    if isinstance(error, anthropic.APIStatusError):
+        if error.status_code not in CLAUDE_RETRY_STATUSES and error.status_code < 500:
+            return None
+        retry_after = retry_after_seconds(error)
+        if retry_after is not None:
+            return retry_after
+    # Экспоненциальная пауза с разбросом, чтобы повторы разных запросов не совпадали
+    return min(CLAUDE_RETRY_MAX_DELAY, CLAUDE_RETRY_BASE_DELAY * 2 ** attempt) * (1 - 0.25 * random.random())
+
+
+async def claude_queue_turn(spec: AnalysisSpec, pool: ClaudeCredentialPool, estimated: int,
+                            deadline: Deadline) -> ClaudeCredential:
+    """Ждет очереди планировщика, но не дольше дедлайна запроса; возвращает ключ для вызова"""
+    if not claude_scheduler.limited:
+        return await claude_scheduler.acquire(pool, spec.priority, _current_client.get(), estimated)
+    try:
+        return await asyncio.wait_for(
+            claude_scheduler.acquire(pool, spec.priority, _current_client.get(), estimated),
+            deadline.budget("claude_queue", CLAUDE_TIMEOUT))
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded("claude_queue", deadline)
+
+
+async def timed_claude_call(spec: AnalysisSpec, pool: ClaudeCredentialPool, kwargs: dict):
+    """Вызов Claude с повторами временных ошибок, пока их позволяет дедлайн запроса; итог - в журнал расхода"""
+    deadline = current_deadline()
+    estimated = estimate_input_tokens(kwargs)
+    attempt = 0
+    credential = None
+    message = None
+    status = "cancelled"
+    call_started = time.monotonic()
+    try:
+        while True:
+            credential = await claude_queue_turn(spec, pool, estimated, deadline)
+            try:
+                timeout = deadline.budget("claude", CLAUDE_TIMEOUT)
+            except DeadlineExceeded:
+                credential.release(estimated)
+                raise
+            started = time.monotonic()
+            try:
+                with credential.in_use():
+                    # Таймаут httpx - на каждое чтение, а не на весь вызов: общий срок держит wait_for
+                    message = await asyncio.wait_for(create_claude_message(
+                        credential.client.with_options(timeout=timeout, max_retries=0), **kwargs), timeout)
+            except (anthropic.APIConnectionError, anthropic.APIStatusError, TimeoutError) as error:
+                delay = claude_retry_delay(error, attempt)
+                # Лимит одного ключа: повтор без паузы через другой, если есть свободный
+                if isinstance(error, anthropic.RateLimitError) and delay is not None and pool.available():
+                    delay = 0.0
+                if delay is None or attempt >= CLAUDE_MAX_RETRIES:
+                    # Таймаут, урезанный до остатка срока, - это истекший дедлайн, а не медленный API
+                    if isinstance(error, (anthropic.APITimeoutError, TimeoutError)) and deadline.remaining() <= 0:
+                        raise DeadlineExceeded("claude", deadline) from error
+                    raise
+                # Повтор нужен, только если после паузы Claude успеет ответить за обычное время
+                expected = claude_latency.percentile(spec.name, 50) or 0.0
+                if deadline.remaining() < delay + expected:
+                    claude_retry_stats["skipped_deadline"] += 1
+                    logger.warning(
+                        f"⌛ Claude ({spec.name}): {type(error).__name__}, на повтор не хватает времени "
+                        f"(осталось {deadline.remaining():.1f}с, нужно ~{delay + expected:.1f}с)")
+                    raise DeadlineExceeded("claude", deadline) from error
+                attempt += 1
+                claude_retry_stats["retries"] += 1
+                logger.warning(
+                    f"🔁 Claude ({spec.name}): {type(error).__name__}, повтор {attempt}/{CLAUDE_MAX_RETRIES} через {delay:.1f}с")
+                await asyncio.sleep(delay)
+                continue
+            claude_latency.record(spec.name, time.monotonic() - started)
+            usage = getattr(message, "usage", None)
+            if usage:
+                credential.record_usage(estimated, usage)
+            return message
+    except DeadlineExceeded:
+        status = "deadline"
+        raise
+    except Exception as error:
+        status = type(error).__name__
+        raise
+    finally:
+        # Одна строка журнала на вызов: с повторами, ожиданием очереди и итогом
+        usage_ledger.record(spec.name, kwargs, message, "ok" if message is not None else status,
+                            attempt, time.monotonic() - call_started, credential and credential.label)
+
+
+async def hedged_claude_call(spec: AnalysisSpec, pool: ClaudeCredentialPool, kwargs: dict):
+    """Вызов Claude; если ответ задерживается дольше обычного - с дублирующим запросом"""
+    if not (CLAUDE_HEDGE_ENABLED and spec.hedge):
+        return await timed_claude_call(spec, pool, kwargs)
+
+    claude_hedge_stats["calls"] += 1
+    claude_hedge_budget.on_call()
+    delay = hedge_delay(spec)
+    started = time.monotonic()
+    primary = asyncio.ensure_future(timed_claude_call(spec, pool, kwargs))
+    tasks = [primary]
+    try:
+        if delay is not None:
+            await asyncio.wait(tasks, timeout=delay)
+            if not primary.done():
+                if claude_hedge_budget.try_spend():
+                    claude_hedge_stats["hedged"] += 1
+                    logger.info(f"🪁 Claude ({spec.name}) не ответил за {delay:.1f}с - отправляем дубль запроса")
+                    tasks.append(asyncio.ensure_future(timed_claude_call(spec, pool, kwargs)))
+                else:
+                    claude_hedge_stats["budget_exhausted"] += 1
+
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            # Ошибка одного запроса не важна, пока другой еще может ответить
+            for task in (task for task in tasks if task in done):
+                if task.exception() is None:
+                    if task is not primary:
+                        elapsed = time.monotonic() - started
+                        saved = claude_latency.expected_remaining(spec.name, elapsed)
+                        # Отмененный первичный шел не меньше elapsed - без этого хвост
+                        # распределения пропадал бы, а порог дублей сползал вниз
+                        claude_latency.record(spec.name, elapsed)
+                        claude_hedge_stats["hedge_wins"] += 1
+                        claude_hedge_stats["saved_seconds"] += saved
+                        logger.info(f"🪁 Дубль ответил первым ({elapsed:.1f}с), экономия ~{saved:.1f}с")
+                    return task.result()
+                error = error or task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+def hedge_metrics() -> dict:
+    calls = claude_hedge_stats["calls"]
+    hedged = claude_hedge_stats["hedged"]
+    return {
+        "enabled": CLAUDE_HEDGE_ENABLED,
+        "percentile": CLAUDE_HEDGE_PERCENTILE,
+        "budget_ratio": CLAUDE_HEDGE_BUDGET,
+        "budget_tokens": round(claude_hedge_budget.tokens, 2),
+        **claude_hedge_stats,
+        "saved_seconds": round(claude_hedge_stats["saved_seconds"], 2),
+        "hedge_rate": round(hedged / calls, 4) if calls else 0.0,
+        "win_rate": round(claude_hedge_stats["hedge_wins"] / hedged, 4) if hedged else 0.0
+    }
+
+
+async def infer(spec: AnalysisSpec, content: List[dict]) -> str:
+    """infer: один вызов Claude; ошибки API превращаются в ValueError с понятным текстом"""
+    kwargs = {
+        "model": CLAUDE_MODEL,
+        "max_tokens": spec.max_tokens,
+        "messages": [{"role": "user", "content": content}]
+    }
+    if spec.system:
+        kwargs["system"] = spec.system
+    if spec.temperature is not None:
+        kwargs["temperature"] = spec.temperature
+
+    pool = get_claude_pool()
+    logger.info(f"🚀 ОТПРАВЛЯЕМ ЗАПРОС В CLAUDE API ({spec.name})...")
+    try:
+        message = await hedged_claude_call(spec, pool, kwargs)
+    except DeadlineExceeded:
+        raise
+    except (anthropic.APITimeoutError, TimeoutError) as timeout_error:
+        logger.error(f"❌ ТАЙМАУТ CLAUDE API: {timeout_error}")
+        raise ValueError(
+            f"Таймаут Claude API (попробуйте позже): {str(timeout_error)}")
+    except anthropic.RateLimitError as rate_error:
+        logger.error(f"❌ ПРЕВЫШЕН ЛИМИТ ЗАПРОСОВ CLAUDE API: {rate_error}")
+        raise ValueError(
+            f"Превышен лимит запросов Claude API: {str(rate_error)}")
+    except anthropic.APIError as api_error:
+        logger.error(f"❌ ОШИБКА CLAUDE API: {api_error}")
+        raise ValueError(f"Ошибка Claude API: {str(api_error)}")
+    except Exception as api_error:
+        logger.error(f"❌ НЕИЗВЕСТНАЯ ОШИБКА ВЫЗОВА CLAUDE API: {api_error}")
+        raise ValueError(
+            f"Неизвестная ошибка вызова Claude API: {str(api_error)}")
+
+    if not message.content:
+        logger.error("❌ ПУСТОЙ CONTENT В ОТВЕТЕ CLAUDE!")
+        raise ValueError("Claude вернул пустой content")
+
+    response_text = message.content[0].text
+    if not response_text or not response_text.strip():
+        logger.error("❌ ПУСТОЙ ОТВЕТ ОТ CLAUDE!")
+        raise ValueError("Claude вернул пустой ответ")
+
+    logger.info(
+        f"✅ ПОЛУЧЕН ОТВЕТ ({spec.name})! Длина: {len(response_text)} символов")
+    return response_text
+
+
+def parse_response(spec: AnalysisSpec, response_text: str):
+    """parse: JSON нужного типа (или текст) из ответа Claude"""
+    if spec.expect is str:
+        return response_text.strip()
+
+    # HTML вместо JSON - ошибка сети или перегрузка API
+    if response_text.strip().startswith('<'):
+        logger.error(f"❌ ПОЛУЧЕН HTML ВМЕСТО JSON: {response_text[:500]}...")
+        raise ValueError(
+            "Claude вернул HTML вместо JSON (ошибка сети или перегрузка API)")
+
+    json_text = extract_json_from_response(response_text)
+    with trace_span("parse_response", **{"response.chars": len(json_text)}):
+        try:
+            parsed = json.loads(json_text)
+        except json.JSONDecodeError as json_error:
+            logger.error(
+                f"❌ ОШИБКА JSON ПАРСИНГА: {json_error} (строка {json_error.lineno}, колонка {json_error.colno})")
+            logger.error(
+                f"🔍 Проблемный фрагмент: {repr(json_text[max(0, json_error.pos-20):json_error.pos+20])}")
+            raise
+
+    # Один товар иногда приходит объектом, а не списком из одного элемента
+    if spec.expect is list and isinstance(parsed, dict):
+        parsed = [parsed]
+    if not isinstance(parsed, spec.expect):
+        raise ValueError(
+            "Ответ Claude не является " + ("списком" if spec.expect is list else "объектом"))
+    return parsed
+
+
+class SingleFlight:
+    """Одно вычисление на ключ: одинаковые параллельные запросы ждут общий результат"""
+
+    def __init__(self):
+        self.calls = {}
+        self.waiters = {}
+        self.stats = {"started": 0, "coalesced": 0, "cancelled": 0}
+
+    async def do(self, key: str, compute):
+        task = self.calls.get(key)
+        if task is None:
+            self.stats["started"] += 1
+            task = asyncio.ensure_future(compute())
+            self.calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            self.stats["coalesced"] += 1
+            logger.info(f"🔗 Такой же анализ уже выполняется ({key[:12]}), ждем его результат")
+
+        self.waiters[task] = self.waiters.get(task, 0) + 1
+        try:
+            # shield: отмена одного ожидающего не прерывает вычисление для остальных
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            # Ушел последний, кто ждал результат, - вычисление больше никому не нужно
+            if not task.done() and self.waiters[task] == 1:
+                self.stats["cancelled"] += 1
+                task.cancel()
+            raise
+        finally:
+            self.waiters[task] -= 1
+            if not self.waiters[task]:
+                del self.waiters[task]
+
+    def _forget(self, key: str, task: asyncio.Future):
+        if self.calls.get(key) is task:
+            del self.calls[key]
+        if not task.cancelled():
+            task.exception()  # исключение уже получили ожидающие - не пишем "never retrieved"
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "in_flight": len(self.calls)}
+
+
+analysis_flights = SingleFlight()
+
+
+def analysis_key(spec: AnalysisSpec, file_info: List[dict], total_files: int,
+                 session_id: Optional[str], description: Optional[str], context: Optional[dict] = None) -> str:
+    """Ключ общего вычисления: упорядоченные фото (хэш и имя) + эндпоинт + версия промпта"""
+    material = [spec.name, PROMPT_VERSION, CLAUDE_MODEL, total_files, session_id, description or "",
+                [(info['sha256'], info['filename']) for info in file_info], context or {}]
+    return hashlib.sha256(json.dumps(material, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+# --- Отмена при отключении клиента ---
+# Закрытая вкладка не должна оплачивать ответ Claude, который никто не прочитает.
+# Пока идет анализ, отдельная задача ждет от сервера сообщение http.disconnect;
+# при отключении анализ отменяется: оставшиеся изображения не уменьшаются,
+# запрос к Claude обрывается, отладочные файлы и тело ответа не создаются.
+# Код nginx для запроса, закрытого клиентом: ответ все равно никто не получит
+CLIENT_CLOSED_REQUEST = 499
+
+
+class ClientDisconnected(Exception):
+    """Клиент закрыл соединение, не дождавшись ответа"""
+
+
+async def wait_for_disconnect(request: Request):
+    # Тело запроса к этому моменту уже прочитано, следующее сообщение - отключение.
+    # request.is_disconnected() тут не подходит: за BaseHTTPMiddleware он его не видит
+    while (await request.receive())["type"] != "http.disconnect":
+        pass
+
+
+async def cancel_on_disconnect(request: Optional[Request], awaitable):
+    """Ждет результат awaitable; если клиент отключился - отменяет его и бросает ClientDisconnected"""
+    task = asyncio.ensure_future(awaitable)
+    if request is None:
+        return await task
+    watcher = asyncio.ensure_future(wait_for_disconnect(request))
+    try:
+        await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+        if task.done():
+            return task.result()
+        set_span_attributes(**{"client.disconnected": True})
+        raise ClientDisconnected()
+    finally:
+        for pending in (task, watcher):
+            if not pending.done():
+                pending.cancel()
+
+
+def analysis_error_response(error: Exception, action: str) -> Response:
+    """Единый ответ эндпоинтов анализа на исключение: 499, 504, 429 или 500"""
+    if isinstance(error, ClientDisconnected):
+        logger.warning(f"🔌 Клиент отключился, не дождавшись {action}")
+        return Response(status_code=CLIENT_CLOSED_REQUEST)
+    if isinstance(error, DeadlineExceeded):
+        return deadline_exceeded_response(error)
+    if isinstance(error, AdmissionRejected):
+        return admission_rejected_response(error)
+    logger.error(f"❌ Ошибка {action}: {error}\n{traceback.format_exc()}")
+    return JSONResponse({
+        "success": False,
+        "error": f"Ошибка сервера: {str(error)}",
+        "trace_id": get_trace_id()
+    }, status_code=500)
+
+
+async def run_analysis(spec: AnalysisSpec, file_info: List[dict], total_files: Optional[int] = None,
+                       session_id: Optional[str] = None, description: Optional[str] = None,
+                       request: Optional[Request] = None, context: Optional[dict] = None) -> JSONResponse:
+    """Проводит изображения через все стадии конвейера и возвращает ответ эндпоинта.
+
+    Одинаковые запросы, пришедшие пока первый еще выполняется (двойной клик,
+    две вкладки), не идут в Claude повторно, а получают тот же результат.
+    Ожидающий чужой результат ждет не дольше своего дедлайна и держит память
+    под свои изображения, пока они у него есть: если вычисление упало по
+    дедлайну первого запроса, а у этого время еще есть, анализ запускается
+    заново уже с ним в роли первого.
+    Если отключились все, кто ждет результат, вычисление отменяется.
+    """
+    file_info = dedup_images(file_info)
+    if not file_info:
+        raise HTTPException(
+            status_code=400, detail="Нет валидных изображений")
+
+    total_files = total_files if total_files is not None else len(file_info)
+    key = analysis_key(spec, file_info, total_files, session_id, description, context)
+    deadline = current_deadline()
+    while True:
+        leader = key not in analysis_flights.calls
+        set_span_attributes(**{
+            "analysis.endpoint": spec.name,
+            "analysis.coalesced": not leader,
+            "image.count": len(file_info)
+        })
+
+        flight = analysis_flights.do(
+            key, lambda: execute_analysis(spec, file_info, total_files, session_id, description, context))
+        if not leader:
+            flight = asyncio.wait_for(flight, deadline.remaining())
+        try:
+            # ClientDisconnected уходит в эндпоинт: его превращает в 499 analysis_error_response
+            status_code, payload = await cancel_on_disconnect(request, flight)
+        except asyncio.TimeoutError:
+            if leader:
+                raise
+            raise DeadlineExceeded("coalesced", deadline)
+        if leader or status_code != 504 or deadline.remaining() <= 0:
+            break
+        logger.info(f"🔗 Общий анализ не уложился в срок первого запроса, запускаем заново ({key[:12]})")
+
+    if status_code != 200:
+        return JSONResponse({**payload, "trace_id": get_trace_id()}, status_code=status_code)
+    # Изображения в ответе (data URL) кодируются в base64 уже при отправке
+    return StreamingJSONResponse({"success": True, **payload, "trace_id": get_trace_id()})
+
+
+async def execute_analysis(spec: AnalysisSpec, file_info: List[dict], total_files: int,
+                           session_id: Optional[str], description: Optional[str],
+                           context: Optional[dict] = None) -> tuple[int, dict]:
+    """Стадии preprocess → infer → parse → assemble; (статус, тело ответа без trace_id)"""
+    run = AnalysisRun(
+        spec, file_info, total_files,
+        session_id or f"{spec.session_prefix}{int(time.time())}_{len(file_info)}", description, context)
+    set_span_attributes(**{"session.id": run.session_id})
+    _current_session_id.set(run.session_id)
 
-        # Упрощенный промпт для точного анализа товаров
-        main_prompt = f"""Проанализируй эти {len(image_batch)} изображений товаров и сгруппируй ОДИНАКОВЫЕ товары.
+    logger.info(
+        f"🔍 {spec.name}: получено {run.total_files} файлов, к анализу {len(file_info)}")
+    for i, info in enumerate(file_info):
+        logger.info(
+            f"    Индекс {i}: blob {info['sha256'][:12]} (оригинал: {info['filename']})")
 
-Изображения пронумерованы от 0 до {len(image_batch)-1}.
+    try:
+        if spec.calls:
+            calls = spec.calls(run)
+        else:
+            calls = [[i] for i in range(len(file_info))] if spec.per_image else [list(range(len(file_info)))]
+        # Уменьшаем только изображения, которые уйдут в Claude
+        needed = sorted({i for indexes in calls for i in indexes})
+        blocks = dict(zip(needed, await preprocess_images([file_info[i] for i in needed])))
+        for indexes in calls:
+            content = [*(blocks[i] for i in indexes),
+                       {"type": "text", "text": spec.prompt(run, indexes)}]
+            try:
+                run.response_text = await infer(spec, content)
+                run.outputs.append(parse_response(spec, run.response_text))
+            except ValueError as call_error:
+                if not spec.per_image:
+                    raise
+                logger.error(
+                    f"❌ Ошибка анализа изображения {indexes[0]}: {call_error}")
+                run.outputs.append(call_error)
+
+        # Отладочные файлы - только когда Claude ответил: брошенный запрос их не пишет
+        if spec.debug != "off":
+            run.debug_folder = save_debug_files(
+                run.image_batch, run.session_id, force=spec.debug == "force")
+
+        with trace_span("assemble", **{"analysis.endpoint": spec.name}):
+            return 200, await asyncio.to_thread(spec.assemble, run)
+
+    except DeadlineExceeded as e:
+        return 504, {**deadline_payload(e), "session_id": run.session_id}
+
+    except ValueError as e:
+        # Неудачные сессии сохраняем для разбора, даже если они не попали в выборку
+        if spec.debug != "off":
+            run.debug_folder = run.debug_folder or save_debug_files(
+                run.image_batch, run.session_id, failed=True)
+        logger.error(f"❌ ОШИБКА ОТВЕТА CLAUDE ({spec.name}): {e}")
+        logger.error(f"🔍 ПОЛНЫЙ ОТВЕТ CLAUDE: {run.response_text}")
+        return 500, {
+            "success": False,
+            "error": f"Ошибка ответа Claude: {str(e)}",
+            "raw_response": run.response_text,
+            "debug_folder": run.debug_folder,
+            "session_id": run.session_id
+        }
 
-ВАЖНО: Группируй только абсолютно идентичные товары:
-- Одинаковая модель, бренд, артикул
-- Одинаковый цвет и размер  
-- Одинаковая комплектация
-- Разные ракурсы одного товара = одна группа
-- Разные модели/цвета = разные группы
 
-Верни результат в JSON формате:
-[
-  {{
-    "group_id": 1,
-    "title": "Точное название товара с моделью",
-    "category": "Категория",
-    "subcategory": "Подкатегория", 
-    "color": "основной цвет",
-    "reasoning": "Почему эти фото в одной группе",
-    "image_indexes": [список_номеров_фото],
-    "description": "Подробное описание товара"
-  }}
-]
+# --- Одно изображение: краткое описание для объявления (/api/analyze-single) ---
 
-Каждый номер фото должен использоваться только один раз."""
+def single_prompt(run: AnalysisRun, indexes: List[int]) -> str:
+    return """Проанализируйте это изображение товара для создания объявления о продаже. Отвечайте ТОЛЬКО на русском языке.
 
-        try:
-            # Инициализация клиента
-            api_key = os.getenv("ANTHROPIC_API_KEY")
-            if not api_key:
-                logger.error("❌ API ключ Anthropic не настроен!")
-                raise ValueError(
-                    "API ключ Anthropic не настроен в переменных окружения")
+Дайте краткую информацию:
+
+🏷️ ТОВАР:
+- Название товара (максимум 5-7 слов)
+- Основная категория (одежда, техника, мебель, автомобиль и т.д.)
+- Подкатегория товара
+- Основной цвет товара
+
+📝 КРАТКОЕ ОПИСАНИЕ:
+- Материал и состояние (новый/б/у)
+- Бренд (если различимо)
+- 1-2 ключевые особенности
 
-            client = anthropic.Anthropic(
-                api_key=api_key,
-                timeout=120.0,  # Увеличиваем таймаут до 2 минут
-                max_retries=2   # Ограничиваем количество повторных попыток
-            )
-            logger.info(f"✅ API ключ найден: {api_key[:15]}...{api_key[-4:]}")
+Отвечайте кратко и по делу. Фокусируйтесь только на основной информации для объявления."""
 
-            logger.info("🚀 ОТПРАВЛЯЕМ ОСНОВНОЙ ЗАПРОС В CLAUDE API...")
 
-            # Отправляем batch запрос к Claude с оптимальными параметрами для анализа товаров
-            try:
-                message = client.messages.create(
-                    model="claude-sonnet-4-20250514",  # Оставляем эту модель
-                    max_tokens=8192,
-                    temperature=0.3,  # Увеличиваем для более вдумчивого анализа
-                    system="""Ты эксперт по анализу товаров для интернет-магазина. Твоя задача:
+def assemble_single(run: AnalysisRun) -> dict:
+    info = run.file_info[0]
+    description = run.outputs[0]
+    if isinstance(description, Exception):
+        description = f"❌ ОШИБКА АНАЛИЗА {info['filename']}: {description}"
+    return {
+        "result": {
+            "id": f"{info['filename']}_0",
+            "filename": info['filename'],
+            # Временные размеры изображения (без PIL)
+            "width": 800,
+            "height": 600,
+            "size_bytes": info['size'],
+            "image_preview": image_data_url(info),
+            "description": description
+        }
+    }
+
+
+SINGLE_SPEC = AnalysisSpec(
+    "single", prompt=single_prompt, assemble=assemble_single, expect=str,
+    max_tokens=2000, per_image=True, session_prefix="single_", debug="off", hedge=True,
+    priority="interactive")
+
+
+# --- Каждое изображение отдельно, диагностика (/api/analyze-individual) ---
+
+def individual_prompt(run: AnalysisRun, indexes: List[int]) -> str:
+    i = indexes[0]
+    return f"""Опишите что изображено на этой фотографии одним предложением.
+
+Формат ответа:
+"Индекс {i}: [Название товара] - [краткое описание]"
+
+Например: "Индекс 0: Стиральная машина LG - белая стиральная машина с фронтальной загрузкой"
+
+ВЕРНИТЕ ТОЛЬКО ОДНО ПРЕДЛОЖЕНИЕ."""
+
+
+def assemble_individual(run: AnalysisRun) -> dict:
+    descriptions = []
+    for i, (info, output) in enumerate(zip(run.file_info, run.outputs)):
+        descriptions.append({
+            "index": i,
+            "filename": info['filename'],
+            "description": f"Ошибка анализа: {output}" if isinstance(output, Exception) else output
+        })
+    return {
+        "diagnostic_mode": True,
+        "total_images": len(run.file_info),
+        "descriptions": descriptions,
+        "debug_folder": run.debug_folder,
+        "session_id": run.session_id,
+        "image_urls": [blob_url(info['sha256']) for info in run.file_info],
+        "message": "Диагностический анализ завершен - каждое изображение описано отдельно"
+    }
+
+
+INDIVIDUAL_SPEC = AnalysisSpec(
+    "individual", prompt=individual_prompt, assemble=assemble_individual, expect=str,
+    max_tokens=200, per_image=True, debug="force", priority="bulk")
+
+
+# --- Группировка одинаковых товаров (/api/analyze-multiple, /api/analyze-grouping, загрузки по частям) ---
+
+GROUPING_SYSTEM_PROMPT = """Ты эксперт по анализу товаров для интернет-магазина. Твоя задача:
 1. Внимательно изучить каждое изображение
 2. Сгруппировать фотографии одного и того же товара
 3. Определить точные названия, модели, цвета
@@ -1464,178 +3889,534 @@ async def analyze_multiple_images(files: List[UploadFile] = File(...)):
 ❌ НЕ объединяй похожие, но разные товары
 ❌ НЕ игнорируй различия в цвете, размере, модели
 
-Анализируй изображения с максимальной точностью. Группируй только абсолютно идентичные товары.""",
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": [
-                                *image_contents,
-                                {
-                                    "type": "text",
-                                    "text": main_prompt
-                                }
-                            ],
-                        }
-                    ],
-                )
-            except anthropic.APITimeoutError as timeout_error:
-                logger.error(f"❌ ТАЙМАУТ CLAUDE API: {timeout_error}")
-                raise ValueError(
-                    f"Таймаут Claude API (попробуйте позже): {str(timeout_error)}")
-            except anthropic.RateLimitError as rate_error:
-                logger.error(
-                    f"❌ ПРЕВЫШЕН ЛИМИТ ЗАПРОСОВ CLAUDE API: {rate_error}")
-                raise ValueError(
-                    f"Превышен лимит запросов Claude API: {str(rate_error)}")
-            except anthropic.APIError as api_error:
-                logger.error(f"❌ ОШИБКА CLAUDE API: {api_error}")
-                raise ValueError(f"Ошибка Claude API: {str(api_error)}")
-            except Exception as api_error:
-                logger.error(
-                    f"❌ НЕИЗВЕСТНАЯ ОШИБКА ВЫЗОВА CLAUDE API: {api_error}")
-                raise ValueError(
-                    f"Неизвестная ошибка вызова Claude API: {str(api_error)}")
+Анализируй изображения с максимальной точностью. Группируй только абсолютно идентичные товары."""
+
+
+def grouping_prompt(run: AnalysisRun, indexes: List[int]) -> str:
+    return f"""Проанализируй эти {len(indexes)} изображений товаров и сгруппируй ОДИНАКОВЫЕ товары.
+
+СПИСОК ФАЙЛОВ (используйте ТОЧНЫЕ имена файлов):
+{chr(10).join([f"- {filename}" for filename in run.filenames])}
+
+ВАЖНО: Группируй только абсолютно идентичные товары:
+- Одинаковая модель, бренд, артикул
+- Одинаковый цвет и размер
+- Одинаковая комплектация
+- Разные ракурсы одного товара = одна группа
+- Разные модели/цвета = разные группы
+- ИСПОЛЬЗУЙТЕ ТОЧНЫЕ ИМЕНА ФАЙЛОВ из списка выше
+
+{category_prompt_section([run.description or ""] + run.filenames)}
+
+Верни результат в JSON формате:
+[
+  {{
+    "group_id": 1,
+    "title": "Точное название товара с моделью",
+    "category": "Категория",
+    "subcategory": "Подкатегория",
+    "color": "основной цвет",
+    "reasoning": "Почему эти фото в одной группе",
+    "image_filenames": ["точное_имя_файла1.jpg", "точное_имя_файла2.jpg"],
+    "description": "Подробное описание товара"
+  }}
+]
+
+Каждое имя файла должно использоваться только один раз."""
+
+
+def assemble_grouping(run: AnalysisRun) -> dict:
+    results = process_claude_results_with_filenames(
+        run.outputs[0], run.image_batch, run.file_info)
+
+    # Запоминаем группы, чтобы правки пользователя не требовали полного повторного анализа
+    grouping_session_writer.submit(run.session_id, run.file_info, results)
+
+    return {
+        "results": results,
+        "processed_count": len(results),
+        "total_files": run.total_files,
+        "grouped": True,
+        "debug_folder": run.debug_folder,
+        "session_id": run.session_id,
+        "summary": {
+            "total_images": run.total_files,
+            "processed_images": len(run.file_info),
+            "grouped_products": len(results)
+        }
+    }
+
+
+def assemble_grouping_diagnostic(run: AnalysisRun) -> dict:
+    return {
+        "diagnostic_mode": "grouping",
+        "total_images": len(run.file_info),
+        "groups": process_claude_results_with_filenames(
+            run.outputs[0], run.image_batch, run.file_info),
+        "raw_response": run.response_text,
+        "debug_folder": run.debug_folder,
+        "session_id": run.session_id,
+        "file_order": [{"index": i, "filename": filename} for i, filename in enumerate(run.filenames)],
+        "image_urls": [blob_url(info['sha256']) for info in run.file_info],
+        "message": "Диагностика группировки завершена"
+    }
+
+
+GROUPING_SPEC = AnalysisSpec(
+    "grouping", prompt=grouping_prompt, assemble=assemble_grouping,
+    system=GROUPING_SYSTEM_PROMPT, temperature=0.3, session_prefix="main_", priority="grouping")
+
+GROUPING_DIAGNOSTIC_SPEC = AnalysisSpec(
+    "grouping_diagnostic", prompt=grouping_prompt, assemble=assemble_grouping_diagnostic,
+    system=GROUPING_SYSTEM_PROMPT, temperature=0.3, session_prefix="diag_", debug="force",
+    priority="grouping")
+
+
+# --- Повторный анализ измененных групп (/api/sessions/{id}/reanalyze) ---
+# run.context: record - сохраненная группировка, groups - измененные группы,
+# to_analyze - те из них, что идут в Claude, removed - id опустевших групп,
+# hints - подсказки для выбора категорий, changed_hashes - перенесенные фото
+
+def reanalyze_calls(run: AnalysisRun) -> List[List[int]]:
+    """Один вызов Claude на все новые группы; группы с прежним составом фото в него не входят"""
+    sha_to_index = {info['sha256']: i for i, info in enumerate(run.file_info)}
+    indexes = [sha_to_index[sha256] for group in run.context["to_analyze"] for sha256 in group["image_hashes"]]
+    return [indexes] if indexes else []
+
+
+def reanalyze_prompt(run: AnalysisRun, indexes: List[int]) -> str:
+    group_lines, start = [], 0
+    for group_number, group in enumerate(run.context["to_analyze"], 1):
+        end = start + len(group["image_hashes"])
+        group_lines.append(f"- group_id {group_number}: изображения {start}..{end - 1}")
+        start = end
+    return f"""Пользователь уже разложил фотографии по товарам вручную. Изображения пронумерованы от 0 до {len(indexes)-1}, группы:
+{chr(10).join(group_lines)}
+
+Не меняй состав групп.
+
+{category_prompt_section(run.context["hints"])}
+
+Для каждой группы определи товар и верни JSON:
+[
+  {{
+    "group_id": 1,
+    "title": "Точное название товара с моделью",
+    "category": "Категория",
+    "subcategory": "Подкатегория",
+    "color": "основной цвет",
+    "description": "Подробное описание товара"
+  }}
+]"""
+
+
+def assemble_reanalyze(run: AnalysisRun) -> dict:
+    record, groups, to_analyze = run.context["record"], run.context["groups"], run.context["to_analyze"]
+    by_number = {}
+    for item in (run.outputs[0] if run.outputs else []):
+        try:
+            by_number[int(item.get("group_id"))] = item
+        except (TypeError, ValueError, AttributeError):
+            continue
+    for group_number, group in enumerate(to_analyze, 1):
+        item = by_number.get(group_number, {})
+        for field in ("title", "category", "subcategory", "color"):
+            group[field] = item.get(field) or group.get(field, "")
+
+    # Ответ в том же формате, что и у analyze-multiple
+    filenames = {info['sha256']: info['filename'] for info in run.file_info}
+    products = [{**group, "image_filenames": [filenames[sha256] for sha256 in group["image_hashes"]]}
+                for group in groups]
+    results = process_claude_results_with_filenames(products, run.image_batch, run.file_info)
+    for group, result in zip(groups, results):
+        result["id"] = group["id"]
+
+    # Обновляем сохраненные группы: перенесенные фото убираем из прежних групп
+    changed_hashes = set(run.context["changed_hashes"])
+    updated_ids = {group["id"] for group in groups} | set(run.context["removed"])
+    kept = []
+    for group in record["groups"]:
+        if group["id"] in updated_ids:
+            continue
+        group["image_hashes"] = [sha256 for sha256 in group["image_hashes"] if sha256 not in changed_hashes]
+        if group["image_hashes"]:
+            kept.append(group)
+    record["groups"] = kept + [group_record(result) for result in results]
+    save_grouping_session(record)
+
+    return {
+        "session_id": run.session_id,
+        "results": results,
+        "removed": run.context["removed"],
+        "reanalyzed_groups": len(to_analyze),
+        "reused_groups": len(groups) - len(to_analyze)
+    }
+
+
+# Пользователь правит группы в интерфейсе и ждет ответ - как анализ одного фото
+REANALYZE_SPEC = AnalysisSpec(
+    "reanalyze", prompt=reanalyze_prompt, assemble=assemble_reanalyze, calls=reanalyze_calls,
+    max_tokens=4096, temperature=0.3, debug="off", priority="interactive")
+
+
+# --- Детальный анализ одного товара (/api/analyze-product-detailed) ---
+
+DETAILED_SYSTEM_PROMPT = """Ты эксперт по анализу товаров для интернет-магазина. Твоя задача - создать максимально подробное и точное описание товара на основе фотографий.
+
+Принципы анализа:
+- Внимательно изучай каждую деталь на фотографиях
+- Читай все видимые надписи, этикетки, бирки
+- Определяй бренд, модель, технические характеристики
+- Оценивай состояние и выявляй дефекты
+- Анализируй материалы, цвета, размеры
+- Определяй комплектность и аксессуары
+- Предлагай ключевые слова для поиска
+- Создавай привлекательное описание для покупателей
+
+Будь максимально точным и детальным в анализе."""
+
+
+def detailed_prompt(run: AnalysisRun, indexes: List[int]) -> str:
+    return f"""Проанализируй эти {len(indexes)} фотографий ОДНОГО товара и заполни максимально подробную информацию.
+
+ЗАДАЧА: Создать детальное описание товара для объявления на сайте Somon.tj
+
+{category_prompt_section(run.filenames)}
+
+Верни результат в JSON формате:
+{{
+  "title": "Точное название товара с брендом и моделью",
+  "brand": "Бренд/производитель",
+  "model": "Модель/артикул",
+  "category": "Основная категория",
+  "subcategory": "Подкатегория",
+  "condition": "Состояние (новый/б/у/отличное/хорошее/удовлетворительное)",
+  "color": "Основной цвет",
+  "material": "Материал изготовления",
+  "size": "Размер/габариты",
+  "weight": "Вес (если видно)",
+  "year": "Год выпуска (если определим)",
+  "country": "Страна производства (если видно)",
+  "features": ["список", "ключевых", "особенностей", "и", "функций"],
+  "included": ["что", "входит", "в", "комплект"],
+  "defects": ["видимые", "дефекты", "или", "износ"],
+  "description": "Подробное описание товара для объявления",
+  "keywords": ["ключевые", "слова", "для", "поиска"],
+  "estimated_price_range": "Примерная ценовая категория",
+  "target_audience": "Целевая аудитория",
+  "usage_tips": "Советы по использованию",
+  "care_instructions": "Инструкции по уходу",
+  "compatibility": "Совместимость с другими товарами",
+  "technical_specs": {{
+    "spec1": "значение1",
+    "spec2": "значение2"
+  }},
+  "photo_analysis": {{
+    "main_photo": "номер лучшего фото для главного изображения (0-{len(indexes)-1})",
+    "photo_descriptions": ["описание фото 0", "описание фото 1", "..."]
+  }}
+}}
+
+ВАЖНО:
+- Анализируй ВСЕ детали на фотографиях
+- Читай все надписи, этикетки, бирки
+- Определяй технические характеристики
+- Оценивай состояние и дефекты
+- Предлагай лучшее фото для главного изображения
+- Если информация не видна, указывай "не определено"
+"""
+
+
+def assemble_detailed(run: AnalysisRun) -> dict:
+    product_data = normalize_product_categories(run.outputs[0])
+    product_images = [{
+        "index": i,
+        "filename": info['filename'],
+        "data": image_data_url(info),
+        "size": info['size']
+    } for i, info in enumerate(run.file_info)]
+
+    logger.info(
+        f"✅ Детальный анализ завершен: {product_data.get('title', 'Товар')}")
+    return {
+        "product": product_data,
+        "images": product_images,
+        "total_images": len(product_images),
+        "debug_folder": run.debug_folder,
+        "session_id": run.session_id
+    }
+
+
+DETAILED_SPEC = AnalysisSpec(
+    "detailed", prompt=detailed_prompt, assemble=assemble_detailed, expect=dict,
+    system=DETAILED_SYSTEM_PROMPT, temperature=0.1, session_prefix="detailed_", priority="detailed")
+
+
+@app.get("/", response_class=HTMLResponse)
+async def root(request: Request):
+    """Главная страница с React приложением"""
+    try:
+        return static_page_response(request, 'static/index.html')
+    except Exception as e:
+        logger.error(f"Ошибка загрузки главной страницы: {e}")
+        return HTMLResponse("""
+        <!DOCTYPE html>
+        <html>
+        <head><title>Ошибка</title></head>
+        <body>
+            <h1>Ошибка загрузки</h1>
+            <p>Файл index.html не найден</p>
+            <p>Убедитесь что файл static/index.html существует</p>
+        </body>
+        </html>
+        """, status_code=500)
+
+
+@app.post("/api/analyze-single")
+async def analyze_single_image(request: Request, file: UploadFile = File(...)):
+    """Анализ одного изображения"""
+    try:
+        logger.info(
+            f"📥 Получен файл для анализа: {file.filename}, тип: {file.content_type}")
+        return await run_analysis(SINGLE_SPEC, await ingest_uploads([file]), request=request)
+
+    except Exception as e:
+        return analysis_error_response(e, "анализа одного изображения")
+
+
+@app.post("/api/analyze-grouping")
+async def analyze_grouping_diagnostic(request: Request, files: List[UploadFile] = File(...)):
+    """ДИАГНОСТИКА ГРУППИРОВКИ: показывает как Claude группирует изображения"""
+    try:
+        logger.info(f"🔍 ДИАГНОСТИКА ГРУППИРОВКИ: Получено {len(files)} файлов")
+        return await run_analysis(
+            GROUPING_DIAGNOSTIC_SPEC, await ingest_uploads(files), len(files), request=request)
+
+    except Exception as e:
+        return analysis_error_response(e, "диагностики группировки")
+
+
+@app.post("/api/analyze-individual")
+async def analyze_individual_images(request: Request, files: List[UploadFile] = File(...)):
+    """ДИАГНОСТИЧЕСКИЙ эндпоинт: анализ каждого изображения отдельно"""
+    try:
+        logger.info(
+            f"🔍 ДИАГНОСТИКА: Получено {len(files)} файлов для индивидуального анализа")
+        return await run_analysis(
+            INDIVIDUAL_SPEC, await ingest_uploads(files), len(files), request=request)
+
+    except Exception as e:
+        return analysis_error_response(e, "диагностического анализа")
+
+
+@app.post("/api/analyze-multiple")
+async def analyze_multiple_images(request: Request, files: List[UploadFile] = File(...),
+                                  description: Optional[str] = Form(None)):
+    """Основная функция группировки товаров - использует проверенную логику диагностики"""
+    try:
+        logger.info(f"🔍 ОСНОВНАЯ ГРУППИРОВКА: Получено {len(files)} файлов")
+        return await run_analysis(
+            GROUPING_SPEC, await ingest_uploads(files), len(files), description=description,
+            request=request)
 
-            # Проверяем что ответ содержит контент
-            if not message.content or len(message.content) == 0:
-                logger.error("❌ ПУСТОЙ CONTENT В ОТВЕТЕ CLAUDE!")
-                raise ValueError("Claude вернул пустой content")
+    except Exception as e:
+        return analysis_error_response(e, "основного анализа")
+
+
+@app.post("/api/uploads")
+async def create_upload_session(request: Request):
+    """Создает сессию загрузки по частям; уже известные серверу файлы сразу помечаются готовыми"""
+    try:
+        payload = await request.json()
+        files, errors = parse_declared_files(payload.get("files") or [])
+        if not files:
+            return JSONResponse({
+                "success": False,
+                "error": "Нет валидных файлов для загрузки",
+                "details": errors
+            }, status_code=400)
+
+        manifest = {
+            "upload_id": f"up_{int(time.time())}_{secrets.token_hex(4)}",
+            "created": time.time(),
+            "trace_id": get_trace_id(),
+            "files": files
+        }
+        await asyncio.to_thread(save_upload_session, manifest)
+        session = describe_upload_session(manifest)
+        logger.info(
+            f"📥 Сессия загрузки {manifest['upload_id']}: {len(files)} файлов, "
+            f"{session['complete_files']} уже есть на сервере")
+        return JSONResponse({"success": True, **session, "rejected": errors})
+    except Exception as e:
+        logger.error(f"❌ Ошибка создания сессии загрузки: {e}")
+        return JSONResponse({"success": False, "error": str(e)}, status_code=500)
+
+
+@app.get("/api/uploads/{upload_id}")
+async def get_upload_session(upload_id: str):
+    """Состояние сессии загрузки: сколько байт каждого файла уже получено"""
+    manifest = load_upload_session(upload_id)
+    if not manifest:
+        return JSONResponse({"success": False, "error": "Сессия загрузки не найдена"}, status_code=404)
+    return JSONResponse({"success": True, **describe_upload_session(manifest)})
+
+
+@app.put("/api/uploads/{upload_id}/files/{sha256}")
+async def upload_file_chunk(upload_id: str, sha256: str, request: Request, offset: int = 0):
+    """Принимает очередную часть файла (сырое тело запроса, начиная с offset)"""
+    manifest = load_upload_session(upload_id)
+    if not manifest:
+        return JSONResponse({"success": False, "error": "Сессия загрузки не найдена"}, status_code=404)
+    entry = next((item for item in manifest["files"] if item["sha256"] == sha256), None)
+    if not entry:
+        return JSONResponse({"success": False, "error": "Файл не объявлен в сессии"}, status_code=404)
+
+    # Тело читаем потоком и прекращаем, как только оно превысило предел
+    limit = UPLOAD_CHUNK_SIZE * 2
+    too_large = JSONResponse({"success": False, "error": "Слишком большая часть файла"}, status_code=413)
+    if int(request.headers.get("content-length", 0) or 0) > limit:
+        return too_large
+    chunk = bytearray()
+    async for part in request.stream():
+        chunk += part
+        if len(chunk) > limit:
+            return too_large
 
-            response_text = message.content[0].text
-            logger.info(
-                f"✅ ПОЛУЧЕН ОСНОВНОЙ ОТВЕТ! Длина: {len(response_text)} символов")
-            logger.info(f"🔍 ПОЛНЫЙ ОТВЕТ: {response_text}")
+    try:
+        status = await asyncio.to_thread(append_upload_chunk, upload_id, entry, offset, chunk)
+    except UploadNotImage as e:
+        logger.warning(f"⚠️ Загрузка {upload_id}/{sha256[:12]}: {e}")
+        return JSONResponse({"success": False, "error": str(e)}, status_code=415)
+    except ValueError as e:
+        # Клиент продолжит с того места, которое сервер действительно получил
+        current = upload_file_status(upload_id, entry)
+        logger.warning(f"⚠️ Загрузка {upload_id}/{sha256[:12]}: {e}")
+        return JSONResponse({
+            "success": False,
+            "error": str(e),
+            "received": current["received"],
+            "complete": current["complete"]
+        }, status_code=409)
+    return JSONResponse({"success": True, "received": status["received"], "complete": status["complete"]})
 
-            # Проверяем что ответ не пустой
-            if not response_text or not response_text.strip():
-                logger.error("❌ ПУСТОЙ ОТВЕТ ОТ CLAUDE!")
-                raise ValueError("Claude вернул пустой ответ")
 
-            # Проверяем что ответ не является HTML (ошибка сети)
-            if response_text.strip().startswith('<'):
-                logger.error(
-                    "❌ ПОЛУЧЕН HTML ВМЕСТО JSON! Возможно ошибка сети или перегрузка API")
-                logger.error(f"🔍 HTML ответ: {response_text[:500]}...")
-                raise ValueError(
-                    "Claude вернул HTML вместо JSON (ошибка сети или перегрузка API)")
-
-            # Парсим JSON ответ - ИСПРАВЛЕННАЯ ЛОГИКА ИЗВЛЕЧЕНИЯ ИЗ MARKDOWN
-            if response_text.strip().startswith('```'):
-                # Извлекаем JSON из markdown блока
-                lines = response_text.strip().split('\n')
-                json_lines = []
-                in_json = False
-                for line in lines:
-                    if line.strip() == '```json' or (line.strip() == '```' and in_json):
-                        in_json = not in_json
-                        continue
-                    if in_json:  # ИСПРАВЛЕНО: добавляем строки ТОЛЬКО когда внутри JSON блока
-                        json_lines.append(line)
-                response_text = '\n'.join(json_lines)
-                logger.info(
-                    f"🔧 Извлечен JSON из markdown блока, новая длина: {len(response_text)}")
-                # Показываем первые 200 символов
-                logger.info(f"🔧 Извлеченный JSON: {response_text[:200]}...")
-            else:
-                # Если нет markdown блоков, пытаемся найти JSON в тексте
-                # Ищем первый '[' и последний ']' для извлечения JSON массива
-                start_idx = response_text.find('[')
-                end_idx = response_text.rfind(']')
-                if start_idx != -1 and end_idx != -1 and end_idx > start_idx:
-                    response_text = response_text[start_idx:end_idx+1]
-                    logger.info(
-                        f"🔧 Извлечен JSON без markdown, длина: {len(response_text)}")
-                    logger.info(
-                        f"🔧 Извлеченный JSON: {response_text[:200]}...")
-
-            # Проверяем что после извлечения из markdown у нас есть контент
-            if not response_text.strip():
-                logger.error("❌ ПУСТОЙ JSON ПОСЛЕ ИЗВЛЕЧЕНИЯ ИЗ MARKDOWN!")
-                raise ValueError("Не удалось извлечь JSON из ответа Claude")
-
-            # ДЕТАЛЬНАЯ ДИАГНОСТИКА ПЕРЕД ПАРСИНГОМ JSON
-            logger.info(f"🔍 ФИНАЛЬНАЯ ДИАГНОСТИКА JSON:")
-            logger.info(f"  📏 Длина: {len(response_text)}")
-            logger.info(f"  🔤 Первые 10 символов: {repr(response_text[:10])}")
-            logger.info(
-                f"  🔤 Последние 10 символов: {repr(response_text[-10:])}")
-            logger.info(f"  ✂️ После strip(): {len(response_text.strip())}")
-            logger.info(
-                f"  🎯 Начинается с '[': {response_text.strip().startswith('[')}")
-            logger.info(
-                f"  🎯 Заканчивается на ']': {response_text.strip().endswith(']')}")
+@app.post("/api/uploads/{upload_id}/analyze")
+async def analyze_upload_session(upload_id: str, request: Request):
+    """Группировка товаров по файлам, загруженным в сессию"""
+    try:
+        # Необязательное тело: {"description": "что продает пользователь"}
+        try:
+            payload = await request.json()
+        except ValueError:
+            payload = {}
+        description = payload.get("description") if isinstance(payload, dict) else None
+
+        manifest = load_upload_session(upload_id)
+        if not manifest:
+            return JSONResponse({"success": False, "error": "Сессия загрузки не найдена"}, status_code=404)
+
+        session = describe_upload_session(manifest)
+        if not session["ready"]:
+            missing = [entry["name"] for entry in session["files"] if not entry["complete"]]
+            return JSONResponse({
+                "success": False,
+                "error": f"Загружены не все файлы ({session['complete_files']}/{session['total_files']})",
+                "missing": missing
+            }, status_code=409)
 
-            # Попытка парсинга с детальной диагностикой
-            try:
-                products = json.loads(response_text)
-                logger.info(
-                    f"✅ JSON успешно распарсен! Тип: {type(products)}, длина: {len(products) if isinstance(products, list) else 'не список'}")
-            except json.JSONDecodeError as json_error:
-                logger.error(f"❌ ОШИБКА JSON ПАРСИНГА: {json_error}")
-                logger.error(
-                    f"🔍 Позиция ошибки: строка {json_error.lineno}, колонка {json_error.colno}")
-                logger.error(
-                    f"🔍 Проблемный фрагмент: {repr(response_text[max(0, json_error.pos-20):json_error.pos+20])}")
-                raise
+        logger.info(f"🔍 ГРУППИРОВКА ПО СЕССИИ ЗАГРУЗКИ {upload_id}: {session['total_files']} файлов")
+        set_span_attributes(**{"upload.id": upload_id})
+        await admit_blobs([entry["sha256"] for entry in manifest["files"]])
+        file_info = await asyncio.to_thread(
+            ingest_blobs, [(entry["sha256"], entry["name"]) for entry in manifest["files"]])
 
-            if not isinstance(products, list):
-                raise ValueError("Ответ Claude не является списком")
+        return await run_analysis(
+            GROUPING_SPEC, file_info, session["total_files"], session_id=upload_id,
+            description=description, request=request)
 
-            # Используем новую функцию для обработки результатов с именами файлов
-            results = process_claude_results_with_filenames(
-                products, image_batch, file_info)
+    except Exception as e:
+        return analysis_error_response(e, "анализа сессии загрузки")
 
-            return JSONResponse({
-                "success": True,
-                "results": results,
-                "processed_count": len(results),
-                "total_files": len(files),
-                "grouped": True,
-                "debug_folder": debug_folder,
-                "session_id": session_id,
-                "summary": {
-                    "total_images": len(files),
-                    "processed_images": len(file_info),
-                    "grouped_products": len(results)
-                }
-            })
 
-        except (json.JSONDecodeError, ValueError) as e:
-            logger.error(f"❌ КРИТИЧЕСКАЯ ОШИБКА ПАРСИНГА JSON: {e}")
-            logger.error(f"🔍 ПОЛНЫЙ ОТВЕТ CLAUDE: {response_text}")
-            logger.error(f"🔍 ТИП ОТВЕТА: {type(response_text)}")
-            logger.error(f"🔍 ДЛИНА ОТВЕТА: {len(response_text)} символов")
+@app.post("/api/sessions/{session_id}/reanalyze")
+async def reanalyze_changed_groups(session_id: str, request: Request):
+    """Повторный анализ только тех групп, которые пользователь изменил (перенос фото между товарами)"""
+    try:
+        record = load_grouping_session(session_id)
+        if not record and grouping_session_writer.pending():
+            # Группировка могла только что завершиться - ее запись еще в очереди
+            await asyncio.to_thread(grouping_session_writer.flush, 5.0)
+            record = load_grouping_session(session_id)
+        if not record:
+            return JSONResponse({"success": False, "error": "Сессия не найдена или устарела"}, status_code=404)
+
+        payload = await request.json()
+        changed = [group for group in payload.get("groups") or [] if isinstance(group, dict)]
+        if not changed:
+            return JSONResponse({"success": False, "error": "Нет измененных групп"}, status_code=400)
+
+        # Прежние названия затронутых групп подсказывают вероятные категории
+        hints = [payload.get("description") or ""]
+        hints += [group.get("title", "") for group in record["groups"]
+                  if set(group["image_hashes"]) & {sha256 for item in changed for sha256 in item.get("image_hashes") or []}]
+
+        unknown = {sha256 for group in changed for sha256 in group.get("image_hashes") or []
+                   if sha256 not in record["images"]}
+        if unknown:
             return JSONResponse({
                 "success": False,
-                "error": f"Ошибка парсинга JSON от Claude: {str(e)}",
-                "raw_response": response_text,
-                "debug_folder": debug_folder,
-                "session_id": session_id
-            }, status_code=500)
+                "error": f"Изображения не относятся к сессии: {len(unknown)}"
+            }, status_code=400)
+
+        set_span_attributes(**{"session.id": session_id, "group.changed": len(changed)})
+        stored_by_images = {frozenset(group["image_hashes"]): group for group in record["groups"]}
+        changed_hashes = {sha256 for group in changed for sha256 in group.get("image_hashes") or []}
+
+        # Группа, собранная заново из тех же фото, что и раньше, в Claude не отправляется
+        groups, to_analyze, removed = [], [], []
+        for group in changed:
+            image_hashes = list(dict.fromkeys(group.get("image_hashes") or []))
+            group_id = str(group.get("id") or f"product_{len(record['groups']) + len(groups)}_{int(time.time())}")
+            if not image_hashes:
+                removed.append(group_id)
+                continue
+            previous = stored_by_images.get(frozenset(image_hashes))
+            entry = {**(previous or {}), "id": group_id, "image_hashes": image_hashes}
+            groups.append(entry)
+            if not previous:
+                to_analyze.append(entry)
+
+        logger.info(
+            f"🔁 ПОВТОРНЫЙ АНАЛИЗ {session_id}: изменено {len(changed)} групп, "
+            f"в Claude {len(to_analyze)}, из кэша {len(groups) - len(to_analyze)}, удалено {len(removed)}")
+
+        # Изображения всех затронутых групп (нужны и для ответа, и для Claude)
+        await admit_blobs([sha256 for group in groups for sha256 in group["image_hashes"]])
+        file_info = await asyncio.to_thread(
+            ingest_blobs, [(sha256, record["images"][sha256]) for group in groups for sha256 in group["image_hashes"]])
+
+        return await run_analysis(
+            REANALYZE_SPEC, file_info, session_id=session_id, request=request, context={
+                "record": record, "groups": groups, "to_analyze": to_analyze, "removed": removed,
+                "hints": hints, "changed_hashes": sorted(changed_hashes)})
 
     except Exception as e:
-        logger.error(
-            f"❌ Ошибка основного анализа: {e}\n{traceback.format_exc()}")
-        return JSONResponse({
-            "success": False,
-            "error": f"Ошибка сервера: {str(e)}"
-        }, status_code=500)
+        return analysis_error_response(e, f"повторного анализа {session_id}")
 
 
 @app.get("/api/health")
 async def health_check():
     """Проверка работоспособности API"""
-    api_key = os.getenv("ANTHROPIC_API_KEY")
+    api_keys = configured_api_keys()
+    api_key = api_keys[0] if api_keys else None
 
     # Проверяем доступность Claude API
     claude_status = "unknown"
     try:
         if api_key:
-            client = anthropic.Anthropic(
-                api_key=api_key,
-                timeout=60.0
-            )
-            # Не делаем реальный запрос, просто проверяем что клиент создается
+            # Не делаем реальный запрос, просто проверяем что клиенты создаются
+            get_claude_pool()
             claude_status = "configured"
     except Exception as e:
         claude_status = f"error: {str(e)}"
@@ -1648,19 +4429,91 @@ async def health_check():
             "debug_images": os.path.exists(os.path.join(STORAGE_BASE, "debug_images")),
             "logs": os.path.exists(os.path.join(STORAGE_BASE, "logs")),
             "uploads": os.path.exists(os.path.join(STORAGE_BASE, "uploads"))
+        },
+        "debug_files": {
+            "enabled": DEBUG_FILES_ENABLED,
+            "sample_rate": DEBUG_SAMPLE_RATE,
+            "persist_failures": DEBUG_PERSIST_FAILURES,
+            "pending": debug_file_writer.pending(),
+            "pending_bytes": debug_file_writer.pending_bytes,
+            "max_pending_bytes": debug_file_writer.max_pending_bytes,
+            **debug_file_writer.stats
+        },
+        "debug_store": {
+            **debug_store_stats,
+            "retention_days": DEBUG_RETENTION_DAYS,
+            "compact_after_days": DEBUG_COMPACT_AFTER_DAYS
         }
     }
 
+    # Заполненность тома с постоянным диском
+    try:
+        total, used, free = shutil.disk_usage(STORAGE_BASE)
+        disk_status["volume"] = {
+            "total_gb": round(total / (1024**3), 2),
+            "used_gb": round(used / (1024**3), 2),
+            "free_gb": round(free / (1024**3), 2),
+            "used_pct": round(used / total * 100, 1)
+        }
+    except OSError as e:
+        disk_status["volume"] = {"error": str(e)}
+
     return JSONResponse({
         "status": "healthy",
         "api_key_configured": bool(api_key),
-        "api_key_preview": f"{api_key[:10]}...{api_key[-4:]}" if api_key else None,
+        "api_key_preview": mask_api_key(api_key) if api_key else None,
+        "api_key_count": len(api_keys),
         "claude_status": claude_status,
         "disk_status": disk_status,
+        "analysis_inflight": analysis_flights.snapshot(),
         "message": "🚀 Somon.tj API работает!"
     })
 
 
+@app.get("/api/metrics")
+async def metrics():
+    """Метрики: вызовы Claude (время ответа, повторы, хеджирование), дедлайны, очередь по памяти"""
+    return JSONResponse({
+        "success": True,
+        "claude": {
+            "latency_seconds": claude_latency.snapshot(),
+            "retries": claude_retry_stats,
+            "scheduler": claude_scheduler.snapshot(),
+            "keys": claude_pool_metrics(),
+            "hedging": hedge_metrics()
+        },
+        "deadline": {
+            "default_seconds": REQUEST_DEADLINE_SECONDS,
+            "max_seconds": REQUEST_DEADLINE_MAX_SECONDS,
+            **deadline_stats
+        },
+        "admission": memory_budget.snapshot(),
+        "usage_ledger": usage_ledger.stats,
+        "grouping_sessions": {
+            "enabled": GROUPING_SESSIONS_ENABLED,
+            "pending": grouping_session_writer.pending(),
+            "pending_bytes": grouping_session_writer.pending_bytes,
+            **grouping_session_writer.stats
+        },
+        "analysis_inflight": analysis_flights.snapshot()
+    })
+
+
+@app.get("/api/usage")
+async def usage(days: int = 7, endpoint: Optional[str] = None):
+    """Расход Claude из журнала: вызовы, фото, токены, время и стоимость по дням и эндпоинтам"""
+    days = max(1, min(days, USAGE_REPORT_MAX_DAYS))
+    try:
+        return JSONResponse({"success": True, **await asyncio.to_thread(usage_report, days, endpoint)})
+    except sqlite3.Error as e:
+        logger.error(f"❌ Ошибка чтения журнала расхода Claude: {e}")
+        return JSONResponse({
+            "success": False,
+            "error": f"Журнал расхода недоступен: {str(e)}",
+            "trace_id": get_trace_id()
+        }, status_code=500)
+
+
 @app.get("/api/test")
 async def test_endpoint():
     """Простой тестовый эндпоинт"""
@@ -1672,30 +4525,221 @@ async def test_endpoint():
 
 
 @app.get("/api/categories")
-async def get_categories():
-    """Получить структуру категорий Somon.tj"""
+async def get_categories(request: Request):
+    """Получить структуру категорий Somon.tj (готовый ответ из памяти, с ETag)"""
+    return taxonomy.refresh().api_asset.response(request)
+
+
+@app.get("/api/upload-config")
+async def get_upload_config():
+    """Параметры предобработки изображений в браузере перед загрузкой"""
+    return JSONResponse({
+        "success": True,
+        "max_dimension": CLAUDE_MAX_IMAGE_SIZE,
+        "mime_type": UPLOAD_IMAGE_MIME_TYPE,
+        "quality": UPLOAD_IMAGE_QUALITY
+    }, headers={"Cache-Control": "public, max-age=300"})
+
+
+# ===== Допуск запросов по бюджету памяти =====
+# Пакетный запрос держит в памяти все загруженные файлы, а при уменьшении -
+# еще и декодированные пиксели. Несколько одновременных загрузок по 50 фото
+# на маленьком инстансе заканчивались OOM. Поэтому перед ingest запрос
+# оценивает свою память по заголовкам изображений (без декодирования): байты
+# файлов + самое большое декодированное изображение (preprocess идет по одному).
+# Оценка резервируется в общем на процесс бюджете MEMORY_BUDGET_MB и
+# освобождается, когда тело ответа отправлено. Если бюджета не хватает, запрос
+# ждет в очереди (FIFO) не дольше ADMISSION_MAX_WAIT_SECONDS и своего дедлайна;
+# при полной очереди или истекшем ожидании - 429 с Retry-After.
+MEMORY_BUDGET_BYTES = int(float(os.getenv("MEMORY_BUDGET_MB", "256")) * 1024 * 1024)
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "8"))
+ADMISSION_MAX_WAIT_SECONDS = float(os.getenv("ADMISSION_MAX_WAIT_SECONDS", "30"))
+# Retry-After, пока нет замеров, сколько запросы держат память
+ADMISSION_DEFAULT_RETRY_AFTER = 10
+
+
+class AdmissionRejected(Exception):
+    """Бюджет памяти занят: запрос не принят, клиенту - повторить через retry_after секунд"""
+
+    def __init__(self, reason: str, retry_after: int):
+        self.retry_after = retry_after
+        super().__init__(reason)
+
+
+class MemoryBudget:
+    """Общий на процесс бюджет байт под изображения запросов с очередью ожидания"""
+
+    def __init__(self, capacity: int, max_queue: int):
+        self.capacity = capacity
+        self.max_queue = max_queue
+        self.used = 0
+        self.waiters = deque()
+        # Время ожидания в очереди и время удержания памяти - распределения для метрик
+        self.timings = LatencyTracker(CLAUDE_LATENCY_WINDOW)
+        self.stats = {"admitted": 0, "queued": 0, "rejected_queue_full": 0, "rejected_timeout": 0}
+
+    def retry_after(self) -> int:
+        held = self.timings.percentile("hold", 50)
+        return max(1, math.ceil(held)) if held is not None else ADMISSION_DEFAULT_RETRY_AFTER
+
+    async def acquire(self, nbytes: int, timeout: float) -> int:
+        """Резервирует nbytes (ожидая не дольше timeout); возвращает зарезервированный объем"""
+        # Запрос больше всего бюджета выполняется, когда остальные освободят память
+        nbytes = min(nbytes, self.capacity)
+        if not self.waiters and self.used + nbytes <= self.capacity:
+            self.used += nbytes
+            self.stats["admitted"] += 1
+            self.timings.record("wait", 0.0)
+            return nbytes
+
+        if len(self.waiters) >= self.max_queue:
+            self.stats["rejected_queue_full"] += 1
+            raise AdmissionRejected(
+                f"Сервер занят обработкой других загрузок (в очереди {len(self.waiters)})", self.retry_after())
+
+        self.stats["queued"] += 1
+        waiter = (nbytes, asyncio.get_running_loop().create_future())
+        self.waiters.append(waiter)
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(waiter[1], timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as error:
+            if waiter[1].done() and not waiter[1].cancelled():
+                self.release(nbytes)  # память выдали одновременно с отменой
+            elif waiter in self.waiters:
+                self.waiters.remove(waiter)
+                self._wake()  # ушедший первым в очереди мог задерживать остальных
+            if isinstance(error, asyncio.CancelledError):
+                raise
+            self.stats["rejected_timeout"] += 1
+            raise AdmissionRejected(
+                f"Не дождались свободной памяти за {timeout:.1f}с", self.retry_after())
+        self.stats["admitted"] += 1
+        self.timings.record("wait", time.monotonic() - started)
+        return nbytes
+
+    def release(self, nbytes: int):
+        self.used -= nbytes
+        self._wake()
+
+    def _wake(self):
+        while self.waiters and self.used + self.waiters[0][0] <= self.capacity:
+            nbytes, future = self.waiters.popleft()
+            if future.done():
+                continue
+            self.used += nbytes
+            future.set_result(None)
+
+    def snapshot(self) -> dict:
+        return {
+            "budget_bytes": self.capacity,
+            "used_bytes": self.used,
+            "queue_depth": len(self.waiters),
+            "queued_bytes": sum(nbytes for nbytes, _ in self.waiters),
+            **self.stats,
+            "seconds": self.timings.snapshot()
+        }
+
+
+# Состояние меняется только из цикла событий - без блокировок
+memory_budget = MemoryBudget(MEMORY_BUDGET_BYTES, ADMISSION_MAX_QUEUE)
+_admission_lease: contextvars.ContextVar[Optional[list]] = contextvars.ContextVar(
+    "admission_lease", default=None)
+
+
+def image_memory_estimate(source) -> tuple[int, int]:
+    """(байт файла, байт пикселей при уменьшении) - по заголовку, без декодирования"""
+    if isinstance(source, str):
+        raw = os.path.getsize(source)
+    else:
+        raw = source.seek(0, os.SEEK_END)
+        source.seek(0)
     try:
-        categories = load_categories_from_file()
-        return JSONResponse({
-            "success": True,
-            "categories": categories,
-            "total_categories": len(categories),
-            "message": "Категории успешно загружены"
-        })
-    except Exception as e:
-        logger.error(f"Ошибка получения категорий: {e}")
-        return JSONResponse({
-            "success": False,
-            "error": str(e),
-            "categories": {}
-        }, status_code=500)
+        with Image.open(source) as image:
+            width, height = image.size
+            scale = min(1.0, CLAUDE_MAX_IMAGE_SIZE / max(width, height))
+            target = (max(1, int(width * scale)), max(1, int(height * scale)))
+            if scale < 1:
+                # Тот же масштаб декодирования JPEG, что в resize_image_for_claude
+                image.draft(None, target)
+            bands = len(image.getbands())
+            decoded = (image.size[0] * image.size[1] + target[0] * target[1]) * bands
+    except Exception:
+        decoded = 0  # не изображение - отсеется при ingest
+    finally:
+        if not isinstance(source, str):
+            source.seek(0)
+    return raw, decoded
+
+
+async def admit_blobs(hashes: List[str]):
+    """admit_images для изображений из blob-хранилища"""
+    paths = await asyncio.to_thread(lambda: [path for path in map(find_blob, hashes) if path])
+    await admit_images(paths)
+
+
+async def admit_images(sources: list):
+    """Резервирует память под изображения запроса (файлы или пути); ждет в очереди или бросает AdmissionRejected"""
+    lease = _admission_lease.get()
+    if lease is None:
+        return
+    estimates = await asyncio.to_thread(lambda: [image_memory_estimate(source) for source in sources])
+    needed = sum(raw for raw, _ in estimates) + max((decoded for _, decoded in estimates), default=0)
+    deadline = current_deadline()
+    timeout = deadline.budget("admission", ADMISSION_MAX_WAIT_SECONDS)
+    set_span_attributes(**{"admission.bytes": needed, "admission.queue_depth": len(memory_budget.waiters)})
+    if memory_budget.waiters or memory_budget.used + needed > memory_budget.capacity:
+        logger.info(
+            f"⏳ Ждем память: нужно {needed / 1024 / 1024:.1f}MB, занято "
+            f"{memory_budget.used / 1024 / 1024:.1f}/{memory_budget.capacity / 1024 / 1024:.0f}MB, "
+            f"в очереди {len(memory_budget.waiters)}")
+    lease.append((await memory_budget.acquire(needed, timeout), time.monotonic()))
+
+
+def release_admission(lease: Optional[list]):
+    """Освобождает память, зарезервированную запросом; повторный вызов ничего не делает"""
+    if lease:
+        memory_budget.timings.record("hold", time.monotonic() - min(since for _, since in lease))
+        memory_budget.release(sum(nbytes for nbytes, _ in lease))
+        lease.clear()
+
+
+def admission_rejected_response(error: AdmissionRejected) -> JSONResponse:
+    logger.warning(f"🚦 {error}, Retry-After: {error.retry_after}с")
+    return JSONResponse({
+        "success": False,
+        "error": str(error),
+        "retry_after": error.retry_after,
+        "trace_id": get_trace_id()
+    }, status_code=429, headers={"Retry-After": str(error.retry_after)})
+
+
+class AdmissionMiddleware:
+    """ASGI-middleware: память, зарезервированная запросом, освобождается после отправки ответа"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST":
+            return await self.app(scope, receive, send)
+        lease = []  # [(байт, когда зарезервировано)]
+        token = _admission_lease.set(lease)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _admission_lease.reset(token)
+            release_admission(lease)
+
+
+app.add_middleware(AdmissionMiddleware)
 
 
 @app.get("/diagnostic", response_class=HTMLResponse)
-async def diagnostic_page():
+async def diagnostic_page(request: Request):
     """Диагностическая страница для анализа отдельных изображений"""
     try:
-        return FileResponse('static/diagnostic.html')
+        return static_page_response(request, 'static/diagnostic.html')
     except Exception as e:
         logger.error(f"Ошибка загрузки диагностической страницы: {e}")
         return HTMLResponse("""
@@ -1711,10 +4755,10 @@ async def diagnostic_page():
 
 
 @app.get("/debug", response_class=HTMLResponse)
-async def debug_page():
+async def debug_page(request: Request):
     """Отладочная страница"""
     try:
-        return FileResponse('static/debug.html')
+        return static_page_response(request, 'static/debug.html')
     except Exception as e:
         logger.error(f"Ошибка загрузки отладочной страницы: {e}")
         # Возвращаем встроенную отладочную страницу
@@ -1747,29 +4791,128 @@ async def debug_page():
         """, status_code=200)
 
 
+# ===== Чтение логов =====
+LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40, "CRITICAL": 50}
+LOG_LEVEL_PATTERN = re.compile(r" - (DEBUG|INFO|WARNING|ERROR|CRITICAL) - ")
+LOG_TAIL_BLOCK_SIZE = 64 * 1024
+LOG_STREAM_POLL_INTERVAL = 0.5
+LOG_STREAM_HEARTBEAT = 15
+
+
+def log_line_matches(line: str, min_level: int, query: Optional[str]) -> bool:
+    """Фильтр по минимальному уровню и подстроке (без учета регистра)"""
+    if min_level:
+        match = LOG_LEVEL_PATTERN.search(line)
+        # Строки без уровня (продолжения traceback) показываем только без фильтра
+        if not match or LOG_LEVELS[match.group(1)] < min_level:
+            return False
+    if query and query not in line.lower():
+        return False
+    return True
+
+
+def read_lines_reversed(path: str):
+    """Читает файл с конца блоками и отдает строки от последней к первой"""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        remainder = b""
+        while position > 0:
+            read_size = min(LOG_TAIL_BLOCK_SIZE, position)
+            position -= read_size
+            f.seek(position)
+            block = f.read(read_size) + remainder
+            lines = block.split(b"\n")
+            # Первая строка блока может быть неполной - доклеим ее к следующему блоку
+            remainder = lines.pop(0)
+            for line in reversed(lines):
+                if line:
+                    yield line.decode('utf-8', errors='replace')
+        if remainder:
+            yield remainder.decode('utf-8', errors='replace')
+
+
+def tail_log_lines(lines: int, level: Optional[str] = None, query: Optional[str] = None) -> tuple[List[str], int]:
+    """
+    Последние N подходящих строк из app.log и ротированных копий app.log.1..N
+    Читает с конца и останавливается, как только набрано нужное количество
+    """
+    min_level = LOG_LEVELS.get((level or "").upper(), 0)
+    query = query.lower() if query else None
+
+    matched = []
+    files_scanned = 0
+    for index in range(file_handler.backupCount + 1):
+        path = log_file_path if index == 0 else f"{log_file_path}.{index}"
+        if not os.path.exists(path):
+            break
+        files_scanned += 1
+        for line in read_lines_reversed(path):
+            if log_line_matches(line, min_level, query):
+                matched.append(line.rstrip('\r'))
+                if len(matched) >= lines:
+                    return list(reversed(matched)), files_scanned
+    return list(reversed(matched)), files_scanned
+
+
+async def stream_log_lines(request: Request, level: Optional[str], query: Optional[str]):
+    """Server-Sent Events: отправляет только новые строки app.log, переживает ротацию"""
+    min_level = LOG_LEVELS.get((level or "").upper(), 0)
+    query = query.lower() if query else None
+
+    f = open(log_file_path, 'r', encoding='utf-8', errors='replace')
+    f.seek(0, os.SEEK_END)
+    inode = os.fstat(f.fileno()).st_ino
+    last_sent = time.time()
+    try:
+        yield "retry: 3000\n\n"
+        while not await request.is_disconnected():
+            new_lines = f.readlines()
+            for line in new_lines:
+                line = line.rstrip('\r\n')
+                if line and log_line_matches(line, min_level, query):
+                    yield f"data: {json.dumps(line, ensure_ascii=False)}\n\n"
+                    last_sent = time.time()
+
+            # После ротации app.log - новый файл, переоткрываем его с начала
+            try:
+                if os.stat(log_file_path).st_ino != inode:
+                    f.close()
+                    f = open(log_file_path, 'r',
+                             encoding='utf-8', errors='replace')
+                    inode = os.fstat(f.fileno()).st_ino
+                    continue
+            except FileNotFoundError:
+                pass
+
+            if time.time() - last_sent > LOG_STREAM_HEARTBEAT:
+                yield ": ping\n\n"
+                last_sent = time.time()
+            await asyncio.sleep(LOG_STREAM_POLL_INTERVAL)
+    finally:
+        f.close()
+
+
 @app.get("/api/logs")
-async def get_logs(lines: int = 100):
-    """Получить последние строки логов"""
+async def get_logs(lines: int = 100, level: Optional[str] = None, q: Optional[str] = None):
+    """Получить последние строки логов (с фильтром по уровню и тексту)"""
     try:
-        log_file = os.path.join(STORAGE_BASE, "logs", "app.log")
-        if not os.path.exists(log_file):
+        if not os.path.exists(log_file_path):
             return JSONResponse({
                 "success": False,
                 "message": "Файл логов не найден",
                 "logs": []
             })
 
-        # Читаем последние N строк
-        with open(log_file, 'r', encoding='utf-8') as f:
-            all_lines = f.readlines()
-            recent_lines = all_lines[-lines:] if len(
-                all_lines) > lines else all_lines
+        lines = max(1, min(lines, 5000))
+        recent_lines, files_scanned = await asyncio.to_thread(
+            tail_log_lines, lines, level, q)
 
         return JSONResponse({
             "success": True,
-            "total_lines": len(all_lines),
             "returned_lines": len(recent_lines),
-            "logs": [line.strip() for line in recent_lines]
+            "files_scanned": files_scanned,
+            "logs": recent_lines
         })
 
     except Exception as e:
@@ -1781,10 +4924,20 @@ async def get_logs(lines: int = 100):
         }, status_code=500)
 
 
-@app.get("/logs", response_class=HTMLResponse)
-async def logs_page():
-    """Веб-страница для просмотра логов"""
-    return HTMLResponse("""
+@app.get("/api/logs/stream")
+async def stream_logs(request: Request, level: Optional[str] = None, q: Optional[str] = None):
+    """Поток новых строк логов (Server-Sent Events)"""
+    if not os.path.exists(log_file_path):
+        raise HTTPException(status_code=404, detail="Файл логов не найден")
+
+    return StreamingResponse(
+        stream_log_lines(request, level, q),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+LOGS_PAGE_HTML = """
     <!DOCTYPE html>
     <html>
     <head>
@@ -1800,7 +4953,7 @@ async def logs_page():
             .controls { margin-bottom: 20px; }
             button { padding: 10px 20px; margin: 5px; background: #333; color: #fff; border: none; border-radius: 3px; cursor: pointer; }
             button:hover { background: #555; }
-            select { padding: 8px; background: #333; color: #fff; border: 1px solid #555; }
+            select, input { padding: 8px; background: #333; color: #fff; border: 1px solid #555; }
         </style>
     </head>
     <body>
@@ -1816,6 +4969,13 @@ async def logs_page():
                 <option value="200">200 строк</option>
                 <option value="500">500 строк</option>
             </select>
+            <select id="levelFilter" onchange="applyFilters()">
+                <option value="">Все уровни</option>
+                <option value="INFO">INFO и выше</option>
+                <option value="WARNING">WARNING и выше</option>
+                <option value="ERROR">Только ERROR</option>
+            </select>
+            <input id="textFilter" placeholder="Поиск (session_id, trace_id...)" onkeydown="if (event.key === 'Enter') applyFilters()">
         </div>
         
         <div class="log-container" id="logContainer">
@@ -1823,22 +4983,35 @@ async def logs_page():
         </div>
 
         <script>
-            let autoRefreshInterval = null;
+            let logStream = null;
+            
+            // Фильтры применяются на сервере
+            function filterParams() {
+                const params = new URLSearchParams();
+                const level = document.getElementById('levelFilter').value;
+                const text = document.getElementById('textFilter').value.trim();
+                if (level) params.set('level', level);
+                if (text) params.set('q', text);
+                return params;
+            }
+            
+            function renderLine(line) {
+                let className = 'info';
+                if (line.includes('ERROR') || line.includes('❌')) className = 'error';
+                else if (line.includes('WARNING') || line.includes('⚠️')) className = 'warning';
+                
+                return `<div class="log-line ${className}">${escapeHtml(line)}</div>`;
+            }
             
             function loadLogs() {
-                const lines = document.getElementById('lineCount').value;
-                fetch(`/api/logs?lines=${lines}`)
+                const params = filterParams();
+                params.set('lines', document.getElementById('lineCount').value);
+                fetch(`/api/logs?${params}`)
                     .then(r => r.json())
                     .then(data => {
                         const container = document.getElementById('logContainer');
                         if (data.success) {
-                            container.innerHTML = data.logs.map(line => {
-                                let className = 'info';
-                                if (line.includes('ERROR') || line.includes('❌')) className = 'error';
-                                else if (line.includes('WARNING') || line.includes('⚠️')) className = 'warning';
-                                
-                                return `<div class="log-line ${className}">${escapeHtml(line)}</div>`;
-                            }).join('');
+                            container.innerHTML = data.logs.map(renderLine).join('');
                             container.scrollTop = container.scrollHeight;
                         } else {
                             container.innerHTML = `<div class="log-line error">Ошибка: ${data.error || data.message}</div>`;
@@ -1850,14 +5023,44 @@ async def logs_page():
                     });
             }
             
+            // Живой поток: сервер присылает только новые строки
+            function startStream() {
+                logStream = new EventSource(`/api/logs/stream?${filterParams()}`);
+                logStream.onmessage = (event) => {
+                    const container = document.getElementById('logContainer');
+                    const atBottom = container.scrollTop + container.clientHeight >= container.scrollHeight - 20;
+                    container.insertAdjacentHTML('beforeend', renderLine(JSON.parse(event.data)));
+                    const maxLines = parseInt(document.getElementById('lineCount').value, 10);
+                    while (container.children.length > maxLines) {
+                        container.removeChild(container.firstChild);
+                    }
+                    if (atBottom) container.scrollTop = container.scrollHeight;
+                };
+            }
+            
+            function stopStream() {
+                if (logStream) {
+                    logStream.close();
+                    logStream = null;
+                }
+            }
+            
             function autoRefresh() {
-                if (autoRefreshInterval) {
-                    clearInterval(autoRefreshInterval);
-                    autoRefreshInterval = null;
-                    document.querySelector('button[onclick="autoRefresh()"]').textContent = '⏰ Авто-обновление';
+                const button = document.querySelector('button[onclick="autoRefresh()"]');
+                if (logStream) {
+                    stopStream();
+                    button.textContent = '⏰ Авто-обновление';
                 } else {
-                    autoRefreshInterval = setInterval(loadLogs, 3000);
-                    document.querySelector('button[onclick="autoRefresh()"]').textContent = '⏹️ Остановить';
+                    startStream();
+                    button.textContent = '⏹️ Остановить';
+                }
+            }
+            
+            function applyFilters() {
+                loadLogs();
+                if (logStream) {
+                    stopStream();
+                    startStream();
                 }
             }
             
@@ -1876,39 +5079,105 @@ async def logs_page():
         </script>
     </body>
     </html>
-    """)
+    """
+
+# Страница не меняется - сжимаем один раз при запуске
+LOGS_PAGE = CompressedAsset(LOGS_PAGE_HTML.encode('utf-8'), "text/html")
+
+
+@app.get("/logs", response_class=HTMLResponse)
+async def logs_page(request: Request):
+    """Веб-страница для просмотра логов"""
+    return LOGS_PAGE.response(request)
+
+
+def load_debug_session(session_id: str) -> Optional[dict]:
+    """
+    Находит сессию в папке debug_images или в дневном архиве
+    Возвращает метаданные, старые файлы-копии (если есть) и путь к архиву
+    """
+    debug_folder = os.path.join(STORAGE_BASE, "debug_images", session_id)
+    if os.path.isdir(debug_folder):
+        files = [{
+            "filename": filename,
+            "size": os.path.getsize(os.path.join(debug_folder, filename)),
+            "url": f"/debug-files/{session_id}/{filename}"
+        } for filename in sorted(os.listdir(debug_folder)) if filename != "metadata.json"]
+        return {"metadata": read_session_metadata(debug_folder), "files": files, "archive": None}
+
+    # Старые сессии уборщик переносит в дневные архивы
+    archive_path = find_archived_session(session_id)
+    if not archive_path:
+        return None
+
+    prefix = f"{session_id}/"
+    with zipfile.ZipFile(archive_path) as zf:
+        names = [name for name in zf.namelist() if name.startswith(prefix)]
+        metadata = {"files": []}
+        if prefix + "metadata.json" in names:
+            metadata = json.loads(zf.read(prefix + "metadata.json"))
+        files = [{
+            "filename": name[len(prefix):],
+            "size": zf.getinfo(name).file_size,
+            "url": f"/debug-files/{session_id}/{name[len(prefix):]}"
+        } for name in names if name != prefix + "metadata.json"]
+    return {"metadata": metadata, "files": files, "archive": archive_path}
+
+
+def blob_response(request: Request, sha256: str, path: str) -> Response:
+    """Отдает blob с сильным ETag - содержимое по хэшу никогда не меняется"""
+    etag = f'"{sha256}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "public, max-age=31536000, immutable"
+    }
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+
+    media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+
+@app.get("/blobs/{sha256}")
+async def get_blob(sha256: str, request: Request):
+    """Получить изображение из хранилища по хэшу содержимого"""
+    if not is_sha256(sha256):
+        raise HTTPException(status_code=400, detail="Неверный хэш")
+
+    path = find_blob(sha256)
+    if not path:
+        raise HTTPException(status_code=404, detail="Изображение не найдено")
+
+    return blob_response(request, sha256, path)
 
 
 @app.get("/debug-files/{session_id}")
 async def get_debug_files(session_id: str):
     """Получить список отладочных файлов для сессии"""
     try:
-        debug_folder = os.path.join(STORAGE_BASE, "debug_images", session_id)
-        if not os.path.exists(debug_folder):
+        session = load_debug_session(session_id)
+        if not session:
             raise HTTPException(status_code=404, detail="Сессия не найдена")
 
-        # Читаем метаданные
-        metadata_path = os.path.join(debug_folder, "metadata.json")
-        if os.path.exists(metadata_path):
-            with open(metadata_path, 'r', encoding='utf-8') as f:
-                metadata = json.load(f)
-        else:
-            metadata = {"files": []}
+        metadata = session["metadata"]
 
-        # Получаем список файлов
-        files = []
-        for filename in os.listdir(debug_folder):
-            if filename != "metadata.json":
-                file_path = os.path.join(debug_folder, filename)
+        # Старые сессии хранят копии файлов, новые - ссылки на blob'ы
+        files = session["files"]
+        for entry in metadata.get("files", []):
+            if entry.get("sha256"):
                 files.append({
-                    "filename": filename,
-                    "size": os.path.getsize(file_path),
-                    "url": f"/debug-files/{session_id}/{filename}"
+                    "filename": entry["debug_filename"],
+                    "size": entry["size_bytes"],
+                    "sha256": entry["sha256"],
+                    "url": blob_url(entry["sha256"])
                 })
 
         return JSONResponse({
             "success": True,
             "session_id": session_id,
+            "archived": bool(session["archive"]),
+            "archive": os.path.basename(session["archive"]) if session["archive"] else None,
             "metadata": metadata,
             "files": files
         })
@@ -1922,15 +5191,36 @@ async def get_debug_files(session_id: str):
 
 
 @app.get("/debug-files/{session_id}/{filename}")
-async def get_debug_file(session_id: str, filename: str):
+async def get_debug_file(session_id: str, filename: str, request: Request):
     """Получить конкретный отладочный файл"""
     try:
         file_path = os.path.join(
             STORAGE_BASE, "debug_images", session_id, filename)
-        if not os.path.exists(file_path):
+        if os.path.exists(file_path):
+            return FileResponse(file_path)
+
+        session = load_debug_session(session_id)
+        if not session:
             raise HTTPException(status_code=404, detail="Файл не найден")
 
-        return FileResponse(file_path)
+        # Имя файла сессии (в том числе старое NN.webp) ведет на blob по хэшу
+        for entry in session["metadata"].get("files", []):
+            if entry.get("sha256") and filename in (entry.get("debug_filename"), f"{entry['index']:02d}.webp"):
+                blob_path = find_blob(entry["sha256"])
+                if blob_path:
+                    return blob_response(request, entry["sha256"], blob_path)
+
+        if not session["archive"]:
+            raise HTTPException(status_code=404, detail="Файл не найден")
+        with zipfile.ZipFile(session["archive"]) as zf:
+            try:
+                contents = zf.read(f"{session_id}/{filename}")
+            except KeyError:
+                raise HTTPException(
+                    status_code=404, detail="Файл не найден")
+        media_type = mimetypes.guess_type(
+            filename)[0] or "application/octet-stream"
+        return Response(contents, media_type=media_type)
 
     except Exception as e:
         logger.error(f"Ошибка получения файла: {e}")
@@ -1990,7 +5280,6 @@ async def get_file_structure():
 
         # Добавляем информацию о дисковом пространстве
         try:
-            import shutil
             total, used, free = shutil.disk_usage(current_dir)
             structure["disk_usage"] = {
                 "total_gb": round(total / (1024**3), 2),
@@ -2013,10 +5302,7 @@ async def get_file_structure():
         }, status_code=500)
 
 
-@app.get("/file-browser", response_class=HTMLResponse)
-async def file_browser():
-    """Веб-браузер файлов"""
-    return HTMLResponse("""
+FILE_BROWSER_PAGE_HTML = """
     <!DOCTYPE html>
     <html>
     <head>
@@ -2113,245 +5399,30 @@ async def file_browser():
         </script>
     </body>
     </html>
-    """)
+    """
+FILE_BROWSER_PAGE = CompressedAsset(FILE_BROWSER_PAGE_HTML.encode('utf-8'), "text/html")
+
+
+@app.get("/file-browser", response_class=HTMLResponse)
+async def file_browser(request: Request):
+    """Веб-браузер файлов"""
+    return FILE_BROWSER_PAGE.response(request)
 
 
 @app.post("/api/analyze-product-detailed")
-async def analyze_product_detailed(files: List[UploadFile] = File(...)):
+async def analyze_product_detailed(request: Request, files: List[UploadFile] = File(...)):
     """Детальный анализ одного товара с множественными фотографиями"""
     try:
         logger.info(
             f"🔍 ДЕТАЛЬНЫЙ АНАЛИЗ ТОВАРА: Получено {len(files)} фотографий")
-
-        # Собираем все валидные изображения
-        image_batch = []
-        file_info = []
-
-        for file in files:
-            if not file.content_type or not file.content_type.startswith('image/'):
-                logger.warning(
-                    f"⚠️ Пропускаем {file.filename} - неверный тип: {file.content_type}")
-                continue
-
-            try:
-                contents = await file.read()
-                if len(contents) > 20 * 1024 * 1024:  # 20MB
-                    logger.warning(
-                        f"⚠️ Пропускаем {file.filename} - слишком большой: {len(contents)/1024/1024:.1f}MB")
-                    continue
-
-                image_batch.append((contents, file.filename))
-                file_info.append({
-                    'filename': file.filename,
-                    'content_type': file.content_type,
-                    'size': len(contents),
-                    'contents': contents
-                })
-
-            except Exception as file_error:
-                logger.error(
-                    f"❌ Ошибка чтения файла {file.filename}: {file_error}")
-                continue
-
-        if not image_batch:
-            raise HTTPException(
-                status_code=400, detail="Нет валидных изображений")
-
-        # Сохраняем отладочные файлы
-        session_id = f"detailed_{int(time.time())}_{len(image_batch)}"
-        debug_folder = save_debug_files(image_batch, session_id)
-
-        # Подготавливаем изображения для анализа
-        image_contents = []
-        for i, (image_data, filename) in enumerate(image_batch):
-            logger.info(f"🖼️ Обработка изображения {i}: {filename}")
-
-            resized_image_data, mime_type = resize_image_for_claude(
-                image_data, max_size=2000)
-            base64_image = base64.b64encode(resized_image_data).decode('utf-8')
-
-            image_contents.append({
-                "type": "image",
-                "source": {
-                    "type": "base64",
-                    "media_type": mime_type,
-                    "data": base64_image
-                }
-            })
-
-        # Детальный промпт для анализа товара
-        detailed_prompt = f"""Проанализируй эти {len(image_batch)} фотографий ОДНОГО товара и заполни максимально подробную информацию.
-
-ЗАДАЧА: Создать детальное описание товара для объявления на сайте Somon.tj
-
-Верни результат в JSON формате:
-{{
-  "title": "Точное название товара с брендом и моделью",
-  "brand": "Бренд/производитель",
-  "model": "Модель/артикул",
-  "category": "Основная категория",
-  "subcategory": "Подкатегория",
-  "condition": "Состояние (новый/б/у/отличное/хорошее/удовлетворительное)",
-  "color": "Основной цвет",
-  "material": "Материал изготовления",
-  "size": "Размер/габариты",
-  "weight": "Вес (если видно)",
-  "year": "Год выпуска (если определим)",
-  "country": "Страна производства (если видно)",
-  "features": ["список", "ключевых", "особенностей", "и", "функций"],
-  "included": ["что", "входит", "в", "комплект"],
-  "defects": ["видимые", "дефекты", "или", "износ"],
-  "description": "Подробное описание товара для объявления",
-  "keywords": ["ключевые", "слова", "для", "поиска"],
-  "estimated_price_range": "Примерная ценовая категория",
-  "target_audience": "Целевая аудитория",
-  "usage_tips": "Советы по использованию",
-  "care_instructions": "Инструкции по уходу",
-  "compatibility": "Совместимость с другими товарами",
-  "technical_specs": {{
-    "spec1": "значение1",
-    "spec2": "значение2"
-  }},
-  "photo_analysis": {{
-    "main_photo": "номер лучшего фото для главного изображения (0-{len(image_batch)-1})",
-    "photo_descriptions": ["описание фото 0", "описание фото 1", "..."]
-  }}
-}}
-
-ВАЖНО:
-- Анализируй ВСЕ детали на фотографиях
-- Читай все надписи, этикетки, бирки
-- Определяй технические характеристики
-- Оценивай состояние и дефекты
-- Предлагай лучшее фото для главного изображения
-- Если информация не видна, указывай "не определено"
-"""
-
-        try:
-            # Инициализация клиента
-            api_key = os.getenv("ANTHROPIC_API_KEY")
-            if not api_key:
-                logger.error("❌ API ключ Anthropic не настроен!")
-                raise ValueError(
-                    "API ключ Anthropic не настроен в переменных окружения")
-
-            client = anthropic.Anthropic(
-                api_key=api_key,
-                timeout=120.0,
-                max_retries=2
-            )
-
-            logger.info("🚀 ОТПРАВЛЯЕМ ДЕТАЛЬНЫЙ ЗАПРОС В CLAUDE API...")
-
-            message = client.messages.create(
-                model="claude-sonnet-4-20250514",
-                max_tokens=8192,
-                temperature=0.1,  # Низкая температура для точности
-                system="""Ты эксперт по анализу товаров для интернет-магазина. Твоя задача - создать максимально подробное и точное описание товара на основе фотографий.
-
-Принципы анализа:
-- Внимательно изучай каждую деталь на фотографиях
-- Читай все видимые надписи, этикетки, бирки
-- Определяй бренд, модель, технические характеристики
-- Оценивай состояние и выявляй дефекты
-- Анализируй материалы, цвета, размеры
-- Определяй комплектность и аксессуары
-- Предлагай ключевые слова для поиска
-- Создавай привлекательное описание для покупателей
-
-Будь максимально точным и детальным в анализе.""",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            *image_contents,
-                            {
-                                "type": "text",
-                                "text": detailed_prompt
-                            }
-                        ],
-                    }
-                ],
-            )
-
-            response_text = message.content[0].text
-            logger.info(
-                f"✅ ПОЛУЧЕН ДЕТАЛЬНЫЙ ОТВЕТ! Длина: {len(response_text)} символов")
-
-            # Проверяем что ответ не является HTML
-            if response_text.strip().startswith('<'):
-                logger.error("❌ ПОЛУЧЕН HTML ВМЕСТО JSON!")
-                raise ValueError("Claude вернул HTML вместо JSON")
-
-            # Извлекаем JSON
-            if response_text.strip().startswith('```'):
-                lines = response_text.strip().split('\n')
-                json_lines = []
-                in_json = False
-                for line in lines:
-                    if line.strip() == '```json' or (line.strip() == '```' and in_json):
-                        in_json = not in_json
-                        continue
-                    if in_json:
-                        json_lines.append(line)
-                response_text = '\n'.join(json_lines)
-            else:
-                # Ищем JSON в тексте
-                start_idx = response_text.find('{')
-                end_idx = response_text.rfind('}')
-                if start_idx != -1 and end_idx != -1 and end_idx > start_idx:
-                    response_text = response_text[start_idx:end_idx+1]
-
-            product_data = json.loads(response_text)
-
-            # Добавляем изображения к результату
-            product_images = []
-            for i, info in enumerate(file_info):
-                image_base64 = base64.b64encode(
-                    info['contents']).decode('utf-8')
-                product_images.append({
-                    "index": i,
-                    "filename": info['filename'],
-                    "data": f"data:image/{info['filename'].split('.')[-1]};base64,{image_base64}",
-                    "size": info['size']
-                })
-
-            result = {
-                "success": True,
-                "product": product_data,
-                "images": product_images,
-                "total_images": len(product_images),
-                "debug_folder": debug_folder,
-                "session_id": session_id
-            }
-
-            logger.info(
-                f"✅ Детальный анализ завершен: {product_data.get('title', 'Товар')}")
-            return JSONResponse(result)
-
-        except (json.JSONDecodeError, ValueError) as e:
-            logger.error(f"❌ ОШИБКА ПАРСИНГА JSON: {e}")
-            return JSONResponse({
-                "success": False,
-                "error": f"Ошибка парсинга ответа Claude: {str(e)}",
-                "raw_response": response_text,
-                "debug_folder": debug_folder,
-                "session_id": session_id
-            }, status_code=500)
+        return await run_analysis(
+            DETAILED_SPEC, await ingest_uploads(files), len(files), request=request)
 
     except Exception as e:
-        logger.error(
-            f"❌ Ошибка детального анализа: {e}\n{traceback.format_exc()}")
-        return JSONResponse({
-            "success": False,
-            "error": f"Ошибка сервера: {str(e)}"
-        }, status_code=500)
+        return analysis_error_response(e, "детального анализа")
 
 
-@app.get("/product-analyzer", response_class=HTMLResponse)
-async def product_analyzer_page():
-    """Страница детального анализа товара"""
-    return HTMLResponse("""
+PRODUCT_ANALYZER_PAGE_HTML = """
     <!DOCTYPE html>
     <html lang="ru">
     <head>
@@ -2897,7 +5968,14 @@ async def product_analyzer_page():
         </script>
     </body>
     </html>
-    """)
+    """
+PRODUCT_ANALYZER_PAGE = CompressedAsset(PRODUCT_ANALYZER_PAGE_HTML.encode('utf-8'), "text/html")
+
+
+@app.get("/product-analyzer", response_class=HTMLResponse)
+async def product_analyzer_page(request: Request):
+    """Страница детального анализа товара"""
+    return PRODUCT_ANALYZER_PAGE.response(request)
 
 
 if __name__ == "__main__":
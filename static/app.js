@@ -7,16 +7,72 @@ const {
   Zap, CheckCircle, AlertCircle
 } = lucide;
 
+// Фото товаров из ответа сервера. Если фото загружали отсюда же, берем уже готовые
+// превью по sha256 (image_hashes), иначе делаем миниатюры из data URL ответа -
+// в состоянии не остается base64 полного размера.
+const resolveResultImages = async (result, previewsByHash) => {
+  const hashes = result.image_hashes || [];
+  if (hashes.length > 0 && hashes.every(hash => previewsByHash.has(hash))) {
+    return hashes.map(hash => previewsByHash.get(hash));
+  }
+  const sources = (result.images || [result.image_preview]).filter(Boolean);
+  return Promise.all(sources.map(window.ImagePreprocess.createPreviewUrl));
+};
+
+const mapPreviewsByHash = async (uploadedImages) => {
+  if (!window.ResumableUpload.isSupported()) return new Map();
+  try {
+    const hashes = await Promise.all(uploadedImages.map(img => window.ResumableUpload.hashFile(img.file)));
+    return new Map(hashes.map((hash, i) => [hash, uploadedImages[i].preview]));
+  } catch (error) {
+    console.warn('⚠️ Не удалось сопоставить превью по хэшам:', error);
+    return new Map();
+  }
+};
+
+// Карточка рендерится, только пока она рядом с экраном; вдали от него остается
+// пустой блок той же высоты. При 50 товарах в DOM лишь несколько карточек с фото.
+const WINDOW_MARGIN_PX = 800;
+
+const VirtualItem = ({ estimatedHeight, children }) => {
+  const ref = useRef(null);
+  const height = useRef(estimatedHeight);
+  const [visible, setVisible] = useState(typeof IntersectionObserver === 'undefined');
+
+  useEffect(() => {
+    const node = ref.current;
+    if (!node || typeof IntersectionObserver === 'undefined') return undefined;
+
+    const observer = new IntersectionObserver(([entry]) => {
+      // Запоминаем настоящую высоту, пока карточка еще отрисована
+      if (!entry.isIntersecting && node.offsetHeight > 0) height.current = node.offsetHeight;
+      setVisible(entry.isIntersecting);
+    }, { rootMargin: `${WINDOW_MARGIN_PX}px 0px` });
+    observer.observe(node);
+    return () => observer.disconnect();
+  }, []);
+
+  return (
+    <div ref={ref} style={visible ? undefined : { height: height.current }}>
+      {visible ? children : null}
+    </div>
+  );
+};
+
 const PhotoListingApp = () => {
   const [currentStep, setCurrentStep] = useState('upload'); // 'upload', 'results', 'promotion'
   const [uploadedImages, setUploadedImages] = useState([]);
   const [processing, setProcessing] = useState(false);
+  const [uploadProgress, setUploadProgress] = useState(null);
+  const [analysisSessionId, setAnalysisSessionId] = useState(null);
+  const [reanalyzing, setReanalyzing] = useState(false);
   const [dragActive, setDragActive] = useState(false);
   const [results, setResults] = useState([]);
   const [publishedItems, setPublishedItems] = useState([]);
   const [userDescription, setUserDescription] = useState('');
 
   const fileInputRef = useRef(null);
+  const livePreviews = useRef(new Set());
   const [files, setFiles] = useState([]);
   const [loading, setLoading] = useState(false);
   const [error, setError] = useState(null);
@@ -74,6 +130,7 @@ const PhotoListingApp = () => {
   useEffect(() => {
     // Загружаем категории при старте
     loadCategories();
+    window.ImagePreprocess.loadUploadConfig();
 
     // Загружаем результаты из localStorage
     const savedResults = localStorage.getItem('ai_tovar_results');
@@ -115,18 +172,19 @@ const PhotoListingApp = () => {
   const handleFiles = (files) => {
     const imageFiles = files.filter(file => file.type.startsWith('image/'));
 
-    imageFiles.forEach(file => {
-      const reader = new FileReader();
-      reader.onload = (e) => {
-        setUploadedImages(prev => [...prev, {
-          id: Date.now() + Math.random(),
-          file,
-          preview: e.target.result,
-          name: file.name,
-          size: file.size
-        }]);
-      };
-      reader.readAsDataURL(file);
+    imageFiles.forEach(async (originalFile) => {
+      // Уменьшаем до размера сервера ещё в браузере (Web Worker)
+      const file = await window.ImagePreprocess.prepareImageForUpload(originalFile);
+      // Превью - миниатюра по object URL, а не base64 всего файла в состоянии
+      const preview = await window.ImagePreprocess.createPreviewUrl(file);
+      setUploadedImages(prev => [...prev, {
+        id: Date.now() + Math.random(),
+        file,
+        preview,
+        name: originalFile.name,
+        size: file.size,
+        originalSize: originalFile.size
+      }]);
     });
   };
 
@@ -138,27 +196,19 @@ const PhotoListingApp = () => {
     setProcessing(true);
 
     try {
-      // Подготавливаем FormData для отправки
-      const formData = new FormData();
-      uploadedImages.forEach(img => {
-        formData.append('files', img.file);
-      });
-
-      // Отправляем запрос к FastAPI
-      const response = await fetch('/api/analyze-multiple', {
-        method: 'POST',
-        body: formData
-      });
-
-      if (!response.ok) {
-        throw new Error(`HTTP error! status: ${response.status}`);
-      }
-
-      const data = await response.json();
+      // Файлы уходят по частям в сессию загрузки, обрыв связи не теряет уже отправленное
+      const data = await window.ResumableUpload.analyzeFiles(
+        uploadedImages.map(img => img.file),
+        { onProgress: setUploadProgress, description: userDescription }
+      );
 
       if (data.success) {
         // Обрабатываем результаты
-        const processedResults = data.results.map(result => {
+        const previewsByHash = await mapPreviewsByHash(uploadedImages);
+        const resultImages = await Promise.all(
+          data.results.map(result => resolveResultImages(result, previewsByHash)));
+
+        const processedResults = data.results.map((result, resultIndex) => {
           // Если результат уже содержит категории от backend, используем их
           const backendCategory = result.category;
           const backendSubcategory = result.subcategory;
@@ -169,7 +219,7 @@ const PhotoListingApp = () => {
 
           return {
             id: result.id,
-            images: result.images || [result.image_preview], // Поддержка множественных изображений
+            images: resultImages[resultIndex], // Поддержка множественных изображений
             title: result.title || extractTitle(result.description),
             description: result.description,
             mainCategory: detectedCategory,
@@ -184,11 +234,13 @@ const PhotoListingApp = () => {
             width: result.width,
             height: result.height,
             size_bytes: result.size_bytes,
-            image_indexes: result.image_indexes || []
+            image_indexes: result.image_indexes || [],
+            image_hashes: result.image_hashes || []
           };
         });
 
         setResults(processedResults);
+        setAnalysisSessionId(data.session_id || null);
 
 
 
@@ -202,6 +254,7 @@ const PhotoListingApp = () => {
       alert(`Ошибка обработки: ${error.message}`);
     } finally {
       setProcessing(false);
+      setUploadProgress(null);
     }
   };
 
@@ -343,40 +396,79 @@ const PhotoListingApp = () => {
     }
   };
 
-  const moveImageToProduct = (fromProductId, imageIndex, toProductId) => {
-    setResults(prev => {
-      const fromProduct = prev.find(item => item.id === fromProductId);
-      if (!fromProduct) return prev;
-
-      const sourceImages = fromProduct.images || [fromProduct.image];
-      const imageToMove = sourceImages[imageIndex];
-      if (!imageToMove) return prev;
-
-      return prev.map(item => {
-        if (item.id === fromProductId) {
-          // Удаляем изображение из исходного товара
-          if (sourceImages.length > 1) {
-            const newImages = sourceImages.filter((_, index) => index !== imageIndex);
-            return {
-              ...item,
-              images: newImages,
-              image: newImages.length > 0 ? newImages[0] : item.image
-            };
-          }
-          return item; // Не удаляем последнее изображение
-        } else if (item.id === toProductId) {
-          // Добавляем изображение к целевому товару
-          const targetImages = item.images || [item.image];
-          const newImages = [...targetImages, imageToMove];
-          return {
-            ...item,
-            images: newImages,
-            image: newImages[0] // Основное изображение остается первым
-          };
-        }
-        return item;
+  // Повторный анализ только измененных товаров: сервер берет фото из сохраненной сессии
+  const reanalyzeProducts = async (changedProducts) => {
+    if (!analysisSessionId || changedProducts.some(item => !item.image_hashes)) return;
+
+    setReanalyzing(true);
+    try {
+      const response = await fetch(`/api/sessions/${analysisSessionId}/reanalyze`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+          groups: changedProducts.map(item => ({ id: item.id, image_hashes: item.image_hashes }))
+        })
       });
+      const data = await response.json();
+      if (!data.success) throw new Error(data.error || 'Ошибка повторного анализа');
+
+      console.log(`🔁 Повторный анализ: ${data.reanalyzed_groups} товаров через Claude, ${data.reused_groups} из кэша`);
+      const updates = new Map(data.results.map(result => [result.id, result]));
+      setResults(prev => prev.map(item => {
+        const result = updates.get(item.id);
+        if (!result) return item;
+        return {
+          ...item,
+          title: result.title || item.title,
+          description: result.description || item.description,
+          mainCategory: result.category || item.mainCategory,
+          subCategory: result.subcategory || item.subCategory
+        };
+      }));
+    } catch (error) {
+      console.error('❌ Ошибка повторного анализа:', error);
+    } finally {
+      setReanalyzing(false);
+    }
+  };
+
+  const moveImageToProduct = (fromProductId, imageIndex, toProductId) => {
+    const fromProduct = results.find(item => item.id === fromProductId);
+    if (!fromProduct) return;
+
+    const sourceImages = fromProduct.images || [fromProduct.image];
+    const imageToMove = sourceImages[imageIndex];
+    if (!imageToMove || sourceImages.length <= 1) return; // Не удаляем последнее изображение
+
+    const sourceHashes = fromProduct.image_hashes;
+    const hashToMove = sourceHashes ? sourceHashes[imageIndex] : undefined;
+
+    const nextResults = results.map(item => {
+      if (item.id === fromProductId) {
+        // Удаляем изображение из исходного товара
+        const newImages = sourceImages.filter((_, index) => index !== imageIndex);
+        return {
+          ...item,
+          images: newImages,
+          image: newImages.length > 0 ? newImages[0] : item.image,
+          image_hashes: sourceHashes ? sourceHashes.filter((_, index) => index !== imageIndex) : undefined
+        };
+      } else if (item.id === toProductId) {
+        // Добавляем изображение к целевому товару
+        const targetImages = item.images || [item.image];
+        const newImages = [...targetImages, imageToMove];
+        return {
+          ...item,
+          images: newImages,
+          image: newImages[0], // Основное изображение остается первым
+          image_hashes: item.image_hashes && hashToMove ? [...item.image_hashes, hashToMove] : undefined
+        };
+      }
+      return item;
     });
+
+    setResults(nextResults);
+    reanalyzeProducts(nextResults.filter(item => item.id === fromProductId || item.id === toProductId));
   };
 
   const deleteResult = (id) => {
@@ -416,6 +508,21 @@ const PhotoListingApp = () => {
     return stats;
   };
 
+  // Object URL превью освобождается, когда фото больше нет ни в загрузке, ни в карточках
+  useEffect(() => {
+    const current = new Set([
+      ...uploadedImages.map(img => img.preview),
+      ...results.flatMap(item => [...(item.images || []), item.image]),
+      ...publishedItems.flatMap(item => [...(item.images || []), item.image])
+    ].filter(url => typeof url === 'string' && url.startsWith('blob:')));
+    livePreviews.current.forEach(url => {
+      if (!current.has(url)) URL.revokeObjectURL(url);
+    });
+    livePreviews.current = current;
+  }, [uploadedImages, results, publishedItems]);
+
+  useEffect(() => () => livePreviews.current.forEach(url => URL.revokeObjectURL(url)), []);
+
   const SomonLogo = () => (
     <div className="flex items-center">
       <span className="text-blue-600 font-bold text-xl">AI</span>
@@ -430,7 +537,7 @@ const PhotoListingApp = () => {
   const handleSingleUpload = async (file) => {
     try {
       const formData = new FormData();
-      formData.append('file', file);
+      formData.append('file', await window.ImagePreprocess.prepareImageForUpload(file));
 
       const response = await fetch('/api/analyze-single', {
         method: 'POST',
@@ -447,7 +554,7 @@ const PhotoListingApp = () => {
         id: data.result.id,
         filename: data.result.filename,
         description: data.result.description,
-        image: data.result.image_preview,
+        image: await window.ImagePreprocess.createPreviewUrl(data.result.image_preview),
         timestamp: new Date().toISOString(),
       };
 
@@ -464,17 +571,8 @@ const PhotoListingApp = () => {
 
   const handleMultipleUpload = async (files) => {
     try {
-      const formData = new FormData();
-      files.forEach(file => {
-        formData.append('files', file);
-      });
-
-      const response = await fetch('/api/analyze-multiple', {
-        method: 'POST',
-        body: formData
-      });
-
-      const data = await response.json();
+      const preparedFiles = await Promise.all(files.map(window.ImagePreprocess.prepareImageForUpload));
+      const data = await window.ResumableUpload.analyzeFiles(preparedFiles);
 
       if (!data.success) {
         throw new Error(data.error || 'Ошибка анализа');
@@ -488,9 +586,11 @@ const PhotoListingApp = () => {
       if (data.grouped && data.results) {
         console.log('📦 Обрабатываем групповой ответ с', data.results.length, 'товарами');
 
-        newResults = data.results.map(product => {
-          // Используем массив images напрямую, так как он уже содержит готовые URL
-          const imageUrls = product.images || [];
+        const productImages = await Promise.all(
+          data.results.map(product => resolveResultImages(product, new Map())));
+
+        newResults = data.results.map((product, productIndex) => {
+          const imageUrls = productImages[productIndex];
           const mainImage = imageUrls.length > 0 ? imageUrls[0] : '';
 
           return {
@@ -507,19 +607,24 @@ const PhotoListingApp = () => {
             condition: extractCondition(product.description || ''),
             currency: 'сомони',
             timestamp: new Date().toISOString(),
-            image_indexes: product.image_indexes || []
+            image_indexes: product.image_indexes || [],
+            image_hashes: product.image_hashes || []
           };
         });
+        setAnalysisSessionId(data.session_id || null);
       } else {
         // Старый формат - отдельные изображения
         console.log('📷 Обрабатываем старый формат с отдельными изображениями');
 
-        newResults = data.results.map(result => ({
+        const previews = await Promise.all(
+          data.results.map(result => window.ImagePreprocess.createPreviewUrl(result.image_preview)));
+
+        newResults = data.results.map((result, resultIndex) => ({
           id: result.id,
           title: extractTitle(result.description),
           description: result.description,
-          images: [result.image_preview], // Одно изображение в массиве
-          image: result.image_preview,
+          images: [previews[resultIndex]], // Одно изображение в массиве
+          image: previews[resultIndex],
           mainCategory: detectCategory(result.description),
           subCategory: detectSubCategory(result.description, detectCategory(result.description)),
           price: extractPrice(result.description),
@@ -617,6 +722,8 @@ const PhotoListingApp = () => {
                     <div key={image.id} className="relative">
                       <img
                         src={image.preview}
+                        loading="lazy"
+                        decoding="async"
                         alt={image.name}
                         className="w-full h-24 object-cover rounded border"
                       />
@@ -665,7 +772,9 @@ const PhotoListingApp = () => {
                   {processing ? (
                     <div className="flex items-center justify-center">
                       <Clock className="w-4 h-4 mr-2 animate-spin" />
-                      Claude AI анализирует товары...
+                      {uploadProgress !== null && uploadProgress < 100
+                        ? `Загрузка фото... ${uploadProgress}%`
+                        : 'Claude AI анализирует товары...'}
                     </div>
                   ) : (
                     `Анализировать ${uploadedImages.length} товаров с ИИ`
@@ -791,7 +900,9 @@ const PhotoListingApp = () => {
           </button>
           <div className="flex-1">
             <h1 className="text-lg font-bold text-gray-800">Проверьте объявления</h1>
-            <p className="text-xs text-gray-600">Claude AI нашел {results.length} товаров</p>
+            <p className="text-xs text-gray-600">
+              {reanalyzing ? 'Claude AI обновляет измененные товары...' : `Claude AI нашел ${results.length} товаров`}
+            </p>
           </div>
         </div>
       </div>
@@ -801,19 +912,20 @@ const PhotoListingApp = () => {
 
         <div className="space-y-4 mb-6">
           {results.map((item) => (
-            <ResultCard
-              key={item.id}
-              item={item}
-              categories={categories}
-              conditions={conditions}
-              currencies={currencies}
-              onUpdate={updateResult}
-              onDelete={deleteResult}
-              onPublish={publishItem}
-              onRemoveImage={removeImageFromProduct}
-              onMoveImage={moveImageToProduct}
-              allProducts={results}
-            />
+            <VirtualItem key={item.id} estimatedHeight={112}>
+              <ResultCard
+                item={item}
+                categories={categories}
+                conditions={conditions}
+                currencies={currencies}
+                onUpdate={updateResult}
+                onDelete={deleteResult}
+                onPublish={publishItem}
+                onRemoveImage={removeImageFromProduct}
+                onMoveImage={moveImageToProduct}
+                allProducts={results}
+              />
+            </VirtualItem>
           ))}
         </div>
 
@@ -872,6 +984,8 @@ const ResultCard = ({ item, categories, conditions, currencies, onUpdate, onDele
             <div className="relative">
               <img
                 src={item.images && item.images.length > 0 ? item.images[0] : item.image}
+                loading="lazy"
+                decoding="async"
                 alt={formData.title}
                 className="w-16 h-16 object-cover rounded"
               />
@@ -936,6 +1050,8 @@ const ResultCard = ({ item, categories, conditions, currencies, onUpdate, onDele
                   <div key={index} className="relative group">
                     <img
                       src={image}
+                      loading="lazy"
+                      decoding="async"
                       alt={`${formData.title} - фото ${index + 1}`}
                       className="w-full h-16 object-cover rounded border hover:border-orange-500 transition-colors cursor-pointer"
                       draggable="true"
@@ -1101,6 +1217,8 @@ const ResultCard = ({ item, categories, conditions, currencies, onUpdate, onDele
           <div className="relative max-w-4xl max-h-full p-4">
             <img
               src={selectedImage}
+              loading="lazy"
+              decoding="async"
               alt="Увеличенное изображение"
               className="max-w-full max-h-full object-contain rounded-lg"
               onClick={(e) => e.stopPropagation()}
@@ -1137,7 +1255,7 @@ const PromotionCard = ({ item, onUpdate }) => {
   return (
     <div className="bg-white rounded-lg border p-4">
       <div className="flex mb-4">
-        <img src={item.images[0]} alt={item.title} className="w-12 h-12 object-cover rounded mr-3" />
+        <img src={item.images[0]} loading="lazy" decoding="async" alt={item.title} className="w-12 h-12 object-cover rounded mr-3" />
         <div className="flex-1">
           <h3 className="font-medium text-gray-800 text-sm">{item.title}</h3>
           <div className="flex items-center justify-between">
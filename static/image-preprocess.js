@@ -0,0 +1,163 @@
+// Предобработка изображений перед загрузкой.
+// Сервер всё равно уменьшает фото до размера, который принимает Claude, поэтому
+// делаем это заранее в браузере: меньше трафика на мобильном интернете и меньше
+// работы для сервера. Целевой размер берём из /api/upload-config.
+
+(function () {
+  const DEFAULT_UPLOAD_CONFIG = {
+    max_dimension: 2000,
+    mime_type: 'image/jpeg',
+    quality: 0.85
+  };
+
+  // Превью в интерфейсе: карточки не больше ~100px, с запасом на плотные экраны
+  const THUMBNAIL_CONFIG = {
+    max_dimension: 320,
+    mime_type: 'image/jpeg',
+    quality: 0.7
+  };
+
+  const EXTENSIONS = {
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+    'image/webp': '.webp'
+  };
+
+  let configPromise = null;
+  let worker = null;
+  let nextTaskId = 0;
+  const pendingTasks = new Map();
+
+  const loadUploadConfig = () => {
+    if (!configPromise) {
+      configPromise = fetch('/api/upload-config')
+        .then(response => response.json())
+        .then(data => (data.success ? { ...DEFAULT_UPLOAD_CONFIG, ...data } : DEFAULT_UPLOAD_CONFIG))
+        .catch(error => {
+          console.warn('⚠️ Не удалось получить параметры загрузки, используем значения по умолчанию:', error);
+          return DEFAULT_UPLOAD_CONFIG;
+        });
+    }
+    return configPromise;
+  };
+
+  const getWorker = () => {
+    if (worker === null) {
+      const supported = typeof Worker !== 'undefined' && typeof OffscreenCanvas !== 'undefined';
+      worker = supported ? new Worker('/static/image-worker.js') : false;
+      if (worker) {
+        worker.onmessage = (e) => {
+          const task = pendingTasks.get(e.data.id);
+          if (!task) return;
+          pendingTasks.delete(e.data.id);
+          if (e.data.error) task.reject(new Error(e.data.error));
+          else task.resolve(e.data);
+        };
+        worker.onerror = (e) => {
+          console.warn('⚠️ Ошибка Web Worker, уменьшаем в основном потоке:', e.message);
+          pendingTasks.forEach(task => task.reject(new Error(e.message)));
+          pendingTasks.clear();
+          worker.terminate();
+          worker = false;
+        };
+      }
+    }
+    return worker || null;
+  };
+
+  const resizeInWorker = (activeWorker, file, config) => new Promise((resolve, reject) => {
+    const id = ++nextTaskId;
+    pendingTasks.set(id, { resolve, reject });
+    activeWorker.postMessage({
+      id,
+      file,
+      maxDimension: config.max_dimension,
+      mimeType: config.mime_type,
+      quality: config.quality
+    });
+  });
+
+  // Запасной путь для браузеров без OffscreenCanvas (старый Safari)
+  const resizeOnMainThread = async (file, config) => {
+    const bitmap = await createImageBitmap(file);
+    const { width, height } = bitmap;
+    if (width <= config.max_dimension && height <= config.max_dimension) {
+      bitmap.close();
+      return { resized: false, width, height };
+    }
+
+    const scale = config.max_dimension / Math.max(width, height);
+    const canvas = document.createElement('canvas');
+    canvas.width = Math.round(width * scale);
+    canvas.height = Math.round(height * scale);
+    const ctx = canvas.getContext('2d');
+    ctx.imageSmoothingQuality = 'high';
+    ctx.drawImage(bitmap, 0, 0, canvas.width, canvas.height);
+    bitmap.close();
+
+    const blob = await new Promise(resolve => canvas.toBlob(resolve, config.mime_type, config.quality));
+    return { resized: Boolean(blob), blob, width: canvas.width, height: canvas.height };
+  };
+
+  const renameForType = (name, mimeType) => {
+    const extension = EXTENSIONS[mimeType] || '';
+    const base = name.replace(/\.[^.]+$/, '');
+    return `${base}${extension}`;
+  };
+
+  // Возвращает файл, готовый к загрузке. При любой ошибке - оригинал:
+  // сервер умеет уменьшать изображения сам.
+  const prepareImageForUpload = async (file) => {
+    if (typeof createImageBitmap === 'undefined') return file;
+
+    try {
+      const config = await loadUploadConfig();
+      const activeWorker = getWorker();
+      const result = activeWorker
+        ? await resizeInWorker(activeWorker, file, config)
+        : await resizeOnMainThread(file, config);
+
+      // Перекодированный файл иногда получается больше исходного - тогда оставляем исходный
+      if (!result.resized || result.blob.size >= file.size) return file;
+
+      console.log(`📐 ${file.name}: ${(file.size / 1024).toFixed(0)}KB → ${(result.blob.size / 1024).toFixed(0)}KB (${result.width}x${result.height})`);
+      return new File([result.blob], renameForType(file.name, result.blob.type || config.mime_type), {
+        type: result.blob.type || config.mime_type,
+        lastModified: file.lastModified
+      });
+    } catch (error) {
+      console.warn(`⚠️ Не удалось уменьшить ${file.name}, загружаем оригинал:`, error);
+      return file;
+    }
+  };
+
+  // Маленькая копия для превью: <img> с фото 2000px держит в памяти декодированный
+  // битмап ~16MB, у миниатюры - меньше 0.5MB. При ошибке - сам файл.
+  const createThumbnail = async (blob) => {
+    if (typeof createImageBitmap === 'undefined') return blob;
+
+    try {
+      const activeWorker = getWorker();
+      const result = activeWorker
+        ? await resizeInWorker(activeWorker, blob, THUMBNAIL_CONFIG)
+        : await resizeOnMainThread(blob, THUMBNAIL_CONFIG);
+      return result.resized ? result.blob : blob;
+    } catch (error) {
+      console.warn('⚠️ Не удалось сделать миниатюру, показываем оригинал:', error);
+      return blob;
+    }
+  };
+
+  // Object URL миниатюры для файла или data URL из ответа сервера.
+  // Освобождать через URL.revokeObjectURL, когда превью больше не показывается.
+  const createPreviewUrl = async (source) => {
+    if (!source) return source;
+    if (typeof source === 'string') {
+      if (!source.startsWith('data:')) return source;
+      source = await (await fetch(source)).blob();
+    }
+    return URL.createObjectURL(await createThumbnail(source));
+  };
+
+  window.ImagePreprocess = { loadUploadConfig, prepareImageForUpload, createThumbnail, createPreviewUrl };
+})();
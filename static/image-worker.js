@@ -0,0 +1,33 @@
+// Web Worker: уменьшает изображение до размера, который принимает сервер.
+// Декодирование и сжатие идут вне основного потока, интерфейс не подвисает.
+
+self.onmessage = async (e) => {
+  const { id, file, maxDimension, mimeType, quality } = e.data;
+
+  try {
+    const bitmap = await createImageBitmap(file);
+    const { width, height } = bitmap;
+
+    // Уже в пределах нормы - отправляем оригинал без перекодирования
+    if (width <= maxDimension && height <= maxDimension) {
+      bitmap.close();
+      self.postMessage({ id, resized: false, width, height });
+      return;
+    }
+
+    const scale = maxDimension / Math.max(width, height);
+    const targetWidth = Math.round(width * scale);
+    const targetHeight = Math.round(height * scale);
+
+    const canvas = new OffscreenCanvas(targetWidth, targetHeight);
+    const ctx = canvas.getContext('2d');
+    ctx.imageSmoothingQuality = 'high';
+    ctx.drawImage(bitmap, 0, 0, targetWidth, targetHeight);
+    bitmap.close();
+
+    const blob = await canvas.convertToBlob({ type: mimeType, quality });
+    self.postMessage({ id, resized: true, blob, width: targetWidth, height: targetHeight });
+  } catch (error) {
+    self.postMessage({ id, error: error.message || String(error) });
+  }
+};
@@ -0,0 +1,187 @@
+// Загрузка фото по частям с продолжением после обрыва связи.
+// Каждый файл отправляется отдельно кусками в сессию загрузки (/api/uploads),
+// файлы, которые сервер уже видел (по sha256), не отправляются повторно.
+// Анализ запускается по id сессии, когда все файлы получены.
+
+(function () {
+  const MAX_ATTEMPTS = 6;
+  const PARALLEL_FILES = 3;
+  const STORAGE_PREFIX = 'upload_session:';
+
+  const sleep = (ms) => new Promise(resolve => setTimeout(resolve, ms));
+
+  // crypto.subtle доступен только по HTTPS и на localhost
+  const isSupported = () => Boolean(window.crypto && window.crypto.subtle);
+
+  const toHex = (buffer) => Array.from(new Uint8Array(buffer))
+    .map(byte => byte.toString(16).padStart(2, '0'))
+    .join('');
+
+  const sha256Hex = async (data) => toHex(await crypto.subtle.digest('SHA-256', data));
+
+  // Хэш считается один раз на файл: его же интерфейс использует, чтобы найти
+  // превью фото из ответа (image_hashes) без base64 от сервера
+  const fileHashes = new WeakMap();
+  const hashFile = (file) => {
+    if (!fileHashes.has(file)) {
+      fileHashes.set(file, file.arrayBuffer().then(sha256Hex));
+    }
+    return fileHashes.get(file);
+  };
+
+  const isRetryableStatus = (status) => status >= 500 && status !== 501;
+
+  // Повторяет запрос при сетевых ошибках и ответах, для которых retryStatus
+  // возвращает true (по умолчанию 5xx), с растущей паузой
+  const fetchJson = async (url, options = {}, retryStatus = isRetryableStatus) => {
+    let lastError = null;
+    for (let attempt = 0; attempt < MAX_ATTEMPTS; attempt++) {
+      if (attempt > 0) await sleep(Math.min(1000 * 2 ** (attempt - 1), 15000));
+      try {
+        const response = await fetch(url, options);
+        if (retryStatus(response.status)) {
+          lastError = new Error(`HTTP error! status: ${response.status}`);
+          continue;
+        }
+        return { status: response.status, data: await response.json() };
+      } catch (error) {
+        console.warn(`⚠️ ${url}: попытка ${attempt + 1} не удалась:`, error.message);
+        lastError = error;
+      }
+    }
+    throw lastError;
+  };
+
+  const sameFiles = (session, hashes) => session.files.length === hashes.length &&
+    session.files.every((entry, i) => entry.sha256 === hashes[i]);
+
+  // Продолжаем сессию, начатую до обрыва или перезагрузки страницы, либо создаем новую
+  const openSession = async (entries) => {
+    const hashes = entries.map(entry => entry.sha256);
+    const storageKey = STORAGE_PREFIX + await sha256Hex(new TextEncoder().encode(hashes.join(',')));
+    const savedId = localStorage.getItem(storageKey);
+
+    if (savedId) {
+      const { status, data } = await fetchJson(`/api/uploads/${savedId}`);
+      if (status === 200 && data.success && sameFiles(data, hashes)) {
+        console.log(`🔁 Продолжаем загрузку ${savedId}: ${data.complete_files}/${data.total_files} файлов`);
+        return { session: data, storageKey };
+      }
+      localStorage.removeItem(storageKey);
+    }
+
+    const { data } = await fetchJson('/api/uploads', {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ files: entries })
+    });
+    if (!data.success) throw new Error(data.error || 'Не удалось создать сессию загрузки');
+
+    localStorage.setItem(storageKey, data.upload_id);
+    console.log(`📥 Сессия загрузки ${data.upload_id}: ${data.complete_files}/${data.total_files} файлов уже на сервере`);
+    return { session: data, storageKey };
+  };
+
+  const uploadFile = async (session, entry, file, onBytes) => {
+    let offset = entry.received;
+    let failures = 0;
+
+    while (offset < entry.size) {
+      const chunk = file.slice(offset, offset + session.chunk_size);
+      try {
+        const response = await fetch(`/api/uploads/${session.upload_id}/files/${entry.sha256}?offset=${offset}`, {
+          method: 'PUT',
+          headers: { 'Content-Type': 'application/octet-stream' },
+          body: chunk
+        });
+        const data = await response.json();
+
+        if (response.ok) {
+          onBytes(data.received - offset);
+          offset = data.complete ? entry.size : data.received;
+          failures = 0;
+          continue;
+        }
+        if (response.status === 409 && failures + 1 < MAX_ATTEMPTS) {
+          // Сервер получил другое количество байт - продолжаем с его позиции
+          failures += 1;
+          onBytes(data.received - offset);
+          offset = data.complete ? entry.size : data.received;
+          continue;
+        }
+        throw new Error(data.error || `HTTP error! status: ${response.status}`);
+      } catch (error) {
+        failures += 1;
+        if (failures >= MAX_ATTEMPTS) throw error;
+        console.warn(`⚠️ ${entry.name}: обрыв на ${offset} байт, повтор ${failures}:`, error.message);
+        await sleep(Math.min(1000 * 2 ** (failures - 1), 15000));
+      }
+    }
+  };
+
+  const uploadAndAnalyze = async (files, { onProgress, description } = {}) => {
+    const entries = await Promise.all(files.map(async (file) => ({
+      name: file.name,
+      size: file.size,
+      sha256: await hashFile(file)
+    })));
+
+    // Одинаковые фото отправляем один раз
+    const filesByHash = new Map();
+    entries.forEach((entry, i) => {
+      if (!filesByHash.has(entry.sha256)) filesByHash.set(entry.sha256, files[i]);
+    });
+    const uniqueEntries = entries.filter((entry, i) => filesByHash.get(entry.sha256) === files[i]);
+
+    const { session, storageKey } = await openSession(uniqueEntries);
+
+    const totalBytes = session.files.reduce((sum, entry) => sum + entry.size, 0);
+    let sentBytes = session.files.reduce((sum, entry) => sum + entry.received, 0);
+    const reportProgress = (bytes) => {
+      sentBytes += bytes;
+      if (onProgress) onProgress(Math.round(sentBytes / totalBytes * 100));
+    };
+    reportProgress(0);
+
+    const pending = session.files.filter(entry => !entry.complete);
+    const workers = Array.from({ length: Math.min(PARALLEL_FILES, pending.length) }, async () => {
+      while (pending.length > 0) {
+        const entry = pending.shift();
+        await uploadFile(session, entry, filesByHash.get(entry.sha256), reportProgress);
+      }
+    });
+    await Promise.all(workers);
+
+    // Описание от пользователя помогает серверу заранее выбрать вероятные категории.
+    // Анализ - дорогой вызов Claude: повторяем только обрыв связи и 503 (сервер
+    // занят), но не 500/504 - там анализ уже мог отработать или упал бы снова
+    const { data } = await fetchJson(`/api/uploads/${session.upload_id}/analyze`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ description: description || '' })
+    }, status => status === 503);
+    if (data.success) localStorage.removeItem(storageKey);
+    return data;
+  };
+
+  // Отправка одним multipart-запросом - для браузеров без crypto.subtle
+  const uploadMultipart = async (files, { description } = {}) => {
+    const formData = new FormData();
+    files.forEach(file => {
+      formData.append('files', file);
+    });
+    if (description) formData.append('description', description);
+
+    const response = await fetch('/api/analyze-multiple', {
+      method: 'POST',
+      body: formData
+    });
+    return response.json();
+  };
+
+  const analyzeFiles = (files, options = {}) => (
+    isSupported() ? uploadAndAnalyze(files, options) : uploadMultipart(files, options)
+  );
+
+  window.ResumableUpload = { analyzeFiles, uploadAndAnalyze, hashFile, isSupported };
+})();
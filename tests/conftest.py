@@ -0,0 +1,12 @@
+"""Общие фикстуры тестов: хранилище сервиса - во временной папке pytest"""
+import importlib
+
+import pytest
+
+
+@pytest.fixture(scope="session")
+def main(tmp_path_factory):
+    """Модуль main, импортированный с STORAGE_BASE во временной папке (blobs, debug_images, логи, usage)"""
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setenv("STORAGE_BASE", str(tmp_path_factory.mktemp("storage")))
+        yield importlib.import_module("main")
@@ -0,0 +1,128 @@
+"""Форма ответов эндпоинтов анализа с подмененным HTTP-транспортом Claude"""
+import io
+import json
+import re
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+
+def claude_reply(body: dict) -> str:
+    """Ответ Claude в зависимости от промпта эндпоинта"""
+    content = body["messages"][0]["content"]
+    prompt = [block for block in content if block.get("type") == "text"][-1]["text"]
+    if "ОДНОГО товара" in prompt:
+        return json.dumps({"title": "Кроссовки Nike", "category": "Одежда и личные вещи",
+                           "subcategory": "обувь"}, ensure_ascii=False)
+    if "image_filenames" in prompt:
+        names = re.findall(r"^- (\S+\.(?:jpg|png))$", prompt, re.M)
+        return json.dumps([{"title": "Чайник", "category": "Электроника и бытовая техника",
+                            "subcategory": "Техника для дома и кухни", "image_filenames": names}],
+                          ensure_ascii=False)
+    if "image_indexes" in prompt:
+        images = sum(1 for block in content if block.get("type") == "image")
+        return json.dumps([{"title": "Телефон", "category": "Телефоны", "subcategory": "Мобильные телефоны",
+                            "image_indexes": list(range(images))}], ensure_ascii=False)
+    return "Описание товара"
+
+
+def messages_response(request: httpx.Request) -> httpx.Response:
+    assert request.url.path == "/v1/messages"
+    body = json.loads(request.content)
+    return httpx.Response(200, json={
+        "id": "msg_test",
+        "type": "message",
+        "role": "assistant",
+        "model": body["model"],
+        "content": [{"type": "text", "text": claude_reply(body)}],
+        "stop_reason": "end_turn",
+        "stop_sequence": None,
+        "usage": {"input_tokens": 100, "output_tokens": 20}
+    })
+
+
+def jpeg(color, size=(64, 48)) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def client(main, monkeypatch):
+    """TestClient, у которого запросы SDK Anthropic уходят в messages_response вместо сети"""
+    def handle_request(transport, request):
+        request.read()
+        return messages_response(request)
+
+    async def handle_async_request(transport, request):
+        await request.aread()
+        return messages_response(request)
+
+    monkeypatch.setattr(httpx.HTTPTransport, "handle_request", handle_request)
+    monkeypatch.setattr(httpx.AsyncHTTPTransport, "handle_async_request", handle_async_request)
+    monkeypatch.setenv("ANTHROPIC_API_KEY", "sk-ant-test-0123456789")
+    monkeypatch.delenv("ANTHROPIC_API_KEYS", raising=False)
+    with TestClient(main.app) as test_client:
+        yield test_client
+
+
+@pytest.fixture
+def files():
+    return [("files", ("red.jpg", jpeg((255, 0, 0)), "image/jpeg")),
+            ("files", ("green.jpg", jpeg((0, 255, 0)), "image/jpeg"))]
+
+
+def assert_envelope(response) -> dict:
+    assert response.status_code == 200, response.text
+    payload = response.json()
+    assert payload["success"] is True
+    assert payload["trace_id"]
+    return payload
+
+
+def test_analyze_single(client, files):
+    payload = assert_envelope(client.post("/api/analyze-single", files={"file": files[0][1]}))
+    assert payload["result"]["description"] == "Описание товара"
+    assert payload["result"]["image_preview"].startswith("data:image/")
+
+
+def test_analyze_grouping(client, files):
+    payload = assert_envelope(client.post("/api/analyze-grouping", files=files))
+    assert payload["total_images"] == 2
+    assert [item["filename"] for item in payload["file_order"]] == ["red.jpg", "green.jpg"]
+    assert len(payload["groups"][0]["images"]) == 2
+
+
+def test_analyze_individual(client, files):
+    payload = assert_envelope(client.post("/api/analyze-individual", files=files))
+    assert [item["description"] for item in payload["descriptions"]] == ["Описание товара"] * 2
+    assert payload["session_id"]
+
+
+def test_analyze_multiple(client, files):
+    payload = assert_envelope(client.post("/api/analyze-multiple", files=files, data={"description": "чайник"}))
+    assert payload["total_files"] == 2
+    assert [result["image_filenames"] for result in payload["results"]] == [["red.jpg", "green.jpg"]]
+    assert payload["results"][0]["category"] == "Электроника и бытовая техника"
+
+
+def test_analyze_product_detailed(client, files):
+    payload = assert_envelope(client.post("/api/analyze-product-detailed", files=files))
+    assert payload["product"]["category"] == "Одежда и личные вещи"
+    assert payload["total_images"] == 2
+
+
+def test_server_error_shape(main, client, files, monkeypatch):
+    monkeypatch.setattr(main, "ingest_uploads", lambda uploads: (_ for _ in ()).throw(RuntimeError("boom")))
+    response = client.post("/api/analyze-multiple", files=files)
+    assert response.status_code == 500
+    payload = response.json()
+    assert payload["success"] is False
+    assert payload["error"] == "Ошибка сервера: boom"
+    assert payload["trace_id"]
+
+
+def test_storage_is_isolated(main, tmp_path_factory):
+    assert main.STORAGE_BASE.startswith(str(tmp_path_factory.getbasetemp()))